@@ -559,3 +559,21 @@ content_server_thumbnail_compression_quality = 75
 # Examples:
 #    cover_drop_exclude = {'tiff', 'webp'}
 cover_drop_exclude = ()
+
+#: Use compact in-memory tables for very large libraries
+# calibre keeps the metadata of all books in memory. For libraries with
+# hundreds of thousands of books this can use a lot of RAM. Setting this to
+# True stores the per-book data in arrays indexed by book id instead of in
+# dictionaries, and shares a single copy of values that are repeated across
+# books. This greatly reduces memory usage at the cost of slightly slower
+# access to individual values. Restart calibre after changing this.
+compact_in_memory_tables = False
+
+#: Read rarely needed columns lazily when opening very large libraries
+# When a library is opened, calibre reads the metadata of all books into
+# memory before showing the book list. For libraries with hundreds of
+# thousands of books this can take a long time. Setting this to True reads
+# comments, identifiers and all custom columns in the background after the
+# library has been opened, or immediately when they are first needed. Restart
+# calibre after changing this.
+lazy_load_columns = False
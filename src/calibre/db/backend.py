@@ -1248,13 +1248,17 @@ class DB(object):
         ''' Return last modified time as a UTC datetime object '''
         return utcfromtimestamp(os.stat(self.dbpath).st_mtime)
 
-    def read_tables(self):
+    def read_tables(self, lazy=()):
         '''
-        Read all data from the db into the python in-memory tables
+        Read all data from the db into the python in-memory tables. Tables
+        whose names are in ``lazy`` are only read when they are first used.
         '''
 
         with self.conn:  # Use a single transaction, to ensure nothing modifies the db while we are reading
             for table in self.tables.itervalues():
+                if table.name in lazy:
+                    table.read_lazily(self)
+                    continue
                 try:
                     table.read(self)
                 except:
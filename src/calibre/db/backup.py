@@ -11,7 +11,9 @@ import weakref, traceback
 from threading import Thread, Event
 
 from calibre import prints
+from calibre.constants import DEBUG
 from calibre.ebooks.metadata.opf2 import metadata_to_opf
+from calibre.utils.monotonic import monotonic
 
 
 class Abort(Exception):
@@ -23,15 +25,27 @@ class MetadataBackup(Thread):
     Continuously backup changed metadata into OPF files
     in the book directory. This class runs in its own
     thread.
+
+    Dirtied books are processed in batches of at most batch_size books: the
+    OPFs for a batch are rendered, written with a single call to the db and
+    then cleared from the dirtied queue in a single statement. Batches follow
+    each other with only the scheduling_interval between them until the queue
+    is empty.
     '''
 
-    def __init__(self, db, interval=2, scheduling_interval=0.1):
+    def __init__(self, db, interval=2, scheduling_interval=0.1, batch_size=100):
         Thread.__init__(self)
         self.daemon = True
         self._db = weakref.ref(getattr(db, 'new_api', db))
         self.stop_running = Event()
         self.interval = interval
         self.scheduling_interval = scheduling_interval
+        self.batch_size = batch_size
+        self.backed_up = self.failed = 0
+        # Books that failed and are left in the dirtied queue, they are only
+        # retried once the rest of the queue has been processed
+        self.skipped = set()
+        self.books_per_second = 0.0
 
     @property
     def db(self):
@@ -51,69 +65,97 @@ class MetadataBackup(Thread):
         while not self.stop_running.is_set():
             try:
                 self.wait(self.interval)
-                self.do_one()
+                while self.do_batch():
+                    self.wait(self.scheduling_interval)
             except Abort:
                 break
 
-    def do_one(self):
+    @property
+    def metrics(self):
+        ''' The number of books waiting to be backed up, the number of books
+        backed up and failed so far and the throughput of the last batch. '''
+        try:
+            queue_depth = self.db.dirty_queue_length()
+        except Exception:
+            queue_depth = None
+        return {'queue_depth':queue_depth, 'backed_up':self.backed_up,
+                'failed':self.failed, 'books_per_second':self.books_per_second}
+
+    def do_batch(self):
+        ''' Backup one batch of dirtied books. Returns the number of books in
+        the batch, zero if there was nothing to do. '''
         try:
-            book_id = self.db.get_a_dirtied_book()
-            if book_id is None:
-                return
+            book_ids = [book_id for book_id in self.db.get_dirtied_books(
+                self.batch_size + len(self.skipped)) if book_id not in self.skipped][:self.batch_size]
+            if not book_ids:
+                self.skipped.clear()
+                return 0
         except Abort:
             raise
         except:
             # Happens during interpreter shutdown
-            return
+            return 0
+        start = monotonic()
 
-        self.wait(0)
-
-        try:
-            mi, sequence = self.db.get_metadata_for_dump(book_id)
-        except:
-            prints('Failed to get backup metadata for id:', book_id, 'once')
-            traceback.print_exc()
-            self.wait(self.interval)
+        metadata, sequences, done = [], {}, {}
+        for book_id in book_ids:
+            self.wait(0)
             try:
                 mi, sequence = self.db.get_metadata_for_dump(book_id)
+            except Abort:
+                raise
             except:
-                prints('Failed to get backup metadata for id:', book_id, 'again, giving up')
+                prints('Failed to get backup metadata for id:', book_id, 'will retry later')
                 traceback.print_exc()
-                return
-
-        if mi is None:
-            self.db.clear_dirtied(book_id, sequence)
-            return
+                self.failed += 1
+                self.skipped.add(book_id)
+                continue
+            if mi is None:
+                done[book_id] = sequence
+            else:
+                metadata.append((book_id, mi))
+                sequences[book_id] = sequence
 
         # Give the GUI thread a chance to do something. Python threads don't
         # have priorities, so this thread would naturally keep the processor
         # until some scheduling event happens. The wait makes such an event
         self.wait(self.scheduling_interval)
 
-        try:
-            raw = metadata_to_opf(mi)
-        except:
-            prints('Failed to convert to opf for id:', book_id)
-            traceback.print_exc()
-            self.db.clear_dirtied(book_id, sequence)
-            return
-
-        self.wait(self.scheduling_interval)
-
-        try:
-            self.db.write_backup(book_id, raw)
-        except:
-            prints('Failed to write backup metadata for id:', book_id, 'once')
-            traceback.print_exc()
-            self.wait(self.interval)
+        raw_map = {}
+        for book_id, mi in metadata:
             try:
-                self.db.write_backup(book_id, raw)
+                raw_map[book_id] = metadata_to_opf(mi)
             except:
-                prints('Failed to write backup metadata for id:', book_id, 'again, giving up')
+                prints('Failed to convert to opf for id:', book_id)
                 traceback.print_exc()
-                return
+                self.failed += 1
+                done[book_id] = sequences[book_id]
+
+        self.wait(self.scheduling_interval)
 
-        self.db.clear_dirtied(book_id, sequence)
+        if raw_map:
+            failures = self.db.write_backups(raw_map)
+            if failures:
+                self.wait(self.interval)
+                failures = self.db.write_backups({book_id:raw_map[book_id] for book_id in failures})
+            for book_id, tb in failures.iteritems():
+                prints('Failed to write backup metadata for id:', book_id, 'twice, will retry later')
+                prints(tb)
+                self.failed += 1
+                self.skipped.add(book_id)
+                del raw_map[book_id]
+            for book_id in raw_map:
+                done[book_id] = sequences[book_id]
+            self.backed_up += len(raw_map)
+
+        if done:
+            self.db.clear_dirtied_books(done)
+        elapsed = monotonic() - start
+        self.books_per_second = len(book_ids) / max(elapsed, 1e-6)
+        if DEBUG and len(book_ids) > 1:
+            prints('Backed up metadata for %d books at %.1f books per second, %s remaining' % (
+                len(raw_map), self.books_per_second, self.metrics['queue_depth']))
+        return len(book_ids)
 
     def break_cycles(self):
         # Legacy compatibility
@@ -7,10 +7,11 @@ __license__   = 'GPL v3'
 __copyright__ = '2011, Kovid Goyal <kovid@kovidgoyal.net>'
 __docformat__ = 'restructuredtext en'
 
-import os, traceback, random, shutil, operator
+import os, traceback, random, shutil, operator, weakref, heapq
 from io import BytesIO
-from collections import defaultdict, Set, MutableSet
+from collections import defaultdict, Set, MutableSet, OrderedDict
 from functools import wraps, partial
+from threading import Thread
 from future_builtins import zip
 from time import time
 
@@ -92,6 +93,13 @@ def _add_newbook_tag(mi):
                     mi.tags.append(tag)
 
 
+# Fields that are changed as a side effect of changing a field
+RELATED_FIELDS = {'title': {'sort'}, 'authors': {'author_sort'}}
+CATEGORY_DEPENDENCIES = frozenset({'rating', 'languages', 'author_sort'})
+# Tables that are not needed to display the book list, see the
+# lazy_load_columns tweak. All custom columns are also read lazily.
+LAZY_TABLES = frozenset({'comments', 'identifiers'})
+
 dynamic_category_preferences = frozenset({'grouped_search_make_user_categories', 'grouped_search_terms', 'user_categories'})
 
 
@@ -116,8 +124,16 @@ class Cache(object):
         self.formatter_template_cache = {}
         self.dirtied_cache = {}
         self.dirtied_sequence = 0
+        self.deferred_dirtied = None
         self.cover_caches = set()
+        self.lazy_loader = None
+        self.stop_lazy_loading = False
         self.clear_search_cache_count = 0
+        # Incremented whenever items shared by many books, such as tags or
+        # authors, are renamed, removed or have their sort or link changed
+        self.item_changes = 0
+        self.sort_ranks = {}
+        self.current_snapshot = None
 
         # Implement locking for all simple read/write API methods
         # An unlocked version of the method is stored with the name starting
@@ -199,6 +215,24 @@ class Cache(object):
             self.dirtied_sequence = max(self.dirtied_cache.itervalues())+1
         self._initialize_dynamic_categories()
 
+    @read_api
+    def snapshot(self):
+        '''
+        Return a read-only, consistent view of the in-memory metadata as it
+        is now, see :class:`calibre.db.snapshot.Snapshot`. Long running
+        readers, such as catalog generation, can use it without blocking
+        writers. The snapshot shares nothing with this cache, so creating one
+        copies all the in-memory data; snapshots are re-used until the next
+        change to the metadata, as long as someone is still using them.
+        '''
+        version = self.clear_search_cache_count
+        ans = None if self.current_snapshot is None else self.current_snapshot()
+        if ans is None or ans.version != version:
+            from calibre.db.snapshot import Snapshot
+            ans = Snapshot(self, version)
+            self.current_snapshot = weakref.ref(ans)
+        return ans
+
     @write_api
     def initialize_template_cache(self):
         self.formatter_template_cache = {}
@@ -213,9 +247,27 @@ class Cache(object):
             field.clear_caches(book_ids=book_ids)
 
     @write_api
-    def clear_search_caches(self, book_ids=None):
+    def clear_search_caches(self, book_ids=None, fields=None):
         self.clear_search_cache_count += 1
-        self._search_api.update_or_clear(self, book_ids)
+        self._search_api.update_or_clear(self, book_ids, fields)
+        self._invalidate_sort_ranks(fields)
+        self._clear_category_caches(book_ids, fields)
+
+    def _clear_category_caches(self, book_ids=None, fields=None):
+        # The cached category data of an item depends on the books it is
+        # associated with and on their ratings, languages and author sorts
+        for name, field in self.fields.iteritems():
+            if fields is None or name in fields or not CATEGORY_DEPENDENCIES.isdisjoint(fields):
+                field.clear_category_cache(book_ids)
+
+    def _invalidate_sort_ranks(self, fields=None):
+        if fields is None:
+            self.sort_ranks.clear()
+            return
+        fields = frozenset(fields)
+        for key, (depends_on, ranks) in tuple(self.sort_ranks.iteritems()):
+            if not depends_on.isdisjoint(fields):
+                del self.sort_ranks[key]
 
     @read_api
     def last_modified(self):
@@ -245,6 +297,7 @@ class Cache(object):
             self._search_api.saved_searches.load_from_db()
             for field in self.fields.itervalues():
                 if hasattr(field, 'table'):
+                    field.table.ensure_loaded()  # Prevent a pending lazy read from overwriting the reread data
                     field.table.read(self.backend)  # Reread data from metadata.db
 
     @property
@@ -351,7 +404,10 @@ class Cache(object):
         Initialize this cache with data from the backend.
         '''
         with self.write_lock:
-            self.backend.read_tables()
+            lazy = ()
+            if tweaks['lazy_load_columns']:
+                lazy = {name for name in self.backend.tables if name.startswith('#') or name in LAZY_TABLES}
+            self.backend.read_tables(lazy=lazy)
             bools_are_tristate = self.backend.prefs['bools_are_tristate']
 
             for field, table in self.backend.tables.iteritems():
@@ -378,6 +434,26 @@ class Cache(object):
         if self.backend.prefs['update_all_last_mod_dates_on_start']:
             self.update_last_modified(self.all_book_ids())
             self.backend.prefs.set('update_all_last_mod_dates_on_start', False)
+        if lazy:
+            self.lazy_loader = Thread(target=self.load_lazy_tables, name='LazyTableLoader')
+            self.lazy_loader.daemon = True
+            self.lazy_loader.start()
+
+    def load_lazy_tables(self):
+        ''' Read the data for all tables whose reading was deferred when this
+        cache was initialized. Each table is read holding the read lock, so
+        that it is not read while another thread is changing the database,
+        the lock is released between tables so that writers are not blocked
+        for long. Tables that are used before they are read here are read on
+        first use. '''
+        for table in self.backend.tables.values():
+            if self.stop_lazy_loading:
+                break
+            try:
+                with self.read_lock:
+                    table.ensure_loaded()
+            except Exception:
+                traceback.print_exc()
 
     # Cache Layer API {{{
 
@@ -904,6 +980,51 @@ class Cache(object):
 
         return ret
 
+    def _sort_rank_dependencies(self, field, virtual_fields):
+        ''' The set of fields whose values determine the sort order of field,
+        or None if the order cannot be cached, for example for composite,
+        virtual and device fields. '''
+        if field in virtual_fields or field not in self.fields:
+            return None
+        name = {'title':'sort', 'authors':'author_sort'}.get(field, field)
+        if name not in self.fields or field in self.composites or field in {'ondevice', 'marked'}:
+            return None
+        ans = {field, name}
+        if field + '_index' in self.fields:
+            # The sort key of series like fields depends on the language of
+            # the book as well
+            ans |= {field + '_index', 'languages'}
+        return frozenset(ans)
+
+    def _sort_rank_maps(self, fields, ids_to_sort, sort_key_func, virtual_fields):
+        ''' Return a map of book id to integer rank for every field in
+        fields, such that sorting on the ranks is equivalent to sorting on the
+        sort keys. Books with equal sort keys have equal ranks. The rank maps
+        are computed for the whole library once and cached until one of the
+        fields they depend on is changed. Returns None if any of the fields
+        cannot be ranked. '''
+        ans = []
+        all_book_ids = None
+        for field, order in fields:
+            depends_on = self._sort_rank_dependencies(field, virtual_fields)
+            if depends_on is None:
+                return None
+            ranks = self.sort_ranks.get(field, (None, None))[1]
+            if ranks is None or not all(book_id in ranks for book_id in ids_to_sort):
+                if all_book_ids is None:
+                    all_book_ids = self._all_book_ids()
+                book_ids = set(all_book_ids)
+                book_ids.update(ids_to_sort)
+                key = sort_key_func(field)
+                ranks, rank, prev = {}, -1, None
+                for i, (sk, book_id) in enumerate(sorted((key(book_id), book_id) for book_id in book_ids)):
+                    if i == 0 or cmp(sk, prev) != 0:
+                        rank, prev = rank + 1, sk
+                    ranks[book_id] = rank
+                self.sort_ranks[field] = (depends_on, ranks)
+            ans.append(ranks)
+        return ans
+
     @read_api
     def multisort(self, fields, ids_to_sort=None, virtual_fields=None):
         '''
@@ -943,6 +1064,19 @@ class Cache(object):
         # Sort only once on any given field
         fields = uniq(fields, operator.itemgetter(0))
 
+        if not isinstance(ids_to_sort, (list, tuple, Set)):
+            ids_to_sort = tuple(ids_to_sort)
+        rank_maps = self._sort_rank_maps(fields, ids_to_sort, sort_key_func, virtual_fields)
+        if rank_maps is not None:
+            if len(fields) == 1:
+                return sorted(ids_to_sort, key=rank_maps[0].__getitem__, reverse=not fields[0][1])
+            # Sort on tuples of integer ranks, negating the ranks of
+            # descending fields, which avoids comparing the (expensive) sort
+            # keys at all
+            rank_maps = tuple((ranks, order) for ranks, (field, order) in zip(rank_maps, fields))
+            return sorted(ids_to_sort, key=lambda book_id: tuple(
+                ranks[book_id] if order else -ranks[book_id] for ranks, order in rank_maps))
+
         if len(fields) == 1:
             return sorted(ids_to_sort, key=sort_key_func(fields[0][0]),
                           reverse=not fields[0][1])
@@ -987,6 +1121,17 @@ class Cache(object):
         '''
         return self._search_api(self, query, restriction, virtual_fields=virtual_fields, book_ids=book_ids)
 
+    @read_api
+    def explain_search(self, query, restriction='', virtual_fields=None):
+        '''
+        Search the database for the specified query, like :meth:`search`,
+        but bypassing the cache of search results. Returns the set of matched
+        book ids and the plan used to evaluate the query. The plan is a list
+        of dicts with the estimated cost and selectivity, the number of
+        candidates and matches and the time taken for every node of the query.
+        '''
+        return self._search_api.explain(self, query, restriction, virtual_fields=virtual_fields)
+
     @read_api
     def books_in_virtual_library(self, vl, search_restriction=None):
         ' Return the set of books in the specified virtual library '
@@ -1017,7 +1162,9 @@ class Cache(object):
             return self.get_categories(sort=sort, book_ids=book_ids, already_fixed=bad_field)
 
     @write_api
-    def update_last_modified(self, book_ids, now=None):
+    def update_last_modified(self, book_ids, now=None, fields=None):
+        ''' Update the last modified date of the specified books. ``fields``
+        is the set of fields that were changed, None means any field. '''
         if book_ids:
             if now is None:
                 now = nowf()
@@ -1025,11 +1172,17 @@ class Cache(object):
             f.writer.set_books({book_id:now for book_id in book_ids}, self.backend)
             if self.composites:
                 self._clear_composite_caches(book_ids)
-            self._clear_search_caches(book_ids)
+            self._clear_search_caches(book_ids, None if fields is None else frozenset(fields) | {'last_modified'})
 
     @write_api
-    def mark_as_dirty(self, book_ids):
-        self._update_last_modified(book_ids)
+    def mark_as_dirty(self, book_ids, fields=None):
+        if self.deferred_dirtied is not None:
+            # Inside a bulk update, everything is marked dirty once at the end
+            dbook_ids, dfields = self.deferred_dirtied
+            dbook_ids.update(book_ids)
+            self.deferred_dirtied = (dbook_ids, None if fields is None or dfields is None else dfields | set(fields))
+            return
+        self._update_last_modified(book_ids, fields=fields)
         already_dirtied = set(self.dirtied_cache).intersection(book_ids)
         new_dirtied = book_ids - already_dirtied
         already_dirtied = {book_id:self.dirtied_sequence+i for i, book_id in enumerate(already_dirtied)}
@@ -1084,6 +1237,9 @@ class Cache(object):
                     simap[k] = sid
             book_id_to_val_map = bimap
 
+        # Forget the category data of the items the books are about to lose,
+        # the items they gain are handled by _mark_as_dirty()
+        f.clear_category_cache(book_id_to_val_map)
         dirtied = f.writer.set_books(
             book_id_to_val_map, self.backend, allow_case_change=allow_case_change)
 
@@ -1094,7 +1250,10 @@ class Cache(object):
         if dirtied and update_path and do_path_update:
             self._update_path(dirtied, mark_as_dirtied=False)
 
-        self._mark_as_dirty(dirtied)
+        changed_fields = {name} | RELATED_FIELDS.get(name, set())
+        if is_series:
+            changed_fields.add(name + '_index')
+        self._mark_as_dirty(dirtied, fields=changed_fields)
 
         return dirtied
 
@@ -1107,8 +1266,8 @@ class Cache(object):
             except IndexError:
                 author = _('Unknown')
             self.backend.update_path(book_id, title, author, self.fields['path'], self.fields['formats'])
-            if mark_as_dirtied:
-                self._mark_as_dirty(book_ids)
+        if mark_as_dirtied:
+            self._mark_as_dirty(book_ids)
 
     @read_api
     def get_a_dirtied_book(self):
@@ -1116,6 +1275,15 @@ class Cache(object):
             return random.choice(tuple(self.dirtied_cache.iterkeys()))
         return None
 
+    @read_api
+    def get_dirtied_books(self, limit=None):
+        ''' Return a list of at most limit dirtied book ids, the books that
+        were dirtied first are first. '''
+        items = self.dirtied_cache.iteritems()
+        key = operator.itemgetter(1)
+        items = sorted(items, key=key) if limit is None else heapq.nsmallest(limit, items, key=key)
+        return [book_id for book_id, sequence in items]
+
     @read_api
     def get_metadata_for_dump(self, book_id):
         mi = None
@@ -1150,6 +1318,38 @@ class Cache(object):
                     (book_id,))
             self.dirtied_cache.pop(book_id, None)
 
+    @write_api
+    def clear_dirtied_books(self, book_id_sequence_map):
+        ''' Same as calling clear_dirtied() for every (book_id, sequence) pair
+        in the map, but uses a single SQL statement. '''
+        book_ids = []
+        for book_id, sequence in book_id_sequence_map.iteritems():
+            dc_sequence = self.dirtied_cache.get(book_id, None)
+            if dc_sequence is None or sequence is None or dc_sequence == sequence:
+                book_ids.append(book_id)
+        if book_ids:
+            self.backend.executemany('DELETE FROM metadata_dirtied WHERE book=?',
+                    ((book_id,) for book_id in book_ids))
+            for book_id in book_ids:
+                self.dirtied_cache.pop(book_id, None)
+
+    @write_api
+    def write_backups(self, book_id_raw_map):
+        ''' Same as calling write_backup() for every book in the map, but
+        acquires the lock only once. Returns a map of the ids of the books
+        whose backups could not be written to the error tracebacks. '''
+        failures = {}
+        for book_id, raw in book_id_raw_map.iteritems():
+            try:
+                path = self._field_for('path', book_id).replace('/', os.sep)
+            except:
+                continue
+            try:
+                self.backend.write_backup(path, raw)
+            except Exception:
+                failures[book_id] = traceback.format_exc()
+        return failures
+
     @write_api
     def write_backup(self, book_id, raw):
         try:
@@ -1356,6 +1556,146 @@ class Cache(object):
             raise
         return dirtied
 
+    @write_api
+    def set_metadata_for_books(self, book_id_to_mi_map, ignore_errors=False, force_changes=False,
+                               set_title=True, set_authors=True, allow_case_change=False):
+        '''
+        Set metadata for many books at once, from a map of book ids to
+        `Metadata` objects. The result is the same as calling
+        :meth:`set_metadata` for every book, but the changes are written one
+        field at a time for all the books, in a single transaction, paths are
+        updated in a single pass and the books are marked dirty only once.
+        Returns the set of all book ids that were affected.
+
+        When ignore_errors is True, a field that fails to be set for all the
+        books is retried one book at a time, so that only the values that
+        actually cause errors are skipped.
+        '''
+        dirtied = set()
+        mi_map = {}
+        for book_id, mi in book_id_to_mi_map.iteritems():
+            try:
+                # Handle code passing in an OPF object instead of a Metadata object
+                mi = mi.to_book_metadata()
+            except (AttributeError, TypeError):
+                pass
+            mi_map[book_id] = mi
+        field_maps = OrderedDict()
+
+        def set_field(name, book_id, val):
+            field_maps.setdefault(name, {})[book_id] = val
+
+        def flush(protected=True):
+            for name, book_id_val_map in field_maps.iteritems():
+                try:
+                    dirtied.update(self._set_field(name, book_id_val_map, do_path_update=False, allow_case_change=allow_case_change))
+                except:
+                    if not protected:
+                        raise
+                    if not ignore_errors:
+                        raise
+                    for book_id, val in book_id_val_map.iteritems():
+                        try:
+                            dirtied.update(self._set_field(name, {book_id:val}, do_path_update=False, allow_case_change=allow_case_change))
+                        except:
+                            traceback.print_exc()
+            field_maps.clear()
+
+        self.deferred_dirtied = (set(), set())
+        try:
+            path_changed = set()
+            for book_id, mi in mi_map.iteritems():
+                if set_title and mi.title:
+                    path_changed.add(book_id)
+                    set_field('title', book_id, mi.title)
+                if set_authors:
+                    path_changed.add(book_id)
+                    if not mi.authors:
+                        mi.authors = [_('Unknown')]
+                    authors = []
+                    for a in mi.authors:
+                        authors += string_to_authors(a)
+                    set_field('authors', book_id, authors)
+            flush(protected=False)
+            if path_changed:
+                # The books were marked dirty by _set_field(), along with the
+                # fields that changed
+                self._update_path(path_changed, mark_as_dirtied=False)
+
+            for book_id, mi in mi_map.iteritems():
+                # force_changes has no effect on cover manipulation
+                try:
+                    cdata = mi.cover_data[1]
+                    if cdata is None and isinstance(mi.cover, basestring) and mi.cover and os.access(mi.cover, os.R_OK):
+                        with lopen(mi.cover, 'rb') as f:
+                            cdata = f.read() or None
+                    if cdata is not None:
+                        self._set_cover({book_id: cdata})
+                except:
+                    if ignore_errors:
+                        traceback.print_exc()
+                    else:
+                        raise
+
+            fm = self.field_metadata
+            for book_id, mi in mi_map.iteritems():
+                for field in ('rating', 'series_index', 'timestamp'):
+                    val = getattr(mi, field)
+                    if val is not None:
+                        set_field(field, book_id, val)
+
+                for field in ('author_sort', 'publisher', 'series', 'tags', 'comments',
+                    'languages', 'pubdate'):
+                    val = mi.get(field, None)
+                    if (force_changes and val is not None) or not mi.is_null(field):
+                        set_field(field, book_id, val)
+
+                val = mi.get('title_sort', None)
+                if (force_changes and val is not None) or not mi.is_null('title_sort'):
+                    set_field('sort', book_id, val)
+
+                # identifiers will always be replaced if force_changes is True
+                mi_idents = mi.get_identifiers()
+                if force_changes:
+                    set_field('identifiers', book_id, mi_idents)
+                elif mi_idents:
+                    identifiers = self._field_for('identifiers', book_id, default_value={})
+                    for key, val in mi_idents.iteritems():
+                        if val and val.strip():  # Don't delete an existing identifier
+                            identifiers[icu_lower(key)] = val
+                    set_field('identifiers', book_id, identifiers)
+
+                user_mi = mi.get_all_user_metadata(make_copy=False)
+                for key in user_mi.iterkeys():
+                    if (key in fm and
+                            user_mi[key]['datatype'] == fm[key]['datatype'] and
+                            (user_mi[key]['datatype'] != 'text' or
+                            user_mi[key]['is_multiple'] == fm[key]['is_multiple'])):
+                        val = mi.get(key, None)
+                        if force_changes or val is not None:
+                            set_field(key, book_id, val)
+                            idx = key + '_index'
+                            if idx in self.fields:
+                                extra = mi.get_extra(key)
+                                if extra is not None or force_changes:
+                                    set_field(idx, book_id, extra)
+
+            try:
+                with self.backend.conn:  # Write all the fields in a single transaction
+                    flush()
+            except:
+                # sqlite will rollback the entire transaction, thanks to the with
+                # statement, so we have to re-read everything form the db to ensure
+                # the db and Cache are in sync
+                self._reload_from_db()
+                raise
+        finally:
+            book_ids, fields = self.deferred_dirtied
+            self.deferred_dirtied = None
+            if book_ids:
+                self._mark_as_dirty(book_ids, fields=fields)
+        return dirtied
+
     def _do_add_format(self, book_id, fmt, stream, name=None, mtime=None):
         path = self._field_for('path', book_id)
         if path is None:
@@ -1409,7 +1749,7 @@ class Cache(object):
 
             max_size = self.fields['formats'].table.update_fmt(book_id, fmt, fname, size, self.backend)
             self.fields['size'].table.update_sizes({book_id: max_size})
-            self._update_last_modified((book_id,))
+            self._update_last_modified((book_id,), fields=('formats', 'size'))
 
         if run_hooks:
             # Run post import plugins, the write lock is released so the plugin
@@ -1453,7 +1793,7 @@ class Cache(object):
 
         size_map = table.remove_formats(formats_map, self.backend)
         self.fields['size'].table.update_sizes(size_map)
-        self._update_last_modified(tuple(formats_map.iterkeys()))
+        self._update_last_modified(tuple(formats_map.iterkeys()), fields=('formats', 'size'))
 
     @read_api
     def get_next_series_num_for(self, series, field='series', current_indices=False):
@@ -1571,9 +1911,23 @@ class Cache(object):
             elif field == 'uuid':
                 self.fields[field].table.uuid_to_id_map[val] = book_id
             self.fields[field].table.book_col_map[book_id] = val
+        # The new book can match searches on fields that were not set above
+        self._clear_search_caches((book_id,))
 
         return book_id
 
+    @read_api
+    def search_results_version(self, query):
+        ''' Return a number that changes whenever the results of the specified
+        search may have changed. Useful for caching search results. '''
+        return self._search_api.results_version(self, query)
+
+    @read_api
+    def sort_results_version(self, fields):
+        ''' Return a number that changes whenever the order of books sorted on
+        the specified fields may have changed. Useful for caching sorted results. '''
+        return self._search_api.sort_version(self.field_metadata, fields)
+
     @api
     def add_books(self, books, add_duplicates=True, apply_import_tags=True, preserve_uuid=False, run_hooks=True, dbapi=None):
         '''
@@ -1617,6 +1971,7 @@ class Cache(object):
             self.backend.windows_check_if_files_in_use(paths)
 
         self.backend.remove_books(path_map, permanent=permanent)
+        self._clear_category_caches(book_ids)
         for field in self.fields.itervalues():
             try:
                 table = field.table
@@ -1625,6 +1980,11 @@ class Cache(object):
             else:
                 table.remove_books(book_ids, self.backend)
         self._search_api.discard_books(book_ids)
+        self.clear_search_cache_count += 1
+        for depends_on, ranks in self.sort_ranks.itervalues():
+            # Book ids can be re-used, so forget the ranks of deleted books
+            for book_id in book_ids:
+                ranks.pop(book_id, None)
         self._clear_caches(book_ids=book_ids, template_cache=False, search_cache=False)
         for cc in self.cover_caches:
             cc.invalidate(book_ids)
@@ -1647,7 +2007,9 @@ class Cache(object):
         :param restrict_to_book_ids: An optional set of book ids for which the rename is to be performed, defaults to all books.
         '''
 
+        self.item_changes += 1
         f = self.fields[field]
+        f.clear_category_cache(item_ids=item_id_to_new_name_map)
         affected_books = set()
         try:
             sv = f.metadata['is_multiple']['ui_to_list']
@@ -1735,7 +2097,7 @@ class Cache(object):
             elif change_index and hasattr(f, 'index_field') and tweaks['series_index_auto_increment'] != 'no_change':
                 for book_id in moved_books:
                     self._set_field(f.index_field.name, {book_id:self._get_next_series_num_for(self._fast_field_for(f, book_id), field=field)})
-            self._mark_as_dirty(affected_books)
+            self._mark_as_dirty(affected_books, fields={field} | RELATED_FIELDS.get(field, set()))
         return affected_books, id_map
 
     @write_api
@@ -1744,16 +2106,17 @@ class Cache(object):
         Returns the set of affected book ids. ``restrict_to_book_ids`` is an
         optional set of books ids. If specified the items will only be removed
         from those books. '''
+        self.item_changes += 1
         field = self.fields[field]
         if restrict_to_book_ids is not None and not isinstance(restrict_to_book_ids, (MutableSet, Set)):
             restrict_to_book_ids = frozenset(restrict_to_book_ids)
+        field.clear_category_cache(item_ids=item_ids)
         affected_books = field.table.remove_items(item_ids, self.backend,
                                                   restrict_to_book_ids=restrict_to_book_ids)
         if affected_books:
             if hasattr(field, 'index_field'):
                 self._set_field(field.index_field.name, {bid:1.0 for bid in affected_books})
-            else:
-                self._mark_as_dirty(affected_books)
+            self._mark_as_dirty(affected_books, fields={field.name})
         return affected_books
 
     @write_api
@@ -1806,6 +2169,7 @@ class Cache(object):
     def refresh_format_cache(self):
         self.fields['formats'].table.read(self.backend)
         self.format_metadata_cache.clear()
+        self._clear_search_caches(fields=('formats',))
 
     @write_api
     def refresh_ondevice(self):
@@ -1863,6 +2227,7 @@ class Cache(object):
 
     @write_api
     def set_sort_for_authors(self, author_id_to_sort_map, update_books=True):
+        self.item_changes += 1
         sort_map = self.fields['authors'].table.set_sort_names(author_id_to_sort_map, self.backend)
         changed_books = set()
         if update_books:
@@ -1878,17 +2243,18 @@ class Cache(object):
             if val_map:
                 self._set_field('author_sort', val_map)
         if changed_books:
-            self._mark_as_dirty(changed_books)
+            self._mark_as_dirty(changed_books, fields={'author_sort'})
         return changed_books
 
     @write_api
     def set_link_for_authors(self, author_id_to_link_map):
+        self.item_changes += 1
         link_map = self.fields['authors'].table.set_links(author_id_to_link_map, self.backend)
         changed_books = set()
         for author_id in link_map:
             changed_books |= self._books_for_field('authors', author_id)
         if changed_books:
-            self._mark_as_dirty(changed_books)
+            self._mark_as_dirty(changed_books, fields=())
         return changed_books
 
     @read_api
@@ -2043,16 +2409,22 @@ class Cache(object):
     def vacuum(self):
         self.backend.vacuum()
 
-    @write_api
     def close(self):
-        from calibre.customize.ui import available_library_closed_plugins
-        for plugin in available_library_closed_plugins():
-            try:
-                plugin.run(self)
-            except Exception:
-                import traceback
-                traceback.print_exc()
-        self.backend.close()
+        # The lazy loader needs the read lock, so it must be stopped before
+        # the write lock is acquired
+        if self.lazy_loader is not None:
+            self.stop_lazy_loading = True
+            self.lazy_loader.join()
+            self.lazy_loader = None
+        with self.write_lock:
+            from calibre.customize.ui import available_library_closed_plugins
+            for plugin in available_library_closed_plugins():
+                try:
+                    plugin.run(self)
+                except Exception:
+                    import traceback
+                    traceback.print_exc()
+            self.backend.close()
 
     @write_api
     def restore_book(self, book_id, mi, last_modified, path, formats):
@@ -7,10 +7,12 @@ from __future__ import absolute_import, division, print_function, unicode_litera
 from calibre import prints
 
 readonly = True
-version = 0  # change this if you change signature of implementation()
+version = 1  # change this if you change signature of implementation()
 
 
-def implementation(db, notify_changes, query):
+def implementation(db, notify_changes, query, explain=False):
+    if explain:
+        return db.explain_search(query)
     return db.search(query)
 
 
@@ -36,14 +38,35 @@ language, for example: {0}
         type=int,
         help=_('The maximum number of results to return. Default is all results.')
     )
+    parser.add_option(
+        '--explain',
+        default=False,
+        action='store_true',
+        help=_('Show the order in which the terms of the search expression were evaluated,'
+               ' with the estimated cost and the actual number of matches and time taken for each term.')
+    )
     return parser
 
 
+def print_plan(plan, indent=0):
+    for entry in plan:
+        prints(
+            ' ' * indent + entry['node'],
+            _('cost: {0:.0f} selectivity: {1:.2f} candidates: {2} matches: {3} time: {4:.2f}ms').format(
+                entry['cost'], entry['selectivity'], entry['candidates'], entry['matches'], entry['time'] * 1000),
+            sep='\n' + ' ' * (indent + 2))
+        print_plan(entry['children'], indent + 4)
+
+
 def main(opts, args, dbctx):
     if len(args) < 1:
         raise SystemExit(_('Error: You must specify the search expression'))
     q = ' '.join(args)
-    ids = dbctx.run('search', q)
+    if opts.explain:
+        ids, plan = dbctx.run('search', q, True)
+        print_plan(plan)
+    else:
+        ids = dbctx.run('search', q)
     if not ids:
         raise SystemExit(_('No books matching the search expression:') + ' ' + q)
     ids = sorted(ids)
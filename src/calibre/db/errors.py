@@ -11,3 +11,7 @@ __docformat__ = 'restructuredtext en'
 class NoSuchFormat(ValueError):
     pass
 
+
+class ReadOnlySnapshot(RuntimeError):
+    pass
+
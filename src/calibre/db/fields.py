@@ -8,6 +8,7 @@ __license__   = 'GPL v3'
 __copyright__ = '2011, Kovid Goyal <kovid@kovidgoyal.net>'
 __docformat__ = 'restructuredtext en'
 
+from copy import copy
 from threading import Lock
 from collections import defaultdict, Counter
 from functools import partial
@@ -89,11 +90,24 @@ class Field(object):
         self.writer = Writer(self)
         self.series_field = None
         self.get_template_functions = get_template_functions
+        # Map of item id to (name, sort value, average rating) for the Tag
+        # Browser, computed over the whole library
+        self.category_cache = {}
 
     @property
     def metadata(self):
         return self.table.metadata
 
+    def snapshot(self, table):
+        '''
+        Return a copy of this field that uses table (a snapshot of this field's
+        table) and shares no caches with this field.
+        '''
+        ans = copy(self)
+        ans.table = table
+        ans.category_cache = {}
+        return ans
+
     def for_book(self, book_id, default_value=None):
         '''
         Return the value of this field for the book identified by book_id.
@@ -149,27 +163,58 @@ class Field(object):
 
         id_map = self.table.id_map
         special_sort = hasattr(self, 'category_sort_value')
-        for item_id, item_book_ids in self.table.col_book_map.iteritems():
+        # The per item data for the whole library is cached, see clear_category_cache()
+        cache = self.category_cache if book_ids is None else {}
+        col_book_map = self.table.col_book_map
+        for item_id, item_book_ids in col_book_map.iteritems():
             if book_ids is not None:
                 item_book_ids = item_book_ids.intersection(book_ids)
             if item_book_ids:
-                ratings = tuple(r for r in (book_rating_map.get(book_id, 0) for
-                                            book_id in item_book_ids) if r > 0)
-                avg = sum(ratings)/len(ratings) if ratings else 0
                 try:
-                    name = self.category_formatter(id_map[item_id])
+                    name, sval, avg = cache[item_id]
                 except KeyError:
-                    # db has entries in the link table without entries in the
-                    # id table, for example, see
-                    # https://bugs.launchpad.net/bugs/1218783
-                    raise InvalidLinkTable(self.name)
-                sval = (self.category_sort_value(item_id, item_book_ids, lang_map)
-                    if special_sort else name)
+                    ratings = tuple(r for r in (book_rating_map.get(book_id, 0) for
+                                                book_id in item_book_ids) if r > 0)
+                    avg = sum(ratings)/len(ratings) if ratings else 0
+                    try:
+                        name = self.category_formatter(id_map[item_id])
+                    except KeyError:
+                        # db has entries in the link table without entries in the
+                        # id table, for example, see
+                        # https://bugs.launchpad.net/bugs/1218783
+                        raise InvalidLinkTable(self.name)
+                    sval = (self.category_sort_value(item_id, item_book_ids, lang_map)
+                        if special_sort else name)
+                    cache[item_id] = (name, sval, avg)
                 c = tag_class(name, id=item_id, sort=sval, avg=avg,
                               id_set=item_book_ids, count=len(item_book_ids))
                 ans.append(c)
+        if len(cache) > len(col_book_map):
+            # Forget items that have been deleted. Only the shared read lock
+            # is held, so other threads may be pruning the cache as well.
+            for item_id in tuple(cache):
+                if item_id not in col_book_map:
+                    cache.pop(item_id, None)
         return ans
 
+    def clear_category_cache(self, book_ids=None, item_ids=None):
+        ''' Forget the cached category data for the specified items and for
+        all items associated with the specified books. Must be called both
+        before and after the items associated with a book are changed. If
+        neither book_ids nor item_ids is specified, everything is forgotten. '''
+        cache = self.category_cache
+        if not cache:
+            return
+        if book_ids is None and item_ids is None:
+            cache.clear()
+            return
+        for item_id in item_ids or ():
+            cache.pop(item_id, None)
+        if self.is_many:
+            for book_id in book_ids or ():
+                for item_id in self.ids_for_book(book_id):
+                    cache.pop(item_id, None)
+
 
 class OneToOneField(Field):
 
@@ -282,6 +327,11 @@ class CompositeField(OneToOneField):
             return self.__render_composite(book_id, mi, formatter, template_cache)
         return ans
 
+    def snapshot(self, table):
+        ans = OneToOneField.snapshot(self, table)
+        ans._render_cache, ans._lock = {}, Lock()
+        return ans
+
     def clear_caches(self, book_ids=None):
         with self._lock:
             if book_ids is None:
@@ -354,6 +404,7 @@ class OnDeviceField(OneToOneField):
         self.book_on_device_func = None
         self.is_multiple = False
         self.cache = {}
+        self.category_cache = {}
         self._lock = Lock()
         self._metadata = {
             'table':None, 'column':None, 'datatype':'text', 'is_multiple':{},
@@ -364,6 +415,11 @@ class OnDeviceField(OneToOneField):
     def metadata(self):
         return self._metadata
 
+    def snapshot(self, table):
+        ans = copy(self)
+        ans.cache, ans.category_cache, ans._lock = {}, {}, Lock()
+        return ans
+
     def clear_caches(self, book_ids=None):
         with self._lock:
             if book_ids is None:
@@ -531,8 +587,14 @@ class ManyToManyField(Field):
     def iter_counts(self, candidates):
         val_map = defaultdict(set)
         cbm = self.table.book_col_map
-        for book_id in candidates:
-            val_map[len(cbm.get(book_id, ()))].add(book_id)
+        length = getattr(cbm, 'length', None)
+        if length is None:
+            for book_id in candidates:
+                val_map[len(cbm.get(book_id, ()))].add(book_id)
+        else:
+            # Compact tables store the counts directly, no need to create tuples
+            for book_id in candidates:
+                val_map[length(book_id, 0)].add(book_id)
         for count, book_ids in val_map.iteritems():
             yield count, book_ids
 
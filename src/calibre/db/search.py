@@ -7,10 +7,12 @@ __license__   = 'GPL v3'
 __copyright__ = '2013, Kovid Goyal <kovid at kovidgoyal.net>'
 __docformat__ = 'restructuredtext en'
 
-import re, weakref, operator
+import re, weakref, operator, sys
+from bisect import bisect_left
 from functools import partial
 from datetime import timedelta
-from collections import deque, OrderedDict
+from collections import OrderedDict, defaultdict
+from threading import Lock
 
 from calibre.constants import preferred_encoding
 from calibre.db.utils import force_to_bool
@@ -444,12 +446,196 @@ class SavedSearchQueries(object):  # {{{
 # }}}
 
 
+class NotIndexable(ValueError):
+    pass
+
+
+# Printable ASCII. For values and queries made up only of these characters,
+# matching at primary collation strength is equivalent to matching the lower
+# cased strings, which means the n-gram index can be used to find candidates.
+simple_text = re.compile(r'^[\x20-\x7e]*$').match
+NGRAM = 3
+
+
+def ngrams(text):
+    return {text[i:i+NGRAM] for i in xrange(len(text) - NGRAM + 1)}
+
+
+class FieldIndex(object):  # {{{
+
+    '''
+    An inverted index for a single text field. It maps the lower cased
+    searchable values of the field to the books that have them and n-grams of
+    the values to the values containing them. This allows equals, hierarchical
+    and contains searches to look at only the values that can possibly match,
+    instead of every value of every book. All candidate values are still
+    checked with :func:`_match` so the results are identical to a full scan.
+    '''
+
+    def __init__(self, field, get_metadata, all_book_ids):
+        self.field, self.get_metadata = field, get_metadata
+        self.book_map = {}
+        self.value_map = {}
+        self.gram_map = defaultdict(set)
+        self.unsafe_values = set()
+        self.sorted_values = None
+        self.add_books(field.iter_searchable_values(get_metadata, all_book_ids))
+
+    def add_books(self, val_iter):
+        book_map, value_map = defaultdict(list), self.value_map
+        for val, book_ids in val_iter:
+            if val is None:
+                continue
+            if not isinstance(val, basestring):
+                raise NotIndexable(self.field.name)
+            val = icu_lower(val)
+            for book_id in book_ids:
+                book_map[book_id].append(val)
+            try:
+                value_map[val] |= book_ids
+            except KeyError:
+                value_map[val] = set(book_ids)
+                if simple_text(val) is None:
+                    self.unsafe_values.add(val)
+                else:
+                    for gram in ngrams(val):
+                        self.gram_map[gram].add(val)
+        for book_id, vals in book_map.iteritems():
+            self.book_map[book_id] = self.book_map.get(book_id, ()) + tuple(vals)
+        self.sorted_values = None
+
+    def remove_books(self, book_ids):
+        value_map = self.value_map
+        for book_id in book_ids:
+            for val in self.book_map.pop(book_id, ()):
+                books = value_map.get(val)
+                if books is None:
+                    continue
+                books.discard(book_id)
+                if not books:
+                    del value_map[val]
+                    self.unsafe_values.discard(val)
+                    for gram in ngrams(val):
+                        vals = self.gram_map.get(gram)
+                        if vals is not None:
+                            vals.discard(val)
+                            if not vals:
+                                del self.gram_map[gram]
+        self.sorted_values = None
+
+    def update(self, book_ids):
+        book_ids = frozenset(book_ids)
+        self.remove_books(book_ids)
+        self.add_books(self.field.iter_searchable_values(self.get_metadata, book_ids))
+
+    def values_with_prefix(self, prefix):
+        if self.sorted_values is None:
+            self.sorted_values = sorted(self.value_map)
+        vals = self.sorted_values
+        for i in xrange(bisect_left(vals, prefix), len(vals)):
+            val = vals[i]
+            if not val.startswith(prefix):
+                break
+            yield val
+
+    def values_containing(self, query):
+        if len(query) < NGRAM or simple_text(query) is None:
+            return self.value_map
+        ans = None
+        for gram in ngrams(query):
+            vals = self.gram_map.get(gram)
+            if not vals:
+                ans = set()
+                break
+            ans = set(vals) if ans is None else ans.intersection(vals)
+        return ans.union(self.unsafe_values)
+
+    def matches(self, query, matchkind, use_primary_find_in_search, candidates):
+        vals = None
+        if matchkind == EQUALS_MATCH and not query.startswith('..'):
+            if query.startswith('.'):
+                q = query[1:]
+                vals = (v for v in self.values_with_prefix(q) if len(v) == len(q) or v[len(q)] == '.')
+            else:
+                vals = (query,) if query in self.value_map else ()
+        elif matchkind == CONTAINS_MATCH:
+            vals = self.values_containing(query)
+        if vals is None:
+            vals = self.value_map
+        else:
+            vals = tuple(vals)
+        ans = set()
+        value_map = self.value_map
+        for val in vals:
+            if _match(query, (val,), matchkind, use_primary_find_in_search=use_primary_find_in_search):
+                ans |= value_map[val]
+        ans &= candidates
+        return ans
+# }}}
+
+
+class TextIndex(object):  # {{{
+
+    '''
+    The per field inverted indices used for searching text fields. The index
+    for a field is built the first time that field is searched and is kept up
+    to date with changes to the database via :meth:`update`. Fields whose
+    values are computed (composite columns) or are very long (comments) are
+    not indexed.
+    '''
+
+    def __init__(self):
+        self.lock = Lock()
+        self.indices = {}
+
+    def is_indexable(self, field):
+        return not field.is_composite and field.metadata['datatype'] in {'text', 'series', 'enumeration'}
+
+    def field_index(self, dbcache, name):
+        try:
+            return self.indices[name]
+        except KeyError:
+            pass
+        with self.lock:
+            if name not in self.indices:
+                field = dbcache.fields.get(name)
+                ans = None
+                if field is not None and hasattr(field, 'table') and self.is_indexable(field):
+                    try:
+                        ans = FieldIndex(field, dbcache._get_proxy_metadata, dbcache._all_book_ids())
+                    except NotIndexable:
+                        pass
+                self.indices[name] = ans
+            return self.indices[name]
+
+    def update(self, book_ids, fields=None):
+        with self.lock:
+            for name, index in tuple(self.indices.iteritems()):
+                if index is not None and (fields is None or name in fields):
+                    try:
+                        index.update(book_ids)
+                    except NotIndexable:
+                        self.indices[name] = None
+
+    def discard_books(self, book_ids):
+        with self.lock:
+            for index in self.indices.itervalues():
+                if index is not None:
+                    index.remove_books(book_ids)
+
+    def clear(self):
+        with self.lock:
+            self.indices.clear()
+# }}}
+
+
 class Parser(SearchQueryParser):  # {{{
 
     def __init__(self, dbcache, all_book_ids, gst, date_search, num_search,
                  bool_search, keypair_search, limit_search_columns, limit_search_columns_to,
-                 locations, virtual_fields, lookup_saved_search, parse_cache):
+                 locations, virtual_fields, lookup_saved_search, parse_cache, text_index=None):
         self.dbcache, self.all_book_ids = dbcache, all_book_ids
+        self.text_index = text_index
         self.all_search_locations = frozenset(locations)
         self.grouped_search_terms = gst
         self.date_search, self.num_search = date_search, num_search
@@ -468,6 +654,40 @@ class Parser(SearchQueryParser):  # {{{
     def universal_set(self):
         return self.all_book_ids
 
+    def estimate_token(self, location, query):
+        ''' Estimate the cost of a search term as the number of values that
+        have to be matched and its selectivity from the cardinality of the
+        field and the statistics of the text index, when available. '''
+        num_books = float(max(len(self.all_book_ids), 1))
+        location = icu_lower(location.strip())
+        if location == 'search' or location.startswith('@'):
+            return 2 * num_books, 0.5
+        location = self.field_metadata.search_term_to_field_key(location)
+        if isinstance(location, list):
+            return sum(self.estimate_token(loc, query)[0] for loc in location), 0.5
+        if location == 'all':
+            return 20 * num_books, 0.5
+        field = self.dbcache.fields.get(location)
+        if field is None:
+            return num_books, 0.5
+        matchkind, q = _matchkind(query, case_sensitive=prefs['case_sensitive'])
+        cost = 5 if matchkind == REGEXP_MATCH else 1
+        if field.is_composite:
+            # Composite columns have to render their templates for every book
+            return 10 * cost * num_books, 0.5
+        num_values = float(max(len(field.table.col_book_map), 1)) if field.is_many else num_books
+        index = None if self.text_index is None else self.text_index.indices.get(location)
+        if index is not None and not prefs['case_sensitive']:
+            books_per_value = len(index.book_map) / max(len(index.value_map), 1)
+            if matchkind == EQUALS_MATCH and not q.startswith('.'):
+                return 1.0, len(index.value_map.get(q, ())) / num_books
+            if matchkind == CONTAINS_MATCH and q not in {'true', 'false'}:
+                n = len(index.values_containing(q))
+                return float(n), min(1.0, n * books_per_value / num_books)
+        if matchkind == EQUALS_MATCH and field.is_many:
+            return cost * num_values, 1 / num_values
+        return cost * num_values, 0.5
+
     def field_iter(self, name, candidates):
         get_metadata = self.dbcache._get_proxy_metadata
         try:
@@ -690,6 +910,12 @@ class Parser(SearchQueryParser):  # {{{
                 continue
 
             if location in text_fields:
+                index = None
+                if self.text_index is not None and not case_sensitive:
+                    index = self.text_index.field_index(self.dbcache, location)
+                if index is not None:
+                    matches |= index.matches(q, matchkind, upf, current_candidates)
+                    continue
                 for val, book_ids in self.field_iter(location, current_candidates):
                     if val is not None:
                         if isinstance(val, basestring):
@@ -734,30 +960,50 @@ class Parser(SearchQueryParser):  # {{{
 
 class LRUCache(object):  # {{{
 
-    'A simple Least-Recently-Used cache'
-
-    def __init__(self, limit=50):
-        self.item_map = {}
-        self.age_map = deque()
-        self.limit = limit
+    '''
+    A Least-Recently-Used cache, bounded by the number of entries and,
+    optionally, by the total size of the values, as measured by size_of().
+    Every entry can record the set of fields its value depends on (None
+    meaning that it depends on all fields), so that entries can be
+    selectively invalidated, see :meth:`keys_depending_on`.
+    '''
+
+    def __init__(self, limit=50, max_size=None, size_of=None):
+        self.item_map = OrderedDict()
+        self.deps_map = {}
+        self.size_map = {}
+        self.limit, self.max_size, self.size_of = limit, max_size, size_of
+        self.total_size = 0
 
     def _move_up(self, key):
-        if key != self.age_map[-1]:
-            self.age_map.remove(key)
-            self.age_map.append(key)
+        self.item_map[key] = self.item_map.pop(key)
 
-    def add(self, key, val):
+    def add(self, key, val, fields=None):
         if key in self.item_map:
             self._move_up(key)
             return
 
-        if len(self.age_map) >= self.limit:
-            self.item_map.pop(self.age_map.popleft())
-
         self.item_map[key] = val
-        self.age_map.append(key)
+        self.deps_map[key] = fields
+        if self.size_of is not None:
+            self.size_map[key] = sz = self.size_of(val)
+            self.total_size += sz
+        self.prune()
     __setitem__  = add
 
+    def prune(self):
+        while self.item_map and (len(self.item_map) > self.limit or (
+                self.max_size is not None and self.total_size > self.max_size)):
+            self.pop(next(iter(self.item_map)))
+
+    def resize(self, key):
+        ' Recalculate the size of the value for key, after it has been changed in place '
+        if self.size_of is not None and key in self.item_map:
+            sz = self.size_of(self.item_map[key])
+            self.total_size += sz - self.size_map[key]
+            self.size_map[key] = sz
+            self.prune()
+
     def get(self, key, default=None):
         ans = self.item_map.get(key, default)
         if ans is not default:
@@ -766,20 +1012,27 @@ class LRUCache(object):  # {{{
 
     def clear(self):
         self.item_map.clear()
-        self.age_map.clear()
+        self.deps_map.clear()
+        self.size_map.clear()
+        self.total_size = 0
 
     def pop(self, key, default=None):
-        self.item_map.pop(key, default)
-        try:
-            self.age_map.remove(key)
-        except ValueError:
-            pass
+        ans = self.item_map.pop(key, default)
+        self.deps_map.pop(key, None)
+        self.total_size -= self.size_map.pop(key, 0)
+        return ans
+
+    def keys_depending_on(self, fields=None):
+        ' The keys of all entries that depend on any of the specified fields, or all keys if fields is None '
+        if fields is None:
+            return list(self.item_map)
+        return [key for key, deps in self.deps_map.iteritems() if deps is None or not deps.isdisjoint(fields)]
 
     def __contains__(self, key):
         return key in self.item_map
 
     def __len__(self):
-        return len(self.age_map)
+        return len(self.item_map)
 
     def __getitem__(self, key):
         return self.get(key)
@@ -792,6 +1045,10 @@ class LRUCache(object):  # {{{
 class Search(object):
 
     MAX_CACHE_UPDATE = 50
+    # The maximum number of cached search results and their maximum total size
+    # in bytes
+    CACHE_LIMIT = 1000
+    CACHE_MAX_SIZE = 32 * 1024 * 1024
 
     def __init__(self, db, opt_name, all_search_locations=()):
         self.all_search_locations = all_search_locations
@@ -800,8 +1057,13 @@ class Search(object):
         self.bool_search = BooleanSearch()
         self.keypair_search = KeyPairSearch()
         self.saved_searches = SavedSearchQueries(db, opt_name)
-        self.cache = LRUCache()
+        self.cache = LRUCache(limit=self.CACHE_LIMIT, max_size=self.CACHE_MAX_SIZE, size_of=sys.getsizeof)
         self.parse_cache = LRUCache(limit=100)
+        self.text_index = TextIndex()
+        # The number of changes for every field, used to tell if the results
+        # of a search may have changed. The key None counts changes to all fields.
+        self.change_counts = defaultdict(int)
+        self.total_changes = 0
 
     def get_saved_searches(self):
         return self.saved_searches
@@ -812,31 +1074,122 @@ class Search(object):
             self.parse_cache.clear()
         self.all_search_locations = newlocs
 
-    def update_or_clear(self, dbcache, book_ids=None):
-        if book_ids and (len(book_ids) * len(self.cache)) <= self.MAX_CACHE_UPDATE:
-            self.update_caches(dbcache, book_ids)
+    def update_or_clear(self, dbcache, book_ids=None, fields=None):
+        ''' Update the cached search results after the specified fields of
+        the specified books have changed. Only results that depend on the
+        changed fields are affected. If fields is None, all fields are assumed
+        to have changed and if book_ids is None, all books. '''
+        self.total_changes += 1
+        if not book_ids:
+            self.change_counts[None] += 1
+            self.text_index.clear()
+            return self.clear_caches()
+        for field in (None,) if fields is None else fields:
+            self.change_counts[field] += 1
+        self.text_index.update(book_ids, fields)
+        keys = self.cache.keys_depending_on(fields)
+        if (len(book_ids) * len(keys)) <= self.MAX_CACHE_UPDATE:
+            self.update_caches(dbcache, book_ids, keys)
         else:
-            self.clear_caches()
+            for key in keys:
+                self.cache.pop(key)
 
     def clear_caches(self):
         self.cache.clear()
 
-    def update_caches(self, dbcache, book_ids):
+    def update_caches(self, dbcache, book_ids, keys=None):
         sqp = self.create_parser(dbcache)
         try:
-            return self._update_caches(sqp, book_ids)
+            return self._update_caches(sqp, book_ids, keys)
         finally:
             sqp.dbcache = sqp.lookup_saved_search = None
 
+    def fields_for_query(self, sqp, query, depth=0):
+        ''' Return the set of fields the results of the query depend on or
+        None if they can depend on any field, for example, when searching all
+        fields, composite columns or user categories. '''
+        try:
+            tree = None if sqp.sqp_parse_cache is None else sqp.sqp_parse_cache.get(query)
+            if tree is None:
+                tree = sqp.parser.parse(query, sqp.locations)
+        except (ParseException, RuntimeError):
+            return None
+        fm = sqp.field_metadata
+        ans = set()
+        stack = [tree]
+        while stack:
+            node = stack.pop()
+            if node[0] != 'token':
+                stack.extend(node[1:])
+                continue
+            location, q = icu_lower(node[1]), node[2]
+            if location == 'search':
+                if depth > 5:
+                    return None
+                saved = sqp.lookup_saved_search(q[1:] if q.startswith('=') else q)
+                fields = None if saved is None else self.fields_for_query(sqp, saved, depth + 1)
+                if fields is None:
+                    return None
+                ans |= fields
+                continue
+            keys = fm.search_term_to_field_key(location)
+            for key in (keys if isinstance(keys, list) else (keys,)):
+                if key == 'date':
+                    key = 'timestamp'
+                elif key == 'series_sort':
+                    ans |= {'series', 'languages'}
+                    continue
+                # User categories and grouped search terms match items from
+                # other fields, that can be changed without changing them
+                if (key not in fm or key == 'all' or key.startswith('@') or fm[key]['datatype'] == 'composite' or
+                        fm[key]['kind'] in ('user', 'search')):
+                    return None
+                ans.add(key)
+        return frozenset(ans)
+
+    def results_version(self, dbcache, query):
+        ''' Return a number that changes whenever the results of the
+        specified query may have changed '''
+        sqp = self.create_parser(dbcache)
+        try:
+            fields = self.fields_for_query(sqp, query)
+        finally:
+            sqp.dbcache = sqp.lookup_saved_search = None
+        if fields is None:
+            return self.total_changes
+        return self.change_counts[None] + sum(self.change_counts[f] for f in fields if f in self.change_counts)
+
+    def sort_version(self, field_metadata, fields):
+        ''' Return a number that changes whenever the order of books sorted
+        on the specified fields may have changed '''
+        # Sort keys are language dependent
+        deps = {'languages'}
+        for field in fields:
+            if field == 'id':
+                continue
+            if field not in field_metadata or field_metadata[field]['datatype'] == 'composite':
+                return self.total_changes
+            deps.add(field)
+            deps.add({'title':'sort', 'authors':'author_sort'}.get(field, field))
+            if field_metadata[field]['datatype'] == 'series':
+                deps.add(field + '_index')
+        return self.change_counts[None] + sum(self.change_counts[f] for f in deps if f in self.change_counts)
+
     def discard_books(self, book_ids):
         book_ids = set(book_ids)
+        self.total_changes += 1
+        self.change_counts[None] += 1
+        self.text_index.discard_books(book_ids)
         for query, result in self.cache:
             result.difference_update(book_ids)
 
-    def _update_caches(self, sqp, book_ids):
+    def _update_caches(self, sqp, book_ids, keys=None):
         book_ids = sqp.all_book_ids = set(book_ids)
         remove = set()
-        for query, result in tuple(self.cache):
+        for query in (list(self.cache.item_map) if keys is None else keys):
+            result = self.cache.item_map.get(query)
+            if result is None:
+                continue
             try:
                 matches = sqp.parse(query)
             except ParseException:
@@ -846,6 +1199,7 @@ class Search(object):
                 result.difference_update(book_ids - matches)
                 # add books that now match but did not before
                 result.update(matches)
+                self.cache.resize(query)
         for query in remove:
             self.cache.pop(query)
 
@@ -856,7 +1210,8 @@ class Search(object):
             self.keypair_search,
             prefs['limit_search_columns'],
             prefs['limit_search_columns_to'], self.all_search_locations,
-            virtual_fields, self.saved_searches.lookup, self.parse_cache)
+            virtual_fields, self.saved_searches.lookup, self.parse_cache,
+            text_index=self.text_index)
 
     def __call__(self, dbcache, query, search_restriction, virtual_fields=None, book_ids=None):
         '''
@@ -871,6 +1226,23 @@ class Search(object):
         finally:
             sqp.dbcache = sqp.lookup_saved_search = None
 
+    def explain(self, dbcache, query, search_restriction, virtual_fields=None):
+        '''
+        Run the search without using the cache of results, returning the
+        matches and the evaluation plan, see
+        :meth:`SearchQueryParser.explain`.
+        '''
+        sqp = self.create_parser(dbcache, virtual_fields)
+        try:
+            sqp.all_book_ids = dbcache._all_book_ids(type=set)
+            if search_restriction and search_restriction.strip():
+                sqp.all_book_ids = sqp.parse(search_restriction)
+            if not query.strip():
+                return sqp.all_book_ids, []
+            return sqp.explain(query)
+        finally:
+            sqp.dbcache = sqp.lookup_saved_search = None
+
     def _do_search(self, sqp, query, search_restriction, dbcache, book_ids=None):
         ''' Do the search, caching the results. Results are cached only if the
         search is on the full library and no virtual field is searched on '''
@@ -892,7 +1264,8 @@ class Search(object):
                 sqp.all_book_ids = all_book_ids if book_ids is None else book_ids
                 restricted_ids = sqp.parse(search_restriction)
                 if not sqp.virtual_field_used and sqp.all_book_ids is all_book_ids:
-                    self.cache.add(search_restriction.strip(), restricted_ids)
+                    self.cache.add(search_restriction.strip(), restricted_ids,
+                                   self.fields_for_query(sqp, search_restriction.strip()))
             else:
                 restricted_ids = cached
                 if book_ids is not None:
@@ -912,7 +1285,7 @@ class Search(object):
         result = sqp.parse(query)
 
         if not sqp.virtual_field_used and sqp.all_book_ids is all_book_ids:
-            self.cache.add(query, result)
+            self.cache.add(query, result, self.fields_for_query(sqp, query))
 
         return result
 
@@ -0,0 +1,81 @@
+#!/usr/bin/env python2
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:fdm=marker:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2013, Kovid Goyal <kovid at kovidgoyal.net>'
+__docformat__ = 'restructuredtext en'
+
+from collections import defaultdict
+
+from calibre.db.cache import Cache, wrap_simple
+from calibre.db.errors import ReadOnlySnapshot
+from calibre.db.locking import create_locks
+from calibre.db.search import Search
+
+
+def read_only(name):
+    def func(*args, **kwargs):
+        raise ReadOnlySnapshot('Cannot call %s() on a read-only snapshot of the database' % name)
+    return func
+
+
+class Snapshot(Cache):
+
+    '''
+    A read-only view of the in-memory metadata of a :class:`Cache` at a point
+    in time. It has the same read API as the cache, but its locks are private,
+    so reading from it never blocks, and is never blocked by, writes to the
+    cache. All write API methods raise :class:`ReadOnlySnapshot`. Create these
+    with :meth:`Cache.snapshot`.
+
+    Only the in-memory metadata is versioned, data that is read from the
+    library itself, such as formats, covers and preferences, is always
+    current.
+    '''
+
+    def __init__(self, cache, version):
+        self.version = version
+        self.backend = cache.backend
+        self.read_lock, self.write_lock = create_locks()
+        self.format_metadata_cache = defaultdict(dict)
+        self.formatter_template_cache = {}
+        self.dirtied_cache = cache.dirtied_cache.copy()
+        self.dirtied_sequence = cache.dirtied_sequence
+        self.deferred_dirtied = None
+        self.cover_caches = set()
+        self.lazy_loader = None
+        self.stop_lazy_loading = False
+        self.clear_search_cache_count = cache.clear_search_cache_count
+        self.item_changes = cache.item_changes
+        self.sort_ranks = {}
+        self.current_snapshot = None
+
+        self.fields, self.composites = {}, {}
+        for name, field in cache.fields.iteritems():
+            table = getattr(field, 'table', None)
+            self.fields[name] = field.snapshot(None if table is None else table.snapshot())
+            if name in cache.composites:
+                self.composites[name] = self.fields[name]
+        for field in self.fields.itervalues():
+            for attr in ('series_field', 'index_field', 'author_sort_field', 'title_sort_field'):
+                other = getattr(field, attr, None)
+                if other is not None:
+                    setattr(field, attr, self.fields[other.name])
+
+        for name in dir(self):
+            func = getattr(self, name)
+            ira = getattr(func, 'is_read_api', None)
+            if ira is not None:
+                if ira:
+                    setattr(self, '_'+name, func)
+                    setattr(self, name, wrap_simple(self.read_lock, func))
+                else:
+                    setattr(self, '_'+name, read_only(name))
+                    setattr(self, name, read_only(name))
+
+        self._search_api = Search(self, 'saved_searches', self.field_metadata.get_search_terms())
+
+    def snapshot(self):
+        return self
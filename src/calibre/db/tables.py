@@ -7,10 +7,14 @@ __license__   = 'GPL v3'
 __copyright__ = '2011, Kovid Goyal <kovid@kovidgoyal.net>'
 __docformat__ = 'restructuredtext en'
 
+from array import array
 from datetime import datetime, timedelta
 from collections import defaultdict
+from itertools import repeat
+from threading import RLock
 
 from calibre.constants import plugins
+from calibre.utils.config_base import tweaks
 from calibre.utils.date import parse_date, UNDEFINED_DATE, utc_tz
 from calibre.ebooks.metadata import author_to_author_sort
 
@@ -47,6 +51,312 @@ ONE_ONE, MANY_ONE, MANY_MANY = xrange(3)
 null = object()
 
 
+# Compact maps {{{
+
+class CompactMap(object):
+
+    '''
+    A dict-like map from book ids to values, stored as a list indexed by the
+    book id. Book ids are small, dense integers, so this uses a fraction of
+    the memory of a dict. Used for the in-memory tables when the
+    compact_in_memory_tables tweak is set. Note that copy() returns a plain
+    dict.
+    '''
+
+    __slots__ = ('data', 'count')
+    missing = null
+
+    def __init__(self, items=()):
+        self.data = self.new_storage()
+        self.count = 0
+        self.update(items)
+
+    def new_storage(self):
+        return []
+
+    def grow(self, key):
+        if key < 0:
+            raise KeyError(key)
+        n = key + 1 - len(self.data)
+        if n > 0:
+            self.data.extend(repeat(self.missing, n))
+
+    def get(self, key, default=None):
+        try:
+            val = self.data[key] if key >= 0 else self.missing
+        except (IndexError, TypeError):
+            return default
+        return default if val is self.missing else val
+
+    def __getitem__(self, key):
+        ans = self.get(key, null)
+        if ans is null:
+            raise KeyError(key)
+        return ans
+
+    def __setitem__(self, key, val):
+        self.grow(key)
+        if self.data[key] is self.missing:
+            self.count += 1
+        self.data[key] = val
+
+    def pop(self, key, default=null):
+        ans = self.get(key, null)
+        if ans is null:
+            if default is null:
+                raise KeyError(key)
+            return default
+        self.data[key] = self.missing
+        self.count -= 1
+        return ans
+
+    def __delitem__(self, key):
+        self.pop(key)
+
+    def __contains__(self, key):
+        return self.get(key, null) is not null
+
+    def __len__(self):
+        return self.count
+
+    def iteritems(self):
+        missing = self.missing
+        for key, val in enumerate(self.data):
+            if val is not missing:
+                yield key, val
+
+    def iterkeys(self):
+        for key, val in self.iteritems():
+            yield key
+    __iter__ = iterkeys
+
+    def itervalues(self):
+        for key, val in self.iteritems():
+            yield val
+
+    def keys(self):
+        return list(self.iterkeys())
+
+    def values(self):
+        return list(self.itervalues())
+
+    def items(self):
+        return list(self.iteritems())
+
+    def update(self, items):
+        if hasattr(items, 'iteritems'):
+            items = items.iteritems()
+        for key, val in items:
+            self[key] = val
+
+    def clear(self):
+        self.data = self.new_storage()
+        self.count = 0
+
+    def copy(self):
+        return dict(self.iteritems())
+
+    def __repr__(self):
+        return '%s(%r)' % (self.__class__.__name__, self.copy())
+
+
+class CompactIdMap(CompactMap):
+
+    '''
+    A :class:`CompactMap` whose values are non-negative integers (item ids),
+    stored in a contiguous array.
+    '''
+
+    __slots__ = ()
+    missing = -1
+
+    def new_storage(self):
+        return array(b'l')
+
+    def get(self, key, default=None):
+        try:
+            val = self.data[key] if key >= 0 else -1
+        except (IndexError, TypeError):
+            return default
+        return default if val < 0 else val
+
+    def __setitem__(self, key, val):
+        if val < 0:
+            raise ValueError('Item ids must not be negative: %r' % val)
+        self.grow(key)
+        if self.data[key] < 0:
+            self.count += 1
+        self.data[key] = val
+
+    def iteritems(self):
+        for key, val in enumerate(self.data):
+            if val > -1:
+                yield key, val
+
+
+class CompactIdsMap(object):
+
+    '''
+    A dict-like map from book ids to tuples of item ids, stored in compressed
+    sparse row form: all item ids live in a single array, and two arrays
+    indexed by book id hold the start and length of the run belonging to each
+    book (a length of -1 means the book is not present). Replacing a value
+    with one of the same or smaller length is done in place, otherwise the new
+    run is appended and the array is compacted once too much space is unused.
+    '''
+
+    __slots__ = ('starts', 'lengths', 'ids', 'count', 'garbage')
+
+    def __init__(self, items=()):
+        self.clear()
+        self.update(items)
+
+    def clear(self):
+        self.starts, self.lengths, self.ids = array(b'l'), array(b'l'), array(b'l')
+        self.count = self.garbage = 0
+
+    def grow(self, key):
+        if key < 0:
+            raise KeyError(key)
+        n = key + 1 - len(self.lengths)
+        if n > 0:
+            self.starts.extend(repeat(0, n))
+            self.lengths.extend(repeat(-1, n))
+
+    def length(self, key, default=-1):
+        ' The number of items for the specified book, without creating a tuple '
+        try:
+            n = self.lengths[key] if key >= 0 else -1
+        except (IndexError, TypeError):
+            return default
+        return default if n < 0 else n
+
+    def get(self, key, default=None):
+        n = self.length(key)
+        if n < 0:
+            return default
+        s = self.starts[key]
+        return tuple(self.ids[s:s+n])
+
+    def __getitem__(self, key):
+        ans = self.get(key, null)
+        if ans is null:
+            raise KeyError(key)
+        return ans
+
+    def __setitem__(self, key, val):
+        val = array(b'l', val)
+        self.grow(key)
+        n, old = len(val), self.lengths[key]
+        if old < 0:
+            self.count += 1
+        if n <= old:
+            s = self.starts[key]
+            self.ids[s:s+n] = val
+            self.garbage += old - n
+        else:
+            self.garbage += max(0, old)
+            self.starts[key] = len(self.ids)
+            self.ids.extend(val)
+        self.lengths[key] = n
+        if self.garbage > 4096 and self.garbage > len(self.ids) // 2:
+            self.compact()
+
+    def pop(self, key, default=null):
+        ans = self.get(key, null)
+        if ans is null:
+            if default is null:
+                raise KeyError(key)
+            return default
+        self.garbage += len(ans)
+        self.lengths[key] = -1
+        self.count -= 1
+        return ans
+
+    def __delitem__(self, key):
+        self.pop(key)
+
+    def __contains__(self, key):
+        return self.length(key) > -1
+
+    def __len__(self):
+        return self.count
+
+    def compact(self):
+        ' Remove unused space from the ids array '
+        ids, starts, old = array(b'l'), self.starts, self.ids
+        for key, n in enumerate(self.lengths):
+            if n > 0:
+                s = starts[key]
+                starts[key] = len(ids)
+                ids.extend(old[s:s+n])
+        self.ids, self.garbage = ids, 0
+
+    def iteritems(self):
+        starts, ids = self.starts, self.ids
+        for key, n in enumerate(self.lengths):
+            if n > -1:
+                s = starts[key]
+                yield key, tuple(ids[s:s+n])
+
+    def iterkeys(self):
+        for key, n in enumerate(self.lengths):
+            if n > -1:
+                yield key
+    __iter__ = iterkeys
+
+    def itervalues(self):
+        for key, val in self.iteritems():
+            yield val
+
+    def keys(self):
+        return list(self.iterkeys())
+
+    def values(self):
+        return list(self.itervalues())
+
+    def items(self):
+        return list(self.iteritems())
+
+    def update(self, items):
+        if hasattr(items, 'iteritems'):
+            items = items.iteritems()
+        for key, val in items:
+            self[key] = val
+
+    def copy(self):
+        return dict(self.iteritems())
+
+    def __repr__(self):
+        return '%s(%r)' % (self.__class__.__name__, self.copy())
+
+
+def interned_values(items):
+    ' Share a single object between all books that have equal values '
+    seen = {}
+    for key, val in items:
+        yield key, seen.setdefault((val.__class__, val), val)
+
+
+def snapshot_copy(val):
+    ''' Copy the in-memory data of a table, so that changes to the table do
+    not affect the copy. Only immutable values are shared with the original. '''
+    if isinstance(val, (CompactMap, CompactIdsMap)):
+        return val.__class__(val.iteritems())
+    if isinstance(val, dict):
+        ans = val.copy()  # Preserves the default_factory of defaultdicts
+        for k, v in ans.iteritems():
+            if isinstance(v, (dict, set, list)):
+                ans[k] = snapshot_copy(v)
+        return ans
+    if isinstance(val, set):
+        return set(val)
+    if isinstance(val, list):
+        return [snapshot_copy(x) for x in val]
+    return val
+# }}}
+
+
 class Table(object):
 
     def __init__(self, name, metadata, link_table=None):
@@ -64,6 +374,50 @@ class Table(object):
 
         self.link_table = (link_table if link_table else
                 'books_%s_link'%self.metadata['table'])
+        # Store the book maps in arrays indexed by book id rather than in dicts
+        self.compact = bool(tweaks['compact_in_memory_tables'])
+        self.lazy_lock, self.lazy_db = RLock(), None
+
+    def __getattr__(self, attr):
+        # Only called for attributes that do not exist, which, for tables
+        # that are read lazily, means that the data has not been read yet
+        if attr.startswith('__') or self.__dict__.get('lazy_db') is None:
+            raise AttributeError(attr)
+        self.ensure_loaded()
+        try:
+            return self.__dict__[attr]
+        except KeyError:
+            raise AttributeError(attr)
+
+    def read_lazily(self, db):
+        ''' Defer reading the data for this table from db until it is first
+        used, or until ensure_loaded() is called. '''
+        self.lazy_db = db
+
+    def ensure_loaded(self):
+        ''' Read the data for this table, if it was deferred by read_lazily().
+        Safe to call from multiple threads, but the caller must hold a lock of
+        the Cache, since the data is read from the shared database connection. '''
+        with self.lazy_lock:
+            db = self.lazy_db
+            if db is None:
+                return
+            # Read into a copy and then update all the data at once, so that
+            # other threads never see partially read data
+            shadow = object.__new__(self.__class__)
+            shadow.__dict__.update(self.__dict__)
+            shadow.lazy_db = None
+            shadow.read(db)
+            self.__dict__.update(shadow.__dict__)
+
+    def snapshot(self):
+        ''' Return a copy of this table that does not change when this table
+        is changed. '''
+        self.ensure_loaded()
+        ans = object.__new__(self.__class__)
+        ans.__dict__.update({k:snapshot_copy(v) for k, v in self.__dict__.iteritems()})
+        ans.lazy_lock, ans.lazy_db = RLock(), None
+        return ans
 
     def remove_books(self, book_ids, db):
         return set()
@@ -117,6 +471,8 @@ class OneToOneTable(Table):
         else:
             us = self.unserialize
             self.book_col_map = {book_id:us(val) for book_id, val in query}
+        if self.compact:
+            self.book_col_map = CompactMap(interned_values(self.book_col_map.iteritems()))
 
     def remove_books(self, book_ids, db):
         clean = set()
@@ -141,7 +497,7 @@ class SizeTable(OneToOneTable):
         query = db.execute(
             'SELECT books.id, (SELECT MAX(uncompressed_size) FROM data '
             'WHERE data.book=books.id) FROM books')
-        self.book_col_map = dict(query)
+        self.book_col_map = (CompactMap if self.compact else dict)(query)
 
     def update_sizes(self, size_map):
         self.book_col_map.update(size_map)
@@ -200,7 +556,7 @@ class ManyToOneTable(Table):
     def read(self, db):
         self.id_map = {}
         self.col_book_map = defaultdict(set)
-        self.book_col_map = {}
+        self.book_col_map = CompactIdMap() if self.compact else {}
         self.read_id_maps(db)
         self.read_maps(db)
 
@@ -379,7 +735,10 @@ class ManyToManyTable(ManyToOneTable):
             cbm[item_id].add(book)
             bcm[book].append(item_id)
 
-        self.book_col_map = {k:tuple(v) for k, v in bcm.iteritems()}
+        if self.compact:
+            self.book_col_map = CompactIdsMap(bcm)
+        else:
+            self.book_col_map = {k:tuple(v) for k, v in bcm.iteritems()}
 
     def fix_link_table(self, db):
         linked_item_ids = {item_id for item_ids in self.book_col_map.itervalues() for item_id in item_ids}
@@ -91,6 +91,17 @@ class BaseTest(unittest.TestCase):
     def cloned_library(self):
         return self.clone_library(self.library_path)
 
+    def field_values(self, cache, book_ids):
+        ' The values of all fields stored in the db for the specified books, as {field:{book_id:value}} '
+        return {f:{book_id:cache.field_for(f, book_id) for book_id in book_ids}
+                for f in cache.fields if f not in ('ondevice', 'marked')}
+
+    def compare_field_values(self, expected, cache, book_ids, msg='The field %s differs'):
+        ' Compare the field values of cache with values returned by :meth:`field_values` '
+        actual = self.field_values(cache, book_ids)
+        for f, values in expected.iteritems():
+            self.assertEqual(values, actual[f], msg % f)
+
     def compare_metadata(self, mi1, mi2, exclude=()):
         allfk1 = mi1.all_field_keys()
         allfk2 = mi2.all_field_keys()
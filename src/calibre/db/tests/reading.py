@@ -214,6 +214,38 @@ class ReadingTest(BaseTest):
         ae([5, 4, 3, 2, 1, 10, 9, 8, 7, 6], cache.multisort([('#one', True), ('#two', False), ('#three', False)], ids_to_sort=sorted(cache.all_book_ids())))
     # }}}
 
+    def test_sort_ranks(self):  # {{{
+        'Test the cached sort ranks used by multisort'
+        cache = self.init_cache()
+        ae = self.assertEqual
+        ae([2, 1, 3], cache.multisort([('title', True)]))
+        self.assertIn('title', cache.sort_ranks)
+        ae([3, 1, 2], cache.multisort([('title', False)]))
+        # Changing a field must only invalidate the ranks that depend on it
+        cache.multisort([('series', True), ('rating', False)])
+        self.assertIn('series', cache.sort_ranks)
+        cache.set_field('title', {3:'aaa'})
+        self.assertNotIn('title', cache.sort_ranks)
+        self.assertIn('series', cache.sort_ranks)
+        ae([3, 2, 1], cache.multisort([('title', True)]))
+        cache.set_field('languages', {1:('fra',)})
+        self.assertNotIn('series', cache.sort_ranks)
+        # Equal sort keys must get equal ranks so that sub-sorting works
+        cache.set_field('#yesno', {1:True, 2:True, 3:False})
+        ae([2, 1, 3], cache.multisort([('#yesno', True), ('title', True)]))
+        ae(cache.sort_ranks['#yesno'][1][1], cache.sort_ranks['#yesno'][1][2])
+        # Composite and virtual fields are never cached
+        cache.multisort([('#formats', True), ('ondevice', True)])
+        self.assertNotIn('#formats', cache.sort_ranks)
+        self.assertNotIn('ondevice', cache.sort_ranks)
+        # New books must be ranked even if the fields are not set for them
+        from calibre.ebooks.metadata.book.base import Metadata
+        book_id = cache.create_book_entry(Metadata('zzz'), apply_import_tags=False)
+        ae(book_id, cache.multisort([('#yesno', False), ('title', False)])[0])
+        cache.remove_books((book_id,))
+        self.assertNotIn(book_id, cache.sort_ranks['#yesno'][1])
+    # }}}
+
     def test_get_metadata(self):  # {{{
         'Test get_metadata() returns the same data for both backends'
         from calibre.library.database2 import LibraryDatabase2
@@ -397,6 +429,38 @@ class ReadingTest(BaseTest):
 
     # }}}
 
+    def test_incremental_categories(self):  # {{{
+        'Check that the cached category data is updated by writes'
+        cache = self.init_cache(self.cloned_library)
+        ae = self.assertEqual
+
+        def categories():
+            return {k:[(t.name, t.id, t.count, t.avg_rating, t.sort, set(t.id_set)) for t in v]
+                    for k, v in cache.get_categories().iteritems()}
+
+        def check():
+            ans = categories()
+            cache.clear_caches()
+            ae(ans, categories())
+
+        categories()
+        self.assertTrue(cache.fields['tags'].category_cache)
+        cache.set_field('tags', {1:('Tag One', 'new tag'), 2:()})
+        check()
+        cache.set_field('rating', {1:8, 3:2})
+        check()
+        cache.set_field('languages', {1:('fra',), 2:('deu',)})
+        check()
+        cache.rename_items('tags', {cache.get_item_id('tags', 'new tag'):'Tag Two'})
+        check()
+        cache.remove_items('series', (cache.get_item_id('series', 'A Series One'),))
+        check()
+        cache.set_sort_for_authors({cache.get_item_id('authors', 'Author One'):'zzz'})
+        check()
+        cache.remove_books((2,))
+        check()
+    # }}}
+
     def test_get_formats(self):  # {{{
         'Test reading ebook formats using the format() method'
         from calibre.library.database2 import LibraryDatabase2
@@ -479,6 +543,72 @@ class ReadingTest(BaseTest):
         db.close()
     # }}}
 
+    def test_compact_tables(self):  # {{{
+        ' Test that compact in-memory tables behave the same as the default ones '
+        from calibre.utils.config_base import tweaks
+        from calibre.db.tables import CompactIdMap, CompactIdsMap
+        cache = self.init_cache()
+        book_ids = cache.all_book_ids()
+        expected = self.field_values(cache, book_ids)
+        expected_searches = {q:cache.search(q) for q in ('tags:#', 'authors:=one', 'series:true', '#tags:=a')}
+        tweaks['compact_in_memory_tables'] = True
+        try:
+            cache = self.init_cache()
+        finally:
+            tweaks['compact_in_memory_tables'] = False
+        self.assertIsInstance(cache.fields['series'].table.book_col_map, CompactIdMap)
+        self.assertIsInstance(cache.fields['tags'].table.book_col_map, CompactIdsMap)
+        self.assertEqual(book_ids, cache.all_book_ids())
+        self.compare_field_values(expected, cache, book_ids)
+        for q, ans in expected_searches.iteritems():
+            self.assertEqual(ans, cache.search(q), 'The search %s differs' % q)
+        cache.set_field('tags', {1:('one', 'two', 'three', 'four'), 2:()})
+        self.assertEqual(cache.field_for('tags', 1), ('one', 'two', 'three', 'four'))
+        self.assertEqual(cache.field_for('tags', 2), ())
+        cache.remove_books((1,))
+        self.assertNotIn(1, cache.all_book_ids())
+    # }}}
+
+    def test_lazy_tables(self):  # {{{
+        ' Test that lazily read tables behave the same as the default ones '
+        from calibre.utils.config_base import tweaks
+        cache = self.init_cache()
+        book_ids = cache.all_book_ids()
+        expected = self.field_values(cache, book_ids)
+        tweaks['lazy_load_columns'] = True
+        try:
+            cache = self.init_cache()
+        finally:
+            tweaks['lazy_load_columns'] = False
+        self.assertIsNotNone(cache.lazy_loader)
+        self.compare_field_values(expected, cache, book_ids)
+        cache.load_lazy_tables()
+        for name, table in cache.backend.tables.iteritems():
+            self.assertIsNone(table.lazy_db, 'The table %s was not read' % name)
+
+        # Tables are read on first use
+        table = cache.fields['comments'].table
+        del table.book_col_map
+        table.read_lazily(cache.backend)
+        self.assertEqual(expected['comments'], {book_id:table.book_col_map.get(book_id) for book_id in book_ids})
+        self.assertIsNone(table.lazy_db)
+        self.assertRaises(AttributeError, getattr, table, 'no_such_attribute')
+
+        # Tables are not read while the database is being changed
+        from threading import Thread
+        del table.book_col_map
+        table.read_lazily(cache.backend)
+        t = Thread(target=cache.load_lazy_tables)
+        with cache.write_lock:
+            t.start()
+            t.join(0.1)
+            self.assertIsNotNone(table.lazy_db)
+        t.join()
+        self.assertIsNone(table.lazy_db)
+        cache.close()
+        self.assertIsNone(cache.lazy_loader)
+    # }}}
+
     def test_datetime(self):  # {{{
         ' Test the reading of datetimes stored in the db '
         from calibre.utils.date import parse_date
@@ -570,6 +700,82 @@ class ReadingTest(BaseTest):
         cache.set_field('publisher', {3:'ppppp', 2:'other'})
         # Test cache update worked
         test(True, {2, 3}, 'title:=xxx or title:"=Title One"')
+        # Test that only searches that depend on the changed fields are invalidated
+        cache._search_api.MAX_CACHE_UPDATE = 0
+        c.limit = 50
+        test(False, {2}, 'title:"=Title One"')
+        test(False, {1, 2}, 'tags:"=tag one"')
+        v = cache.search_results_version('title:"=Title One"')
+        cache.set_field('rating', {1:4, 2:2})
+        test(True, {2}, 'title:"=Title One"')
+        test(True, {1, 2}, 'tags:"=tag one"')
+        ae(v, cache.search_results_version('title:"=Title One"'))
+        cache.set_field('title', {2:'Title Three'})
+        test(False, set(), 'title:"=Title One"')
+        test(True, {1, 2}, 'tags:"=tag one"')
+        self.assertLess(v, cache.search_results_version('title:"=Title One"'))
+        # Searches of user categories depend on the fields of their items
+        test(False, {1, 2}, '@Good Series.Good Tags:true')
+        test(True, {1, 2}, '@Good Series.Good Tags:true')
+        v = cache.search_results_version('@Good Series.Good Tags:true')
+        cache.set_field('tags', {1:('News',)})
+        self.assertLess(v, cache.search_results_version('@Good Series.Good Tags:true'))
+        test(False, {2}, '@Good Series.Good Tags:true')
+        # Adding a book can change the results of any search
+        from calibre.ebooks.metadata.book.base import Metadata
+        ae(cache.search('not tags:"=News"'), {2, 3})
+        v = cache.search_results_version('')
+        book_id = cache.create_book_entry(Metadata('zzz'), apply_import_tags=False)
+        self.assertLess(v, cache.search_results_version(''))
+        ae(cache.search('not tags:"=News"'), {2, 3, book_id})
+    # }}}
+
+    def test_text_index(self):  # {{{
+        ' Test that searching with the text index gives the same results as scanning '
+        cache = self.init_cache()
+        api = cache._search_api
+
+        def scan(query):
+            sqp = api.create_parser(cache)
+            sqp.text_index = None
+            sqp.all_book_ids = cache._all_book_ids(type=set)
+            return sqp.parse(query)
+
+        queries = ('title:one', 'title:=title one', 'title:"=Title One"', 'authors:aut', 'tags:=one', 'tags:=.one',
+                   'tags:"=..two"', 'series:series', 'publisher:pub', 'author_sort:one', 'languages:eng', 'one',
+                   'title:~^t', '#enum:one', 'not tags:t', 'title:e')
+
+        def check():
+            for q in queries:
+                api.clear_caches()
+                self.assertEqual(scan(q), cache.search(q), 'Search for %s differs' % q)
+
+        check()
+        self.assertIsNotNone(api.text_index.indices['title'])
+        self.assertIsNone(api.text_index.indices['comments'] if 'comments' in api.text_index.indices else None)
+        cache.set_field('title', {1:'Changed title', 2:'title ONE'})
+        cache.set_field('tags', {1:('one.two', 'Three'), 3:('one',)})
+        cache.rename_items('tags', {cache.get_item_id('tags', 'Three'):'Four'})
+        check()
+        self.assertEqual({1}, cache.search('tags:=four'))
+        cache.remove_books((2,))
+        check()
+    # }}}
+
+    def test_search_planning(self):  # {{{
+        ' Test the ordering of the terms of searches and the explain output '
+        cache = self.init_cache()
+        for q in ('title:~^t and tags:=one', 'tags:=one and title:~^t', 'title:one or not tags:=one or #tags:=a',
+                  'not (title:~e and series:=a) and authors:=one', 'title:"=nothing" and tags:~.'):
+            ans, plan = cache.explain_search(q)
+            self.assertEqual(cache.search(q), ans, 'Search for %s differs' % q)
+            self.assertEqual(len(ans), plan[0]['matches'])
+        ans, plan = cache.explain_search('title:~^t and tags:"=tag one"')
+        self.assertEqual({1, 2}, ans)
+        children = plan[0]['children']
+        self.assertEqual(['tags:"=tag one"', 'title:"~^t"'], [x['node'] for x in children])
+        self.assertEqual(len(cache.all_book_ids()), children[0]['candidates'])
+        self.assertEqual(children[0]['matches'], children[1]['candidates'])
     # }}}
 
     def test_proxy_metadata(self):  # {{{
@@ -365,6 +365,18 @@ class WritingTest(BaseTest):
             opf = OPF(BytesIO(raw))
             ae(opf.title, 'title%d'%book_id)
             ae(opf.authors, ['author1', 'author2'])
+        self.assertGreaterEqual(mb.metrics['backed_up'], 3)
+        ae(mb.metrics['queue_depth'], 0)
+
+        # Batched access to the dirtied queue
+        cache.mark_as_dirty({1, 2, 3})
+        cache.mark_as_dirty({2})
+        ae(cache.get_dirtied_books(2), [1, 3])
+        ae(cache.get_dirtied_books(), [1, 3, 2])
+        cache.clear_dirtied_books({1:cache.dirtied_cache[1], 2:-1})
+        ae(cache.get_dirtied_books(), [3, 2])
+        ae(cache.write_backups({3:b'xxx'}), {})
+        ae(cache.read_backup(3), b'xxx')
     # }}}
 
     def test_set_cover(self):  # {{{
@@ -438,6 +450,80 @@ class WritingTest(BaseTest):
 
     # }}}
 
+    def test_set_metadata_for_books(self):  # {{{
+        ' Test setting of metadata for many books at once '
+        ae = self.assertEqual
+        cache = self.init_cache(self.cloned_library)
+        mi, mi2 = cache.get_metadata(1), cache.get_metadata(3)
+        mi.title, mi.authors = 'New Title', ['New Author']
+        mi2.tags = ['bulk one', 'bulk two']
+        cache.set_metadata(2, mi)
+        cache.set_metadata(1, mi2, force_changes=True)
+        expected = {book_id:cache.get_metadata(book_id) for book_id in (1, 2)}
+
+        cache = self.init_cache(self.cloned_library)
+        ae({1, 2}, cache.set_metadata_for_books({2:mi}) | cache.set_metadata_for_books({1:mi2}, force_changes=True))
+        for book_id, emi in expected.iteritems():
+            self.compare_metadata(cache.get_metadata(book_id), emi, exclude={'last_modified', 'format_metadata'})
+        ae(cache.field_for('path', 2), 'New Author/New Title (2)')
+
+        # All books are marked dirty in a single pass
+        cache = self.init_cache(self.cloned_library)
+        marked, mark_as_dirty = [], cache._mark_as_dirty
+
+        def record_marks(book_ids, fields=None):
+            if cache.deferred_dirtied is None:
+                marked.append((set(book_ids), fields))
+            return mark_as_dirty(book_ids, fields=fields)
+        cache._mark_as_dirty = record_marks
+        mi.tags, mi2.tags = ['one'], ['two']
+        ae({1, 2, 3}, cache.set_metadata_for_books({1:mi, 2:mi2, 3:mi2}))
+        ae(len(marked), 1)
+        ae(marked[0][0], {1, 2, 3})
+        # Only the caches that depend on the changed fields are invalidated
+        self.assertIsNotNone(marked[0][1])
+        self.assertIn('tags', marked[0][1])
+        cache._mark_as_dirty = mark_as_dirty
+        ae(cache.field_for('tags', 1), ('one',))
+        ae(cache.field_for('tags', 3), ('two',))
+
+        # Errors in a single book do not prevent the others from being changed
+        mi.rating, mi2.rating = 'not a number', 4
+        mi2.tags = ['three']
+        cache.set_metadata_for_books({1:mi, 2:mi2}, ignore_errors=True)
+        ae(cache.field_for('tags', 2), ('three',))
+        ae(cache.field_for('rating', 2), 4)
+    # }}}
+
+    def test_snapshot(self):  # {{{
+        ' Test that snapshots are not affected by writes '
+        from calibre.db.errors import ReadOnlySnapshot
+        ae = self.assertEqual
+        cache = self.init_cache(self.cloned_library)
+        snap = cache.snapshot()
+        self.assertIs(snap, cache.snapshot())
+        book_ids = cache.all_book_ids()
+        expected = self.field_values(cache, book_ids)
+        tags = cache.search('tags:"=Tag One"')
+
+        cache.set_field('tags', {1:('new',), 2:('new',)})
+        cache.set_field('#tags', {3:('x', 'y')})
+        cache.set_field('title', {1:'changed'})
+        cache.remove_books((3,))
+        ae(book_ids, snap.all_book_ids())
+        self.compare_field_values(expected, snap, book_ids, 'The field %s changed in the snapshot')
+        ae(tags, snap.search('tags:"=Tag One"'))
+        self.assertFalse(cache.search('tags:"=Tag One"'))
+        ae([t.name for t in snap.get_categories()['tags']], ['Tag One', 'Tag Two'])
+        self.assertRaises(ReadOnlySnapshot, snap.set_field, 'title', {1:'x'})
+
+        # A new snapshot is created after changes
+        snap2 = cache.snapshot()
+        self.assertIsNot(snap, snap2)
+        ae(snap2.field_for('title', 1), 'changed')
+        ae(snap2.all_book_ids(), cache.all_book_ids())
+    # }}}
+
     def test_conversion_options(self):  # {{{
         ' Test saving of conversion options '
         cache = self.init_cache()
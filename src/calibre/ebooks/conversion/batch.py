@@ -0,0 +1,185 @@
+#!/usr/bin/env python2
+# vim:fileencoding=utf-8
+# License: GPLv3 Copyright: 2017, Kovid Goyal <kovid at kovidgoyal.net>
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+'''
+Convert many books with ebook-convert --batch, in a pool of worker processes
+that are re-used for many books, so that the conversion system has to be
+loaded only once per worker, not once per book.
+'''
+
+import os, shlex, sys, tempfile
+
+from calibre import detect_ncpus, prints
+from calibre.constants import iswindows
+from calibre.utils.logging import Log
+
+USAGE = _('''\
+%s --batch list_file [--batch-workers N] [--batch-max-memory-growth MB] [options]
+
+Convert many e-books, using a pool of worker processes that stay loaded between
+conversions. Every line of list_file has the same arguments as a single
+ebook-convert command, that is, the input file and the output file, optionally
+followed by options for that book. Empty lines and lines starting with # are
+ignored. The options given on the command line are used for every book.
+
+--batch-workers is the number of books to convert in parallel, the default is
+the number of CPUs. Worker processes whose memory usage grows by more than
+--batch-max-memory-growth MB (default: %d) are replaced by fresh ones, use zero
+to never replace them.''')
+
+DEFAULT_MAX_MEMORY_GROWTH = 512
+
+
+def pop_option(args, name, default=None):
+    ' Remove the option --name value or --name=value from args and return its value '
+    for i, arg in enumerate(args):
+        if arg == name:
+            if i + 1 >= len(args):
+                raise ValueError('No value specified for %s' % name)
+            val = args[i+1]
+            del args[i:i+2]
+            return val
+        if arg.startswith(name + '='):
+            del args[i]
+            return arg.partition('=')[2]
+    return default
+
+
+def read_batch_file(path):
+    ''' Return the list of command line arguments, one for each book, in the
+    file at path. '''
+    ans = []
+    with open(path, 'rb') as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith(b'#'):
+                continue
+            args = shlex.split(line, posix=not iswindows)
+            if iswindows:
+                args = [x[1:-1] if len(x) > 1 and x[0] == x[-1] == b'"' else x for x in args]
+            if len(args) < 2:
+                raise ValueError('No output file specified in the line: %s' % line.decode('utf-8', 'replace'))
+            ans.append(args)
+    return ans
+
+
+def convert_book(args, cwd):
+    ''' Run ebook-convert with args in the working directory cwd and return
+    its exit code and output. Runs in a worker process. '''
+    from calibre import ptempfile
+    from calibre.ebooks.conversion.cli import main
+    from calibre.utils.logging import FileStream
+    log = Log()
+    log.outputs = [FileStream()]
+    # The conversion creates persistent temporary files, that are normally
+    # removed only when the process exits. Workers convert many books, so
+    # create them in a directory that is removed once this book is done.
+    tdir = tempfile.mkdtemp(prefix='batch_', dir=ptempfile.base_dir())
+    orig_base_dir, ptempfile._base_dir = ptempfile._base_dir, tdir
+    os.chdir(cwd)
+    try:
+        ret = main(args, log=log)
+    except SystemExit as e:
+        ret = e.code if isinstance(e.code, int) else int(e.code is not None)
+    except Exception:
+        log.exception('Conversion failed')
+        ret = 1
+    finally:
+        ptempfile._base_dir = orig_base_dir
+        os.chdir(cwd)
+        ptempfile.remove_dir(tdir)
+    return ret, log.outputs[0].stream.getvalue()
+
+
+def main(args=sys.argv):
+    log = Log()
+    args = list(args)
+    if any(x in args for x in ('-h', '--help')):
+        prints(USAGE % (os.path.basename(args[0]), DEFAULT_MAX_MEMORY_GROWTH))
+        return 0
+    try:
+        path = pop_option(args, '--batch')
+        workers = int(pop_option(args, '--batch-workers', detect_ncpus()))
+        max_memory_growth = int(pop_option(args, '--batch-max-memory-growth', DEFAULT_MAX_MEMORY_GROWTH))
+        if path is None:
+            raise ValueError('No list of books specified')
+        books = read_batch_file(path)
+    except (ValueError, EnvironmentError) as err:
+        prints(USAGE % (os.path.basename(args[0]), DEFAULT_MAX_MEMORY_GROWTH))
+        log.error('\n' + unicode(err))
+        return 1
+    common_args, cwd = args[1:], os.getcwdu()
+    jobs = [(args[:1] + book + common_args, cwd) for book in books]
+    return run_batch(jobs, books, log, workers, max_memory_growth * 1024 * 1024 if max_memory_growth > 0 else None)
+
+
+def run_batch(jobs, books, log, workers, max_memory_growth):
+    from calibre.utils.ipc.pool import run_jobs, Failure
+    pending, failed = range(len(jobs)), []
+    while pending:
+        done = set()
+        try:
+            for i, (ret, output) in run_jobs(
+                    [jobs[j] for j in pending], 'calibre.ebooks.conversion.batch', 'convert_book',
+                    max_workers=workers, name='BatchConvert', max_memory_growth=max_memory_growth):
+                j = pending[i]
+                done.add(j)
+                prints(output)
+                if ret == 0:
+                    log(_('Converted %s') % books[j][0].decode('utf-8', 'replace'))
+                else:
+                    failed.append(j)
+                    log.error(_('Failed to convert %s') % books[j][0].decode('utf-8', 'replace'))
+        except Failure as err:
+            if err.job_id is None:
+                log.error(err.failure_message)
+                log.debug(err.details)
+                failed.extend(j for j in pending if j not in done)
+                break
+            # A worker crashed while converting a book, convert the remaining
+            # books in a new pool
+            j = pending[err.job_id]
+            done.add(j)
+            failed.append(j)
+            log.error(_('The worker process crashed while converting %s') % books[j][0].decode('utf-8', 'replace'))
+            log.debug(err.details)
+        pending = [j for j in pending if j not in done]
+    log(_('Converted %d of %d books') % (len(jobs) - len(failed), len(jobs)))
+    return 1 if failed else 0
+
+
+def find_tests():
+    import unittest
+    from calibre.ptempfile import TemporaryDirectory
+
+    class TestBatch(unittest.TestCase):
+
+        def test_pop_option(self):
+            args = ['ebook-convert', '--batch', 'list.txt', '--batch-workers=2', '--title', 'x']
+            self.assertEqual(pop_option(args, '--batch'), 'list.txt')
+            self.assertEqual(pop_option(args, '--batch-workers'), '2')
+            self.assertIsNone(pop_option(args, '--batch-max-memory-growth'))
+            self.assertEqual(pop_option(args, '--batch-max-memory-growth', 7), 7)
+            self.assertEqual(args, ['ebook-convert', '--title', 'x'])
+            self.assertRaises(ValueError, pop_option, ['x', '--batch'], '--batch')
+
+        def test_read_batch_file(self):
+            with TemporaryDirectory() as tdir:
+                path = os.path.join(tdir, 'list.txt')
+                with open(path, 'wb') as f:
+                    f.write(b'# A comment\n\n  a.epub a.mobi\n"my book.epub" out.azw3 --title "X Y"\n')
+                self.assertEqual(read_batch_file(path), [
+                    [b'a.epub', b'a.mobi'], [b'my book.epub', b'out.azw3', b'--title', b'X Y']])
+                with open(path, 'wb') as f:
+                    f.write(b'a.epub\n')
+                self.assertRaises(ValueError, read_batch_file, path)
+
+    return unittest.defaultTestLoader.loadTestsFromTestCase(TestBatch)
+
+
+if __name__ == '__main__':
+    from calibre.utils.run_tests import run_cli
+    run_cli(find_tests())
@@ -41,6 +41,9 @@ options. The available options depend on the input and output file types. \
 To get help on them specify the input and output file and then use the -h \
 option.
 
+To convert many books at once, use the --batch option, for details run:
+ebook-convert --batch -h
+
 For full documentation of the conversion system see
 ''') + localize_user_manual_link('https://manual.calibre-ebook.com/conversion.html')
 
@@ -250,6 +253,8 @@ def add_pipeline_options(parser, plumber):
                         [
                          'verbose',
                          'debug_pipeline',
+                         'profile_pipeline',
+                         'profile_pipeline_cprofile',
                          ])),
 
               ))
@@ -359,8 +364,11 @@ def read_sr_patterns(path, log=None):
     return json.dumps(pats)
 
 
-def main(args=sys.argv):
-    log = Log()
+def main(args=sys.argv, log=None):
+    if '--batch' in args[1:2] or any(x.startswith('--batch=') for x in args[1:2]):
+        from calibre.ebooks.conversion.batch import main
+        return main(args)
+    log = log or Log()
     parser, plumber = create_option_parser(args, log)
     opts, leftover_args = parser.parse_args(args)
     if len(leftover_args) > 3:
@@ -4,6 +4,7 @@ __copyright__ = '2009, Kovid Goyal <kovid@kovidgoyal.net>'
 __docformat__ = 'restructuredtext en'
 
 import os, re, sys, shutil, pprint, json
+from contextlib import contextmanager
 from functools import partial
 
 from calibre.customize.conversion import OptionRecommendation, DummyReporter
@@ -17,7 +18,8 @@ from calibre.utils.date import parse_date
 from calibre.utils.zipfile import ZipFile
 from calibre import (extract, walk, isbytestring, filesystem_encoding,
         get_types_map)
-from calibre.constants import __version__
+from calibre.constants import __version__, isosx
+from calibre.utils.monotonic import monotonic
 
 DEBUG_README=u'''
 This debug directory contains snapshots of the e-book as it passes through the
@@ -64,6 +66,88 @@ class CompositeProgressReporter(object):
         self.global_reporter(global_frac, msg)
 
 
+def peak_rss():
+    ' The peak resident memory used by this process so far, in bytes '
+    try:
+        import resource
+    except ImportError:
+        import psutil
+        return psutil.Process(os.getpid()).memory_info().peak_wset
+    ans = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return ans if isosx else ans * 1024
+
+
+class PipelineProfiler(object):
+
+    '''
+    Records the wall and CPU time, the memory used and the size of the book
+    for every stage of the conversion pipeline. Stages can be nested, the
+    results are saved to PROFILE_NAME in out_dir every time a stage ends, so
+    that they are available even if the conversion fails. If use_cprofile is
+    True, the Python profiler output for every top level stage is saved in
+    out_dir as well. Does nothing if out_dir is None.
+    '''
+
+    PROFILE_NAME = 'pipeline-profile.json'
+
+    def __init__(self, out_dir=None, use_cprofile=False, input_fmt=None, output_fmt=None, get_oeb=lambda: None):
+        self.out_dir, self.use_cprofile = out_dir, use_cprofile
+        self.input_fmt, self.output_fmt = input_fmt, output_fmt
+        self.get_oeb = get_oeb
+        self.stages, self.stack = [], []
+
+    def begin(self, name):
+        if self.out_dir is None:
+            return
+        from calibre.utils.mem import get_memory
+        stage = {'name': name, 'parent': self.stack[-1][0]['name'] if self.stack else None}
+        self.stages.append(stage)
+        profiler = None
+        if self.use_cprofile and not self.stack:
+            import cProfile
+            profiler = cProfile.Profile()
+            stage['cprofile'] = '%d-%s.prof' % (len(self.stages), name)
+        self.stack.append((stage, profiler, monotonic(), sum(os.times()[:2]), get_memory()))
+        if profiler is not None:
+            profiler.enable()
+
+    def end(self):
+        if self.out_dir is None or not self.stack:
+            return
+        stage, profiler, wall, cpu, rss = self.stack.pop()
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(os.path.join(self.out_dir, stage['cprofile']))
+        from calibre.utils.mem import get_memory
+        stage['wall_time'] = monotonic() - wall
+        stage['cpu_time'] = sum(os.times()[:2]) - cpu
+        stage['rss'] = get_memory()
+        stage['rss_delta'] = stage['rss'] - rss
+        stage['peak_rss'] = peak_rss()
+        oeb = self.get_oeb()
+        if hasattr(oeb, 'manifest'):
+            stage['manifest_items'] = len(oeb.manifest)
+            stage['spine_items'] = len(oeb.spine)
+        self.save()
+
+    @contextmanager
+    def __call__(self, name):
+        self.begin(name)
+        try:
+            yield
+        except:
+            if self.stack:
+                self.stack[-1][0]['failed'] = True
+            raise
+        finally:
+            self.end()
+
+    def save(self):
+        data = {'input_format': self.input_fmt, 'output_format': self.output_fmt, 'stages': self.stages}
+        with open(os.path.join(self.out_dir, self.PROFILE_NAME), 'wb') as f:
+            json.dump(data, f, indent=2, sort_keys=True)
+
+
 ARCHIVE_FMTS = ('zip', 'rar', 'oebzip')
 
 
@@ -124,6 +208,23 @@ OptionRecommendation(name='debug_pipeline',
                    'of the conversion process a bug is occurring.')
         ),
 
+OptionRecommendation(name='profile_pipeline',
+            recommended_value=None, level=OptionRecommendation.LOW,
+            help=_('Save the time taken and the memory used by the different '
+                   'stages of the conversion pipeline, and by each transform '
+                   'applied to the book, as JSON, to the file %s in the '
+                   'specified directory. Useful to find out which stage of '
+                   'the conversion process is slow.') % PipelineProfiler.PROFILE_NAME
+        ),
+
+OptionRecommendation(name='profile_pipeline_cprofile',
+            recommended_value=False, level=OptionRecommendation.LOW,
+            help=_('When used together with --profile-pipeline, also save the '
+                   'output of the Python profiler for each stage of the '
+                   'conversion pipeline, to the same directory. The output can '
+                   'be read with the Python pstats module.')
+        ),
+
 OptionRecommendation(name='input_profile',
             recommended_value='default', level=OptionRecommendation.LOW,
             choices=[x.short_name for x in input_profiles()],
@@ -1050,9 +1151,18 @@ OptionRecommendation(name='search_replace',
                 if os.path.exists(x):
                     shutil.rmtree(x)
 
+        if self.opts.profile_pipeline is not None:
+            self.opts.profile_pipeline = os.path.abspath(self.opts.profile_pipeline)
+            if not os.path.exists(self.opts.profile_pipeline):
+                os.makedirs(self.opts.profile_pipeline)
+        self.profile = profile = PipelineProfiler(
+            self.opts.profile_pipeline, self.opts.profile_pipeline_cprofile,
+            self.input_fmt, self.output_fmt, lambda: getattr(self, 'oeb', None))
+
         # Run any preprocess plugins
         from calibre.customize.ui import run_plugins_on_preprocess
-        self.input = run_plugins_on_preprocess(self.input)
+        with profile('preprocess'):
+            self.input = run_plugins_on_preprocess(self.input)
 
         self.flush()
         # Create an OEBBook from the input file. The input plugin does all the
@@ -1082,7 +1192,7 @@ OptionRecommendation(name='search_replace',
         self.input_plugin.report_progress = ir
         if self.for_regex_wizard:
             self.input_plugin.for_viewer = True
-        with self.input_plugin:
+        with profile('input'), self.input_plugin:
             self.oeb = self.input_plugin(stream, self.opts,
                                         self.input_fmt, self.log,
                                         accelerators, tdir)
@@ -1111,130 +1221,144 @@ OptionRecommendation(name='search_replace',
                     self.output_fmt)
 
         pr(0., _('Running transforms on e-book...'))
+        with profile('transforms'):
+            self.oeb.plumber_output_format = self.output_fmt or ''
+
+            from calibre.ebooks.oeb.transforms.data_url import DataURL
+            with profile('DataURL'):
+                DataURL()(self.oeb, self.opts)
+            from calibre.ebooks.oeb.transforms.guide import Clean
+            with profile('Clean'):
+                Clean()(self.oeb, self.opts)
+            pr(0.1)
+            self.flush()
 
-        self.oeb.plumber_output_format = self.output_fmt or ''
-
-        from calibre.ebooks.oeb.transforms.data_url import DataURL
-        DataURL()(self.oeb, self.opts)
-        from calibre.ebooks.oeb.transforms.guide import Clean
-        Clean()(self.oeb, self.opts)
-        pr(0.1)
-        self.flush()
-
-        self.opts.source = self.opts.input_profile
-        self.opts.dest = self.opts.output_profile
-
-        from calibre.ebooks.oeb.transforms.jacket import RemoveFirstImage
-        RemoveFirstImage()(self.oeb, self.opts, self.user_metadata)
-        from calibre.ebooks.oeb.transforms.metadata import MergeMetadata
-        MergeMetadata()(self.oeb, self.user_metadata, self.opts,
-                override_input_metadata=self.override_input_metadata)
-        pr(0.2)
-        self.flush()
+            self.opts.source = self.opts.input_profile
+            self.opts.dest = self.opts.output_profile
+
+            from calibre.ebooks.oeb.transforms.jacket import RemoveFirstImage
+            with profile('RemoveFirstImage'):
+                RemoveFirstImage()(self.oeb, self.opts, self.user_metadata)
+            from calibre.ebooks.oeb.transforms.metadata import MergeMetadata
+            with profile('MergeMetadata'):
+                MergeMetadata()(self.oeb, self.user_metadata, self.opts,
+                        override_input_metadata=self.override_input_metadata)
+            pr(0.2)
+            self.flush()
 
-        from calibre.ebooks.oeb.transforms.structure import DetectStructure
-        DetectStructure()(self.oeb, self.opts)
-        pr(0.35)
-        self.flush()
+            from calibre.ebooks.oeb.transforms.structure import DetectStructure
+            with profile('DetectStructure'):
+                DetectStructure()(self.oeb, self.opts)
+            pr(0.35)
+            self.flush()
 
-        if self.output_plugin.file_type not in ('epub', 'kepub'):
-            # Remove the toc reference to the html cover, if any, except for
-            # epub, as the epub output plugin will do the right thing with it.
-            item = getattr(self.oeb.toc, 'item_that_refers_to_cover', None)
-            if item is not None and item.count() == 0:
-                self.oeb.toc.remove(item)
-
-        from calibre.ebooks.oeb.transforms.flatcss import CSSFlattener
-        fbase = self.opts.base_font_size
-        if fbase < 1e-4:
-            fbase = float(self.opts.dest.fbase)
-        fkey = self.opts.font_size_mapping
-        if fkey is None:
-            fkey = self.opts.dest.fkey
-        else:
-            try:
-                fkey = map(float, fkey.split(','))
-            except:
-                self.log.error('Invalid font size key: %r ignoring'%fkey)
+            if self.output_plugin.file_type not in ('epub', 'kepub'):
+                # Remove the toc reference to the html cover, if any, except for
+                # epub, as the epub output plugin will do the right thing with it.
+                item = getattr(self.oeb.toc, 'item_that_refers_to_cover', None)
+                if item is not None and item.count() == 0:
+                    self.oeb.toc.remove(item)
+
+            from calibre.ebooks.oeb.transforms.flatcss import CSSFlattener
+            fbase = self.opts.base_font_size
+            if fbase < 1e-4:
+                fbase = float(self.opts.dest.fbase)
+            fkey = self.opts.font_size_mapping
+            if fkey is None:
                 fkey = self.opts.dest.fkey
+            else:
+                try:
+                    fkey = map(float, fkey.split(','))
+                except:
+                    self.log.error('Invalid font size key: %r ignoring'%fkey)
+                    fkey = self.opts.dest.fkey
+
+            from calibre.ebooks.oeb.transforms.jacket import Jacket
+            with profile('Jacket'):
+                Jacket()(self.oeb, self.opts, self.user_metadata)
+            pr(0.4)
+            self.flush()
 
-        from calibre.ebooks.oeb.transforms.jacket import Jacket
-        Jacket()(self.oeb, self.opts, self.user_metadata)
-        pr(0.4)
-        self.flush()
-
-        if self.opts.debug_pipeline is not None:
-            out_dir = os.path.join(self.opts.debug_pipeline, 'structure')
-            self.dump_oeb(self.oeb, out_dir)
-            self.log('Structured HTML written to:', out_dir)
-
-        if self.opts.extra_css and os.path.exists(self.opts.extra_css):
-            self.opts.extra_css = open(self.opts.extra_css, 'rb').read()
-
-        oibl = self.opts.insert_blank_line
-        orps  = self.opts.remove_paragraph_spacing
-        if self.output_plugin.file_type == 'lrf':
-            self.opts.insert_blank_line = False
-            self.opts.remove_paragraph_spacing = False
-        line_height = self.opts.line_height
-        if line_height < 1e-4:
-            line_height = None
-
-        if self.opts.linearize_tables and \
-                self.output_plugin.file_type not in ('mobi', 'lrf'):
-            from calibre.ebooks.oeb.transforms.linearize_tables import LinearizeTables
-            LinearizeTables()(self.oeb, self.opts)
-
-        if self.opts.unsmarten_punctuation:
-            from calibre.ebooks.oeb.transforms.unsmarten import UnsmartenPunctuation
-            UnsmartenPunctuation()(self.oeb, self.opts)
-
-        mobi_file_type = getattr(self.opts, 'mobi_file_type', 'old')
-        needs_old_markup = (self.output_plugin.file_type == 'lit' or
-                    (self.output_plugin.file_type == 'mobi' and mobi_file_type == 'old'))
-        transform_css_rules = ()
-        if self.opts.transform_css_rules:
-            transform_css_rules = self.opts.transform_css_rules
-            if isinstance(transform_css_rules, basestring):
-                transform_css_rules = json.loads(transform_css_rules)
-        flattener = CSSFlattener(fbase=fbase, fkey=fkey,
-                lineh=line_height,
-                untable=needs_old_markup,
-                unfloat=needs_old_markup,
-                page_break_on_body=self.output_plugin.file_type in ('mobi',
-                    'lit'),
-                transform_css_rules=transform_css_rules,
-                specializer=partial(self.output_plugin.specialize_css_for_output,
-                    self.log, self.opts))
-        flattener(self.oeb, self.opts)
-        self.opts._final_base_font_size = fbase
-
-        self.opts.insert_blank_line = oibl
-        self.opts.remove_paragraph_spacing = orps
-
-        from calibre.ebooks.oeb.transforms.page_margin import \
-            RemoveFakeMargins, RemoveAdobeMargins
-        RemoveFakeMargins()(self.oeb, self.log, self.opts)
-        RemoveAdobeMargins()(self.oeb, self.log, self.opts)
-
-        if self.opts.embed_all_fonts:
-            from calibre.ebooks.oeb.transforms.embed_fonts import EmbedFonts
-            EmbedFonts()(self.oeb, self.log, self.opts)
-
-        if self.opts.subset_embedded_fonts and self.output_plugin.file_type != 'pdf':
-            from calibre.ebooks.oeb.transforms.subset import SubsetFonts
-            SubsetFonts()(self.oeb, self.log, self.opts)
-
-        pr(0.9)
-        self.flush()
+            if self.opts.debug_pipeline is not None:
+                out_dir = os.path.join(self.opts.debug_pipeline, 'structure')
+                self.dump_oeb(self.oeb, out_dir)
+                self.log('Structured HTML written to:', out_dir)
+
+            if self.opts.extra_css and os.path.exists(self.opts.extra_css):
+                self.opts.extra_css = open(self.opts.extra_css, 'rb').read()
+
+            oibl = self.opts.insert_blank_line
+            orps  = self.opts.remove_paragraph_spacing
+            if self.output_plugin.file_type == 'lrf':
+                self.opts.insert_blank_line = False
+                self.opts.remove_paragraph_spacing = False
+            line_height = self.opts.line_height
+            if line_height < 1e-4:
+                line_height = None
+
+            if self.opts.linearize_tables and \
+                    self.output_plugin.file_type not in ('mobi', 'lrf'):
+                from calibre.ebooks.oeb.transforms.linearize_tables import LinearizeTables
+                with profile('LinearizeTables'):
+                    LinearizeTables()(self.oeb, self.opts)
+
+            if self.opts.unsmarten_punctuation:
+                from calibre.ebooks.oeb.transforms.unsmarten import UnsmartenPunctuation
+                with profile('UnsmartenPunctuation'):
+                    UnsmartenPunctuation()(self.oeb, self.opts)
+
+            mobi_file_type = getattr(self.opts, 'mobi_file_type', 'old')
+            needs_old_markup = (self.output_plugin.file_type == 'lit' or
+                        (self.output_plugin.file_type == 'mobi' and mobi_file_type == 'old'))
+            transform_css_rules = ()
+            if self.opts.transform_css_rules:
+                transform_css_rules = self.opts.transform_css_rules
+                if isinstance(transform_css_rules, basestring):
+                    transform_css_rules = json.loads(transform_css_rules)
+            flattener = CSSFlattener(fbase=fbase, fkey=fkey,
+                    lineh=line_height,
+                    untable=needs_old_markup,
+                    unfloat=needs_old_markup,
+                    page_break_on_body=self.output_plugin.file_type in ('mobi',
+                        'lit'),
+                    transform_css_rules=transform_css_rules,
+                    specializer=partial(self.output_plugin.specialize_css_for_output,
+                        self.log, self.opts))
+            with profile('CSSFlattener'):
+                flattener(self.oeb, self.opts)
+            self.opts._final_base_font_size = fbase
+
+            self.opts.insert_blank_line = oibl
+            self.opts.remove_paragraph_spacing = orps
+
+            from calibre.ebooks.oeb.transforms.page_margin import \
+                RemoveFakeMargins, RemoveAdobeMargins
+            with profile('RemoveFakeMargins'):
+                RemoveFakeMargins()(self.oeb, self.log, self.opts)
+            with profile('RemoveAdobeMargins'):
+                RemoveAdobeMargins()(self.oeb, self.log, self.opts)
+
+            if self.opts.embed_all_fonts:
+                from calibre.ebooks.oeb.transforms.embed_fonts import EmbedFonts
+                with profile('EmbedFonts'):
+                    EmbedFonts()(self.oeb, self.log, self.opts)
+
+            if self.opts.subset_embedded_fonts and self.output_plugin.file_type != 'pdf':
+                from calibre.ebooks.oeb.transforms.subset import SubsetFonts
+                with profile('SubsetFonts'):
+                    SubsetFonts()(self.oeb, self.log, self.opts)
+
+            pr(0.9)
+            self.flush()
 
-        from calibre.ebooks.oeb.transforms.trimmanifest import ManifestTrimmer
+            from calibre.ebooks.oeb.transforms.trimmanifest import ManifestTrimmer
 
-        self.log.info('Cleaning up manifest...')
-        trimmer = ManifestTrimmer()
-        trimmer(self.oeb, self.opts)
+            self.log.info('Cleaning up manifest...')
+            trimmer = ManifestTrimmer()
+            with profile('ManifestTrimmer'):
+                trimmer(self.oeb, self.opts)
 
-        self.oeb.toc.rationalize_play_orders()
+            self.oeb.toc.rationalize_play_orders()
         pr(1.)
         self.flush()
 
@@ -1247,12 +1371,13 @@ OptionRecommendation(name='search_replace',
         our = CompositeProgressReporter(0.67, 1., self.ui_reporter)
         self.output_plugin.report_progress = our
         our(0., _('Running %s plugin')%self.output_plugin.name)
-        with self.output_plugin:
+        with profile('output'), self.output_plugin:
             self.output_plugin.convert(self.oeb, self.output, self.input_plugin,
                 self.opts, self.log)
         self.oeb.clean_temp_files()
         self.ui_reporter(1.)
-        run_plugins_on_postprocess(self.output, self.output_fmt)
+        with profile('postprocess'):
+            run_plugins_on_postprocess(self.output, self.output_fmt)
 
         self.log(self.output_fmt.upper(), 'output written to', self.output)
         self.flush()
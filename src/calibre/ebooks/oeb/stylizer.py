@@ -9,6 +9,8 @@ __license__   = 'GPL v3'
 __copyright__ = '2008, Marshall T. Vandegrift <llasram@gmail.com>'
 
 import os, re, logging, copy, unicodedata
+from collections import OrderedDict, namedtuple
+from urlparse import urldefrag
 from weakref import WeakKeyDictionary
 from xml.dom import SyntaxErr as CSSSyntaxError
 from cssutils.css import (CSSStyleRule, CSSPageRule, CSSFontFaceRule,
@@ -19,11 +21,14 @@ from calibre import force_unicode, as_unicode
 from calibre.ebooks import unit_convert
 from calibre.ebooks.oeb.base import XHTML, XHTML_NS, CSS_MIME, OEB_STYLES, xpath, urlnormalize
 from calibre.ebooks.oeb.normalize_css import DEFAULTS, normalizers
-from css_selectors import Select, SelectorError, INAPPROPRIATE_PSEUDO_CLASSES
+from css_selectors import Select, SelectorIndex, SelectorError, INAPPROPRIATE_PSEUDO_CLASSES
 from tinycss.media3 import CSSMedia3Parser
 
 cssutils_log.setLevel(logging.WARN)
 
+CSSCache = namedtuple('CSSCache', 'parsed flattened')
+FlattenedSheet = namedtuple('FlattenedSheet', 'rules page_rule font_face_rules num_rules')
+
 _html_css_stylesheet = None
 
 
@@ -96,6 +101,9 @@ def test_media_ok():
 
 class Stylizer(object):
     STYLESHEETS = WeakKeyDictionary()
+    SELECTOR_INDICES = WeakKeyDictionary()
+    CSS_CACHES = WeakKeyDictionary()
+    SELECTOR_INDEX_CACHE_SIZE = 10
 
     def __init__(self, tree, path, oeb, opts, profile=None,
             extra_css='', user_css='', base_css=''):
@@ -118,17 +126,19 @@ class Stylizer(object):
         item = oeb.manifest.hrefs[path]
         basename = os.path.basename(path)
         cssname = os.path.splitext(basename)[0] + '.css'
-        stylesheets = [html_css_stylesheet()]
+        css_cache = self.css_cache()
+        # Each entry is (stylesheet, href, key) where key identifies the
+        # contents of stylesheets that are cached for the whole book, so that
+        # they are flattened only once
+        stylesheets = [(html_css_stylesheet(), None, ('html.css',))]
         if base_css:
-            stylesheets.append(parseString(base_css, validate=False))
+            key = ('base_css', base_css)
+            stylesheet = css_cache.parsed.get(key)
+            if stylesheet is None:
+                stylesheet = css_cache.parsed[key] = parseString(base_css, validate=False)
+            stylesheets.append((stylesheet, stylesheet.href, key))
         style_tags = xpath(tree, '//*[local-name()="style" or local-name()="link"]')
 
-        # Add cssutils parsing profiles from output_profile
-        for profile in self.opts.output_profile.extra_css_modules:
-            cssprofiles.addProfile(profile['name'],
-                                        profile['props'],
-                                        profile['macros'])
-
         parser = CSSParser(fetcher=self._fetch_css_file,
                 log=logging.getLogger('calibre.css'))
         self.font_face_rules = []
@@ -144,12 +154,7 @@ class Stylizer(object):
                     if t:
                         text += u'\n\n' + force_unicode(t, u'utf-8')
                 if text:
-                    text = oeb.css_preprocessor(text)
-                    # We handle @import rules separately
-                    parser.setFetcher(lambda x: ('utf-8', b''))
-                    stylesheet = parser.parseString(text, href=cssname,
-                            validate=False)
-                    parser.setFetcher(self._fetch_css_file)
+                    stylesheet, key = self.parse_style_tag(parser, text, item, cssname)
                     for rule in stylesheet.cssRules:
                         if rule.type == rule.IMPORT_RULE:
                             ihref = item.abshref(rule.href)
@@ -163,14 +168,8 @@ class Stylizer(object):
                             if sitem.media_type not in OEB_STYLES:
                                 self.logger.warn('CSS @import of non-CSS file %r' % rule.href)
                                 continue
-                            stylesheets.append(sitem.data)
-                    for rule in tuple(stylesheet.cssRules.rulesOfType(CSSRule.PAGE_RULE)):
-                        stylesheet.cssRules.remove(rule)
-                    # Make links to resources absolute, since these rules will
-                    # be folded into a stylesheet at the root
-                    replaceUrls(stylesheet, item.abshref,
-                            ignoreImportRules=True)
-                    stylesheets.append(stylesheet)
+                            stylesheets.append((sitem.data, sitem.data.href, None))
+                    stylesheets.append((stylesheet, cssname, key))
             elif (elem.tag == XHTML('link') and elem.get('href') and
                   elem.get('rel', 'stylesheet').lower() == 'stylesheet' and
                   elem.get('type', CSS_MIME).lower() in OEB_STYLES and
@@ -189,45 +188,63 @@ class Stylizer(object):
                     'Stylesheet %r referenced by file %r is not CSS'%(path,
                         item.href))
                     continue
-                stylesheets.append(sitem.data)
+                stylesheets.append((sitem.data, sitem.data.href, None))
         csses = {'extra_css':extra_css, 'user_css':user_css}
         for w, x in csses.items():
             if x:
-                try:
-                    text = x
-                    stylesheet = parser.parseString(text, href=cssname,
-                            validate=False)
-                    stylesheets.append(stylesheet)
-                except:
-                    self.logger.exception('Failed to parse %s, ignoring.'%w)
-                    self.logger.debug('Bad css: ')
-                    self.logger.debug(x)
+                key = ('css', x)
+                stylesheet = css_cache.parsed.get(key)
+                if stylesheet is None:
+                    try:
+                        text = x
+                        stylesheet = parser.parseString(text, href=cssname,
+                                validate=False)
+                    except:
+                        self.logger.exception('Failed to parse %s, ignoring.'%w)
+                        self.logger.debug('Bad css: ')
+                        self.logger.debug(x)
+                        continue
+                    css_cache.parsed[key] = stylesheet
+                stylesheets.append((stylesheet, cssname, key))
         rules = []
         index = 0
         self.stylesheets = set()
         self.page_rule = {}
-        for sheet_index, stylesheet in enumerate(stylesheets):
-            href = stylesheet.href
+        flatten_key = (getattr(self.opts, 'change_justification', None), tuple(sorted(self.profile.fnames.iteritems())))
+        for sheet_index, (stylesheet, href, key) in enumerate(stylesheets):
             self.stylesheets.add(href)
-            for rule in stylesheet.cssRules:
-                if rule.type == rule.MEDIA_RULE:
-                    if media_ok(rule.media.mediaText):
-                        for subrule in rule.cssRules:
-                            rules.extend(self.flatten_rule(subrule, href, index, is_user_agent_sheet=sheet_index==0))
-                            index += 1
-                else:
-                    rules.extend(self.flatten_rule(rule, href, index, is_user_agent_sheet=sheet_index==0))
-                    index = index + 1
+            is_user_agent_sheet = sheet_index == 0
+            if key is None:
+                flat = self.flatten_stylesheet(stylesheet, is_user_agent_sheet)
+            else:
+                key += (is_user_agent_sheet,) + flatten_key
+                flat = css_cache.flattened.get(key)
+                if flat is None:
+                    flat = css_cache.flattened[key] = self.flatten_stylesheet(stylesheet, is_user_agent_sheet)
+            for specificity, selector, style, text in flat.rules:
+                rules.append((specificity[:-1] + (specificity[-1] + index,), selector, style, text, href))
+            self.page_rule.update(flat.page_rule)
+            self.font_face_rules.extend(flat.font_face_rules)
+            index += flat.num_rules
         rules.sort()
         self.rules = rules
         self._styles = {}
         pseudo_pat = re.compile(ur':{1,2}(%s)' % ('|'.join(INAPPROPRIATE_PSEUDO_CLASSES)), re.I)
         select = Select(tree, ignore_inappropriate_pseudo_classes=True)
+        index = self.selector_index(rules)
+        candidates = select.candidate_selectors(index)
 
-        for _, _, cssdict, text, _ in rules:
+        for i, (_, _, cssdict, text, _) in enumerate(rules):
+            err = index.errors.get(i)
+            if err is not None:
+                self.logger.error('Ignoring CSS rule with invalid selector: %r (%s)' % (text, as_unicode(err)))
+                continue
+            if i not in candidates:
+                # The id, class or tag this rule needs is not in this file
+                continue
             fl = pseudo_pat.search(text)
             try:
-                matches = tuple(select(text))
+                matches = tuple(select.select_parsed(index.parsed[i]))
             except SelectorError as err:
                 self.logger.error('Ignoring CSS rule with invalid selector: %r (%s)' % (text, as_unicode(err)))
                 continue
@@ -290,6 +307,21 @@ class Stylizer(object):
                 if upd:
                     style._update_cssdict(upd)
 
+    def selector_index(self, rules):
+        # The selectors of the rules are parsed and indexed once for all the
+        # files in the book that use the same stylesheets
+        key = tuple(r[3] for r in rules)
+        cache = self.SELECTOR_INDICES.get(self.oeb)
+        if cache is None:
+            cache = self.SELECTOR_INDICES[self.oeb] = OrderedDict()
+        index = cache.pop(key, None)
+        if index is None:
+            index = SelectorIndex(key)
+        cache[key] = index
+        if len(cache) > self.SELECTOR_INDEX_CACHE_SIZE:
+            cache.popitem(last=False)
+        return index
+
     def _fetch_css_file(self, path):
         hrefs = self.oeb.manifest.hrefs
         if path not in hrefs:
@@ -302,7 +334,70 @@ class Stylizer(object):
         data = item.data.cssText
         return ('utf-8', data)
 
-    def flatten_rule(self, rule, href, index, is_user_agent_sheet=False):
+    def css_cache(self):
+        # Stylesheets are parsed and flattened once for the lifetime of the
+        # book, which is the whole conversion
+        ans = self.CSS_CACHES.get(self.oeb)
+        if ans is None:
+            ans = self.CSS_CACHES[self.oeb] = CSSCache({}, {})
+            # Add cssutils parsing profiles from output_profile
+            for profile in self.opts.output_profile.extra_css_modules:
+                cssprofiles.addProfile(profile['name'],
+                                            profile['props'],
+                                            profile['macros'])
+        return ans
+
+    def parse_style_tag(self, parser, text, item, cssname):
+        ''' Return the parsed stylesheet for the contents of a <style> tag in
+        item, and the key under which it is cached. The same <style> tag in
+        other files in the same directory re-uses the parsed stylesheet. '''
+        css_cache = self.css_cache()
+        dir_key, item_key = ('style', os.path.dirname(item.href), text), ('style', item.href, text)
+        for key in (dir_key, item_key):
+            stylesheet = css_cache.parsed.get(key)
+            if stylesheet is not None:
+                return stylesheet, key
+        text = self.oeb.css_preprocessor(text)
+        # We handle @import rules separately
+        parser.setFetcher(lambda x: ('utf-8', b''))
+        stylesheet = parser.parseString(text, href=cssname,
+                validate=False)
+        parser.setFetcher(self._fetch_css_file)
+        for rule in tuple(stylesheet.cssRules.rulesOfType(CSSRule.PAGE_RULE)):
+            stylesheet.cssRules.remove(rule)
+        # Make links to resources absolute, since these rules will
+        # be folded into a stylesheet at the root. Links to item itself mean
+        # the stylesheet cannot be re-used for other files.
+        self_links = []
+
+        def replace_url(url):
+            if not urldefrag(url)[0]:
+                self_links.append(url)
+            return item.abshref(url)
+        replaceUrls(stylesheet, replace_url, ignoreImportRules=True)
+        key = item_key if self_links else dir_key
+        css_cache.parsed[key] = stylesheet
+        return stylesheet, key
+
+    def flatten_stylesheet(self, stylesheet, is_user_agent_sheet=False):
+        ''' Return the flattened style rules of stylesheet, with rule indices
+        relative to the start of the stylesheet, its @page style and its
+        @font-face rules. '''
+        rules, page_rule, font_face_rules = [], {}, []
+        index = 0
+        for rule in stylesheet.cssRules:
+            if rule.type == rule.MEDIA_RULE:
+                if not media_ok(rule.media.mediaText):
+                    continue
+                subrules = rule.cssRules
+            else:
+                subrules = (rule,)
+            for subrule in subrules:
+                rules.extend(self.flatten_rule(subrule, index, page_rule, font_face_rules, is_user_agent_sheet=is_user_agent_sheet))
+                index += 1
+        return FlattenedSheet(rules, page_rule, font_face_rules, index)
+
+    def flatten_rule(self, rule, index, page_rule, font_face_rules, is_user_agent_sheet=False):
         results = []
         sheet_index = 0 if is_user_agent_sheet else 1
         if isinstance(rule, CSSStyleRule):
@@ -311,16 +406,16 @@ class Stylizer(object):
                 specificity = (sheet_index,) + selector.specificity + (index,)
                 text = selector.selectorText
                 selector = list(selector.seq)
-                results.append((specificity, selector, style, text, href))
+                results.append((specificity, selector, style, text))
         elif isinstance(rule, CSSPageRule):
             style = self.flatten_style(rule.style)
-            self.page_rule.update(style)
+            page_rule.update(style)
         elif isinstance(rule, CSSFontFaceRule):
             if rule.style.length > 1:
                 # Ignore the meaningless font face rules generated by the
                 # benighted MS Word that contain only a font-family declaration
                 # and nothing else
-                self.font_face_rules.append(rule)
+                font_face_rules.append(rule)
         return results
 
     def flatten_style(self, cssstyle):
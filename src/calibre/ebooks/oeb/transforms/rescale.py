@@ -8,13 +8,52 @@ __docformat__ = 'restructuredtext en'
 
 from calibre import fit_image
 
+# Books with fewer images to rescale than this many per worker process are
+# rescaled in a single process, as starting worker processes has a significant
+# overhead
+IMAGES_PER_WORKER = 10
+# Larger images are rescaled in the main process, as they are too large to be
+# sent to worker processes
+MAX_WORKER_IMAGE_SIZE = 10 * 1024 * 1024
+
+
+def rescale_image(href, raw, ext, new_width, new_height, convert_to_rgb=False):
+    ''' Resize the image raw to new_width x new_height and return it in the
+    format ext, along with a list of (log level, message) tuples. The returned
+    image is None if it could not be resized. Can be run in a worker process. '''
+    from PIL import Image
+    from io import BytesIO
+    messages = []
+    img = Image.open(BytesIO(raw))
+    if convert_to_rgb:
+        try:
+            img = img.convert('RGB')
+        except Exception:
+            import traceback
+            messages.append(('error', 'Failed to convert image %s from CMYK to RGB\n%s' % (href, traceback.format_exc())))
+    try:
+        img = img.resize((new_width, new_height))
+    except Exception:
+        import traceback
+        messages.append(('error', 'Failed to rescale image: %s\n%s' % (href, traceback.format_exc())))
+        return None, messages
+    buf = BytesIO()
+    try:
+        img.save(buf, ext)
+    except Exception:
+        import traceback
+        messages.append(('error', 'Failed to rescale image: %s\n%s' % (href, traceback.format_exc())))
+        return None, messages
+    return buf.getvalue(), messages
+
 
 class RescaleImages(object):
 
     'Rescale all images to fit inside given screen size'
 
-    def __init__(self, check_colorspaces=False):
+    def __init__(self, check_colorspaces=False, max_workers=None):
         self.check_colorspaces = check_colorspaces
+        self.max_workers = max_workers
 
     def __call__(self, oeb, opts):
         self.oeb, self.opts, self.log = oeb, opts, oeb.log
@@ -33,6 +72,9 @@ class RescaleImages(object):
             page_width -= (self.opts.margin_left + self.opts.margin_right) * self.opts.dest.dpi/72.
             page_height -= (self.opts.margin_top + self.opts.margin_bottom) * self.opts.dest.dpi/72.
 
+        # Only the image headers are read here, the images that need to be
+        # rescaled are decoded and resized by rescale_image()
+        jobs, items = [], []
         for item in self.oeb.manifest:
             if item.media_type.startswith('image'):
                 ext = item.media_type.split('/')[-1].upper()
@@ -51,14 +93,11 @@ class RescaleImages(object):
                     continue
                 width, height = img.size
 
-                try:
-                    if self.check_colorspaces and img.mode == 'CMYK':
-                        self.log.warn(
-                            'The image %s is in the CMYK colorspace, converting it '
-                            'to RGB as Adobe Digital Editions cannot display CMYK' % item.href)
-                        img = img.convert('RGB')
-                except Exception:
-                    self.log.exception('Failed to convert image %s from CMYK to RGB' % item.href)
+                convert_to_rgb = self.check_colorspaces and img.mode == 'CMYK'
+                if convert_to_rgb:
+                    self.log.warn(
+                        'The image %s is in the CMYK colorspace, converting it '
+                        'to RGB as Adobe Digital Editions cannot display CMYK' % item.href)
 
                 scaled, new_width, new_height = fit_image(width, height, page_width, page_height)
                 if scaled:
@@ -66,16 +105,30 @@ class RescaleImages(object):
                     new_height = max(1, new_height)
                     self.log('Rescaling image from %dx%d to %dx%d'%(
                         width, height, new_width, new_height), item.href)
-                    try:
-                        img = img.resize((new_width, new_height))
-                    except Exception:
-                        self.log.exception('Failed to rescale image: %s' % item.href)
-                        continue
-                    buf = BytesIO()
-                    try:
-                        img.save(buf, ext)
-                    except Exception:
-                        self.log.exception('Failed to rescale image: %s' % item.href)
-                    else:
-                        item.data = buf.getvalue()
-                        item.unload_data_from_memory()
+                    jobs.append((item.href, raw, ext, new_width, new_height, convert_to_rgb))
+                    items.append(item)
+
+        max_workers = self.max_workers
+        if max_workers is None:
+            from calibre import detect_ncpus
+            max_workers = min(detect_ncpus(), len(jobs) // IMAGES_PER_WORKER)
+        if max_workers > 1:
+            results = self.rescale_in_pool(jobs, max_workers)
+        else:
+            results = ((i, rescale_image(*job)) for i, job in enumerate(jobs))
+        for i, (data, messages) in results:
+            for level, msg in messages:
+                getattr(self.log, level)(msg)
+            if data is not None:
+                item = items[i]
+                item.data = data
+                item.unload_data_from_memory()
+
+    def rescale_in_pool(self, jobs, max_workers):
+        from calibre.utils.ipc.pool import run_jobs
+        in_pool = [i for i, job in enumerate(jobs) if len(job[1]) <= MAX_WORKER_IMAGE_SIZE]
+        for i, result in run_jobs([jobs[i] for i in in_pool], 'calibre.ebooks.oeb.transforms.rescale', 'rescale_image',
+                                  max_workers=max_workers, name='RescaleImages'):
+            yield in_pool[i], result
+        for i in sorted(frozenset(xrange(len(jobs))) - frozenset(in_pool)):
+            yield i, rescale_image(*jobs[i])
@@ -6,6 +6,8 @@ from __future__ import (unicode_literals, division, absolute_import,
 __license__ = 'GPL v3'
 __copyright__ = '2015, Kovid Goyal <kovid at kovidgoyal.net>'
 
+import json as jsonlib
+from base64 import urlsafe_b64decode, urlsafe_b64encode
 from functools import partial
 from future_builtins import zip
 from itertools import cycle
@@ -15,7 +17,9 @@ from calibre.library.field_metadata import category_icon_map
 from calibre.db.view import sanitize_sort_field_name
 from calibre.ebooks.metadata import title_sort
 from calibre.ebooks.metadata.book.json_codec import JsonCodec
-from calibre.srv.errors import HTTPNotFound, BookNotFound
+from calibre.srv.errors import HTTPBadRequest, HTTPNotFound, BookNotFound
+from calibre.srv.metadata import book_json_cache, book_json_version
+from calibre.srv.pool import SLOW_LANE
 from calibre.srv.routes import endpoint, json
 from calibre.srv.content import get as get_content, icon as get_icon
 from calibre.srv.utils import http_date, custom_fields_to_display, encode_name, decode_name, get_db
@@ -59,6 +63,16 @@ def category_icon(category, meta):  # {{{
 
 def book_to_json(ctx, rd, db, book_id,
                  get_category_urls=True, device_compatible=False, device_for_template=None):
+    cache = book_json_cache(db)
+    # The category URLs depend on the categories visible to the user, so
+    # include the user's restriction in the key
+    restriction = ctx.restriction_for(rd, db) if get_category_urls and not device_compatible else None
+    key = book_id, 'ajax', get_category_urls, device_compatible, device_for_template, prefs['output_format'], restriction
+    last_modified = db.field_for('last_modified', book_id)
+    version = book_json_version(db, last_modified)
+    data = cache.get(key, version)
+    if data is not None:
+        return data.copy(), last_modified
     mi = db.get_metadata(book_id, get_cover=False)
     codec = JsonCodec(db.field_metadata)
     if not device_compatible:
@@ -102,20 +116,20 @@ def book_to_json(ctx, rd, db, book_id,
         if get_category_urls:
             category_urls = data['category_urls'] = {}
             all_cats = ctx.get_categories(rd, db)
-            for key in mi.all_field_keys():
-                fm = mi.metadata_for_field(key)
+            for field in mi.all_field_keys():
+                fm = mi.metadata_for_field(field)
                 if (fm and fm['is_category'] and not fm['is_csp'] and
-                        key != 'formats' and fm['datatype'] != 'rating'):
-                    categories = mi.get(key) or []
+                        field != 'formats' and fm['datatype'] != 'rating'):
+                    categories = mi.get(field) or []
                     if isinstance(categories, basestring):
                         categories = [categories]
-                    category_urls[key] = dbtags = {}
+                    category_urls[field] = dbtags = {}
                     for category in categories:
-                        for tag in all_cats.get(key, ()):
+                        for tag in all_cats.get(field, ()):
                             if tag.original_name == category:
                                 dbtags[category] = ctx.url_for(
                                     books_in,
-                                    encoded_category=encode_name(tag.category if tag.category else key),
+                                    encoded_category=encode_name(tag.category if tag.category else field),
                                     encoded_item=encode_name(tag.original_name if tag.id is None else unicode(tag.id)),
                                     library_id=db.server_library_id
                                 )
@@ -139,7 +153,8 @@ def book_to_json(ctx, rd, db, book_id,
                             template, sanitize, path_type=posixpath)
                     break
 
-    return data, mi.last_modified
+    cache.set(key, version, data)
+    return data.copy(), mi.last_modified
 
 
 @endpoint('/ajax/book/{book_id}/{library_id=None}', postprocess=json)
@@ -235,7 +250,7 @@ def books(ctx, rd, library_id):
 # Categories (Tag Browser)  {{{
 
 
-@endpoint('/ajax/categories/{library_id=None}', postprocess=json)
+@endpoint('/ajax/categories/{library_id=None}', postprocess=json, lane=SLOW_LANE)
 def categories(ctx, rd, library_id):
     '''
     Return the list of top-level categories as a list of dictionaries. Each
@@ -528,7 +543,23 @@ def books_in(ctx, rd, encoded_category, encoded_item, library_id):
 # Search {{{
 
 
-def search_result(ctx, rd, db, query, num, offset, sort, sort_order, vl=''):
+def encode_cursor(query, sort, sort_order, vl, offset, last_book_id):
+    ' An opaque token that identifies the next page of a search result '
+    return urlsafe_b64encode(jsonlib.dumps([query, sort, sort_order, vl, offset, last_book_id])).decode('ascii')
+
+
+def decode_cursor(cursor):
+    try:
+        query, sort, sort_order, vl, offset, last_book_id = jsonlib.loads(urlsafe_b64decode(cursor.encode('ascii')))
+        return query, sort, sort_order, vl, int(offset), int(last_book_id)
+    except Exception:
+        raise HTTPBadRequest('Invalid cursor: %r' % cursor)
+
+
+def search_result(ctx, rd, db, query, num, offset, sort, sort_order, vl='', cursor=None):
+    after = None
+    if cursor:
+        query, sort, sort_order, vl, offset, after = decode_cursor(cursor)
     multisort = [(sanitize_sort_field_name(db.field_metadata, s), ensure_val(o, 'asc', 'desc') == 'asc')
                  for s, o in zip(sort.split(','), cycle(sort_order.split(',')))]
     skeys = db.field_metadata.sortable_field_keys()
@@ -536,10 +567,18 @@ def search_result(ctx, rd, db, query, num, offset, sort, sort_order, vl=''):
         if sfield not in skeys:
             raise HTTPNotFound('%s is not a valid sort field'%sort)
 
-    ids = ctx.search(rd, db, query, vl=vl)
-    ids = db.multisort(fields=multisort, ids_to_sort=ids)
-    total_num = len(ids)
-    ids = ids[offset:offset+num]
+    # The sorted list is cached by the search that produced it, so getting the
+    # next page neither runs the search nor looks at every book in it
+    sorted_books = ctx.sort_books(db, partial(ctx.search, rd, db, query, vl=vl), multisort,
+                                  search=ctx.search_version(rd, db, query, vl))
+    if after is not None:
+        # Resume after the last book on the previous page, even if books
+        # have been added or removed since then
+        pos = sorted_books.positions.get(after)
+        if pos is not None:
+            offset = pos + 1
+    total_num = len(sorted_books.book_ids)
+    ids = list(sorted_books.book_ids[offset:offset+num])
     return {
         'total_num': total_num, 'sort_order':sort_order,
         'offset':offset, 'num':len(ids), 'sort':sort,
@@ -548,6 +587,7 @@ def search_result(ctx, rd, db, query, num, offset, sort, sort_order, vl=''):
         'library_id': db.server_library_id,
         'book_ids':ids,
         'vl': vl,
+        'cursor': encode_cursor(query, sort, sort_order, vl, offset + len(ids), ids[-1]) if ids and offset + len(ids) < total_num else None,
     }
 
 
@@ -560,12 +600,16 @@ def search(ctx, rd, library_id):
     :func:`search_result`.
 
     Optional: ?num=100&offset=0&sort=title&sort_order=asc&query=&vl=
+
+    To get the next page of results, pass the cursor field of the returned
+    object as ?cursor=, it replaces all the other parameters except num.
     '''
     db = get_db(ctx, rd, library_id)
     query = rd.query.get('query')
     num, offset = get_pagination(rd.query)
     with db.safe_read_lock:
-        return search_result(ctx, rd, db, query, num, offset, rd.query.get('sort', 'title'), rd.query.get('sort_order', 'asc'), rd.query.get('vl') or '')
+        return search_result(ctx, rd, db, query, num, offset, rd.query.get('sort', 'title'), rd.query.get('sort_order', 'asc'),
+                             rd.query.get('vl') or '', cursor=rd.query.get('cursor'))
 
 # }}}
 
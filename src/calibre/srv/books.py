@@ -6,22 +6,26 @@ from __future__ import (unicode_literals, division, absolute_import,
                         print_function)
 from hashlib import sha1
 from functools import partial
-from threading import RLock, Lock
+from threading import RLock, Lock, Thread
 from cPickle import dumps
 from zipfile import ZipFile
-import errno, os, tempfile, shutil, time, json as jsonlib
+from Queue import Queue
+import errno, os, tempfile, time, json as jsonlib
 
 from lzma.xz import decompress
 from calibre.constants import cache_dir, iswindows
 from calibre.customize.ui import plugin_for_input_format
 from calibre.srv.metadata import book_as_json
-from calibre.srv.render_book import RENDER_VERSION
+from calibre.srv.render_book import RENDER_VERSION, read_progress
+from calibre.srv.render_cache import render_cache, safe_remove
 from calibre.srv.errors import HTTPNotFound, BookNotFound
+from calibre.srv.pool import SLOW_LANE
 from calibre.srv.routes import endpoint, json
 from calibre.srv.utils import get_library_data, get_db
+from calibre.utils.config import prefs
 
 cache_lock = RLock()
-queued_jobs = {}
+queued_jobs = {}  # book hash -> (job id, output directory)
 failed_jobs = {}
 
 
@@ -55,76 +59,129 @@ def book_hash(library_uuid, book_id, fmt, size, mtime):
     return sha1(raw).hexdigest().decode('ascii')
 
 
-staging_cleaned = False
+def get_render_cache(ctx):
+    return render_cache(books_cache_dir(), ctx.opts.max_render_cache_size)
 
 
-def safe_remove(x, is_file=None):
-    if is_file is None:
-        is_file = os.path.isfile(x)
-    try:
-        os.remove(x) if is_file else shutil.rmtree(x, ignore_errors=True)
-    except EnvironmentError:
-        pass
-
-
-def queue_job(ctx, copy_format_to, bhash, fmt, book_id, size, mtime):
-    global staging_cleaned
-    tdir = os.path.join(books_cache_dir(), 's')
-    if not staging_cleaned:
-        staging_cleaned = True
-        for x in os.listdir(tdir):
-            safe_remove(os.path.join(tdir, x))
-    fd, pathtoebook = tempfile.mkstemp(prefix='', suffix=('.' + fmt.lower()), dir=tdir)
-    with os.fdopen(fd, 'wb') as f:
-        copy_format_to(f)
-    tdir = tempfile.mkdtemp('', '', tdir)
-    job_id = ctx.start_job('Render book %s (%s)' % (book_id, fmt), 'calibre.srv.render_book', 'render', args=(
-        pathtoebook, tdir, {'size':size, 'mtime':mtime, 'hash':bhash}),
-        job_done_callback=job_done, job_data=(bhash, pathtoebook, tdir))
-    queued_jobs[bhash] = job_id
-    return job_id
-
+def format_hash(db, book_id, fmt):
+    fm = db.format_metadata(book_id, fmt)
+    if not fm:
+        return None, None, None
+    size, mtime = map(int, (fm['size'], time.mktime(fm['mtime'].utctimetuple())*10))
+    return book_hash(db.library_id, book_id, fmt, size, mtime), size, mtime
 
-last_final_clean_time = 0
 
-
-def clean_final(interval=24 * 60 * 60):
-    global last_final_clean_time
-    now = time.time()
-    if now - last_final_clean_time < interval:
+def queue_job(ctx, rcache, copy_format_to, bhash, fmt, book_id, size, mtime):
+    # Must be called with cache_lock held. Returns None if the book is being
+    # rendered by another server process.
+    if not rcache.claim(bhash):
         return
-    last_final_clean_time = now
-    fdir = os.path.join(books_cache_dir(), 'f')
-    for x in os.listdir(fdir):
-        try:
-            tm = os.path.getmtime(os.path.join(fdir, x,  'calibre-book-manifest.json'))
-        except EnvironmentError:
-            continue
-        if now - tm >= interval:
-            # This book has not been accessed for a long time, delete it
-            safe_remove(x)
+    tdir = rcache.staging_dir()
+    try:
+        fd, pathtoebook = tempfile.mkstemp(prefix='', suffix=('.' + fmt.lower()), dir=tdir)
+        with os.fdopen(fd, 'wb') as f:
+            copy_format_to(f)
+        tdir = tempfile.mkdtemp('', '', tdir)
+        job_id = ctx.start_job('Render book %s (%s)' % (book_id, fmt), 'calibre.srv.render_book', 'render', args=(
+            pathtoebook, tdir, {'size':size, 'mtime':mtime, 'hash':bhash}),
+            job_done_callback=job_done, job_data=(bhash, pathtoebook, tdir, rcache))
+    except Exception:
+        rcache.release(bhash)
+        raise
+    if job_id is None:  # The server is shutting down
+        rcache.release(bhash)
+        return
+    queued_jobs[bhash] = (job_id, tdir)
+    return job_id
 
 
 def job_done(job):
     with cache_lock:
-        bhash, pathtoebook, tdir = job.data
+        bhash, pathtoebook, tdir, rcache = job.data
         queued_jobs.pop(bhash, None)
         safe_remove(pathtoebook)
-        if job.failed:
-            failed_jobs[bhash] = (job.was_aborted, job.traceback)
-            safe_remove(tdir, False)
-        else:
-            try:
-                clean_final()
-                dest = os.path.join(books_cache_dir(), 'f', bhash)
-                safe_remove(dest, False)
-                os.rename(tdir, dest)
-            except Exception:
-                import traceback
-                failed_jobs[bhash] = (False, traceback.format_exc())
-
-
-@endpoint('/book-manifest/{book_id}/{fmt}', postprocess=json, types={'book_id':int})
+        try:
+            if job.failed:
+                failed_jobs[bhash] = (job.was_aborted, job.traceback)
+                safe_remove(tdir, False)
+            else:
+                try:
+                    rcache.add(bhash, tdir)
+                except Exception:
+                    import traceback
+                    failed_jobs[bhash] = (False, traceback.format_exc())
+        finally:
+            rcache.release(bhash)
+
+
+# Pre-rendering {{{
+
+prerender_queue = Queue()
+prerender_worker = None
+
+
+def preferred_format(db, book_id):
+    # Mirrors the choice of format made by the browser viewer
+    formats = [x.upper() for x in db.formats(book_id)]
+    fmt = prefs['output_format'].upper()
+    if fmt == 'PDF':
+        fmt = 'EPUB'
+    if fmt in formats:
+        return fmt
+    for fmt in sorted(formats):
+        if plugin_for_input_format(fmt) is not None:
+            return fmt
+
+
+def prerender_books(ctx, library_id, book_ids):
+    ''' Render the specified books, in the background, so that they open
+    instantly in the browser viewer. '''
+    global prerender_worker
+    with cache_lock:
+        if prerender_worker is None:
+            prerender_worker = Thread(target=run_prerender, name='PrerenderBooks')
+            prerender_worker.daemon = True
+            prerender_worker.start()
+    # book_ids can be a function that returns the book ids, when they can only
+    # be known once the library has been loaded
+    prerender_queue.put((ctx, library_id, book_ids if callable(book_ids) else tuple(book_ids)))
+
+
+def prerender_recent_books(ctx):
+    ' Render the most recently added books in the default library '
+    def recent_books(db):
+        return db.multisort([('timestamp', False)])[:ctx.opts.prerender_recent_books]
+    prerender_books(ctx, None, recent_books)
+
+
+def run_prerender():
+    while True:
+        ctx, library_id, book_ids = prerender_queue.get()
+        try:
+            db = ctx.library_broker.get(library_id)
+            if db is None:
+                continue
+            db = getattr(db, 'new_api', db)
+            if callable(book_ids):
+                book_ids = book_ids(db)
+            rcache = get_render_cache(ctx)
+            for book_id in book_ids:
+                with db.safe_read_lock:
+                    fmt = preferred_format(db, book_id)
+                    if fmt is None:
+                        continue
+                    bhash, size, mtime = format_hash(db, book_id, fmt)
+                    if bhash is None or os.path.exists(os.path.join(rcache.final_dir, bhash)):
+                        continue
+                    with cache_lock:
+                        if bhash not in queued_jobs:
+                            queue_job(ctx, rcache, partial(db.copy_format_to, book_id, fmt), bhash, fmt, book_id, size, mtime)
+        except Exception:
+            ctx.log.exception('Failed to prerender books')
+# }}}
+
+
+@endpoint('/book-manifest/{book_id}/{fmt}', postprocess=json, types={'book_id':int}, lane=SLOW_LANE)
 def book_manifest(ctx, rd, book_id, fmt):
     db, library_id = get_library_data(ctx, rd)[:2]
     force_reload = rd.query.get('force_reload') == '1'
@@ -133,34 +190,34 @@ def book_manifest(ctx, rd, book_id, fmt):
     if not ctx.has_id(rd, db, book_id):
         raise BookNotFound(book_id, db)
     with db.safe_read_lock:
-        fm = db.format_metadata(book_id, fmt)
-        if not fm:
+        bhash, size, mtime = format_hash(db, book_id, fmt)
+        if bhash is None:
             raise HTTPNotFound('No %s format for the book (id:%s) in the library: %s' % (fmt, book_id, library_id))
-        size, mtime = map(int, (fm['size'], time.mktime(fm['mtime'].utctimetuple())*10))
-        bhash = book_hash(db.library_id, book_id, fmt, size, mtime)
+        rcache = get_render_cache(ctx)
         with cache_lock:
-            mpath = abspath(os.path.join(books_cache_dir(), 'f', bhash, 'calibre-book-manifest.json'))
-            if force_reload:
-                safe_remove(mpath, True)
-            try:
-                os.utime(mpath, None)
-                with lopen(mpath, 'rb') as f:
-                    ans = jsonlib.load(f)
+            if force_reload and bhash not in queued_jobs:
+                rcache.remove(bhash)
+            ans = rcache.manifest(bhash)
+            if ans is not None:
                 ans['metadata'] = book_as_json(db, book_id)
                 user = rd.username or None
                 ans['last_read_positions'] = db.get_last_read_positions(book_id, fmt, user)
                 return ans
-            except EnvironmentError as e:
-                if e.errno != errno.ENOENT:
-                    raise
             x = failed_jobs.pop(bhash, None)
             if x is not None:
                 return {'aborted':x[0], 'traceback':x[1], 'job_status':'finished'}
-            job_id = queued_jobs.get(bhash)
+            job_id, tdir = queued_jobs.get(bhash, (None, None))
             if job_id is None:
-                job_id = queue_job(ctx, partial(db.copy_format_to, book_id, fmt), bhash, fmt, book_id, size, mtime)
+                job_id = queue_job(ctx, rcache, partial(db.copy_format_to, book_id, fmt), bhash, fmt, book_id, size, mtime)
+                if job_id is None:
+                    # Being rendered by another server process, the client
+                    # will keep asking for the manifest till it is done
+                    return {'aborted':False, 'traceback':None, 'job_status':'running', 'job_id':None}
     status, result, tb, aborted = ctx.job_status(job_id)
-    return {'aborted': aborted, 'traceback':tb, 'job_status':status, 'job_id':job_id}
+    ans = {'aborted': aborted, 'traceback':tb, 'job_status':status, 'job_id':job_id}
+    if status == 'running' and tdir is not None:
+        ans['progress'] = read_progress(tdir)
+    return ans
 
 
 @endpoint('/book-file/{book_id}/{fmt}/{size}/{mtime}/{+name}', types={'book_id':int, 'size':int, 'mtime':int})
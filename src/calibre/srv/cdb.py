@@ -9,6 +9,7 @@ from functools import partial
 from calibre import as_unicode
 from calibre.db.cli import module_for_cmd
 from calibre.srv.errors import HTTPBadRequest, HTTPNotFound, HTTPForbidden
+from calibre.srv.pool import SLOW_LANE
 from calibre.srv.routes import endpoint, msgpack_or_json
 from calibre.srv.utils import get_library_data
 from calibre.utils.serialize import MSGPACK_MIME, json_loads, msgpack_loads
@@ -16,7 +17,7 @@ from calibre.utils.serialize import MSGPACK_MIME, json_loads, msgpack_loads
 receive_data_methods = {'GET', 'POST'}
 
 
-@endpoint('/cdb/cmd/{which}/{version=0}', postprocess=msgpack_or_json, methods=receive_data_methods)
+@endpoint('/cdb/cmd/{which}/{version=0}', postprocess=msgpack_or_json, methods=receive_data_methods, lane=SLOW_LANE)
 def cdb_run(ctx, rd, which, version):
     try:
         m = module_for_cmd(which)
@@ -23,6 +23,7 @@ from calibre.srv.errors import (
 from calibre.srv.metadata import (
     book_as_json, categories_as_json, categories_settings, icon_map
 )
+from calibre.srv.pool import SLOW_LANE
 from calibre.srv.routes import endpoint, json
 from calibre.srv.utils import get_library_data, get_use_roman
 from calibre.utils.config import prefs, tweaks
@@ -247,7 +248,9 @@ def interface_data(ctx, rd):
 def more_books(ctx, rd):
     '''
     Get more results from the specified search-query, which must
-    be specified as JSON in the request body.
+    be specified as JSON in the request body. Instead of the search-query,
+    the body can contain the cursor from a previous search result, as
+    {"cursor": cursor}.
 
     Optional: ?num=50&library_id=<default library>
     '''
@@ -259,9 +262,13 @@ def more_books(ctx, rd):
         raise HTTPNotFound('Invalid number of books: %r' % rd.query.get('num'))
     try:
         search_query = load_json_file(rd.request_body_file)
-        query, offset, sorts, orders, vl = search_query['query'], search_query[
-            'offset'
-        ], search_query['sort'], search_query['sort_order'], search_query['vl']
+        cursor = search_query.get('cursor')
+        if cursor:
+            query = offset = sorts = orders = vl = None
+        else:
+            query, offset, sorts, orders, vl = search_query['query'], search_query[
+                'offset'
+            ], search_query['sort'], search_query['sort_order'], search_query['vl']
     except KeyError as err:
         raise HTTPBadRequest('Search query missing key: %s' % as_unicode(err))
     except Exception as err:
@@ -269,7 +276,7 @@ def more_books(ctx, rd):
     ans = {}
     with db.safe_read_lock:
         ans['search_result'] = search_result(
-            ctx, rd, db, query, num, offset, sorts, orders, vl
+            ctx, rd, db, query, num, offset, sorts, orders, vl, cursor=cursor
         )
         mdata = ans['metadata'] = {}
         for book_id in ans['search_result']['book_ids']:
@@ -351,7 +358,7 @@ def book_metadata(ctx, rd, book_id):
     return data
 
 
-@endpoint('/interface-data/tag-browser')
+@endpoint('/interface-data/tag-browser', lane=SLOW_LANE)
 def tag_browser(ctx, rd):
     '''
     Get the Tag Browser serialized as JSON
@@ -14,7 +14,7 @@ from future_builtins import map
 from functools import partial
 
 from calibre import fit_image
-from calibre.constants import config_dir, iswindows
+from calibre.constants import cache_dir, config_dir, iswindows
 from calibre.db.errors import NoSuchFormat
 from calibre.ebooks.covers import cprefs, override_prefs, scale_cover, generate_cover, set_use_roman
 from calibre.ebooks.metadata import authors_to_string
@@ -22,7 +22,9 @@ from calibre.ebooks.metadata.meta import set_metadata
 from calibre.ebooks.metadata.opf2 import metadata_to_opf
 from calibre.library.save_to_disk import find_plugboard
 from calibre.srv.errors import HTTPNotFound, BookNotFound
+from calibre.srv.pool import DEFAULT_LANE, SLOW_LANE
 from calibre.srv.routes import endpoint, json
+from calibre.srv.thumbnails import thumbnail_store
 from calibre.srv.utils import http_date, get_db, get_use_roman
 from calibre.utils.config_base import tweaks
 from calibre.utils.date import timestampfromdt
@@ -136,11 +138,34 @@ def generated_cover(ctx, rd, library_id, db, book_id, width=None, height=None):
     return create_file_copy(ctx, rd, prefix, library_id, book_id, 'jpg', mtime, partial(write_generated_cover, db, book_id, width, height))
 
 
+def stored_thumbnail(ctx, rd, library_id, db, book_id, width, height, prefix, mtime):
+    if ctx.testing:
+        location = os.path.join(rd.tdir, 'thumbnails')
+    else:
+        location = os.path.join(cache_dir(), 'srv-thumbnails')
+    store = thumbnail_store(location, ctx.opts.max_thumbnail_cache_size)
+    path, used_cache = store.thumbnail(db, book_id, width, height)
+    if path is None:
+        return
+    try:
+        ans = share_open(path, 'rb')
+    except EnvironmentError:
+        return  # Removed by another server process
+    if ctx.testing:
+        rd.outheaders['Used-Cache'] = 'yes' if used_cache else 'no'
+        rd.outheaders['Tempfile'] = hexlify(path.encode('utf-8'))
+    return rd.filesystem_file_with_custom_etag(ans, prefix, library_id, book_id, mtime, '')
+
+
 def cover(ctx, rd, library_id, db, book_id, width=None, height=None):
     mtime = db.cover_last_modified(book_id)
     if mtime is None:
         return generated_cover(ctx, rd, library_id, db, book_id, width, height)
     prefix = 'cover'
+    if width is not None and height is not None and ctx.opts.max_thumbnail_cache_size > 0:
+        ans = stored_thumbnail(ctx, rd, library_id, db, book_id, width, height, '%s-%sx%s' % (prefix, width, height), mtime)
+        if ans is not None:
+            return ans
     if width is None and height is None:
         def copy_func(dest):
             db.copy_cover_to(book_id, dest)
@@ -203,6 +228,14 @@ def book_fmt(ctx, rd, library_id, db, book_id, fmt):
 # }}}
 
 
+def static_resource_paths():
+    ' The paths to all the files that are served by the static endpoint '
+    base = P('content-server', allow_user_override=False)
+    for dirpath, dirnames, filenames in os.walk(base):
+        for name in filenames:
+            yield P('content-server/' + os.path.relpath(os.path.join(dirpath, name), base).replace(os.sep, '/'))
+
+
 @endpoint('/static/{+what}', auth_required=False, cache_control=24)
 def static(ctx, rd, what):
     if not what:
@@ -278,7 +311,13 @@ def icon(ctx, rd, which):
         return ans
 
 
-@endpoint('/get/{what}/{book_id}/{library_id=None}', android_workaround=True)
+def get_lane(what, *args):
+    # Thumbnails and metadata are quick to generate, full size covers and
+    # book files can need resizing or updating of the metadata in the file
+    return DEFAULT_LANE if what in ('thumb', 'opf', 'json') else SLOW_LANE
+
+
+@endpoint('/get/{what}/{book_id}/{library_id=None}', android_workaround=True, lane=get_lane)
 def get(ctx, rd, what, book_id, library_id):
     book_id, rest = book_id.partition('_')[::2]
     try:
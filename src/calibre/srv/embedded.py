@@ -10,6 +10,7 @@ from threading import Thread
 from calibre import as_unicode
 from calibre.constants import cache_dir, is_running_from_develop
 from calibre.srv.bonjour import BonJour
+from calibre.srv.content import static_resource_paths
 from calibre.srv.handler import Handler
 from calibre.srv.http_response import create_http_handler
 from calibre.srv.loop import ServerLoop
@@ -54,8 +55,9 @@ class Server(object):
     def start(self):
         if self.current_thread is None:
             try:
+                http_handler = create_http_handler(self.handler.dispatch, lane_for=self.handler.lane_for)
                 self.loop = ServerLoop(
-                    create_http_handler(self.handler.dispatch),
+                    http_handler,
                     opts=self.opts,
                     log=self.log,
                     access_log=self.access_log,
@@ -72,6 +74,7 @@ class Server(object):
                         pass
                 return
             self.handler.set_jobs_manager(self.loop.jobs_manager)
+            http_handler.compressed_variants.precompress(static_resource_paths(), self.opts.compress_min_size)
             self.current_thread = t = Thread(
                 name='EmbeddedServer', target=self.serve_forever
             )
@@ -4,16 +4,22 @@
 from __future__ import absolute_import, division, print_function, unicode_literals
 
 import json
+from collections import namedtuple
 from functools import partial
 from importlib import import_module
 from threading import Lock
 
 from calibre.srv.auth import AuthController
+from calibre.srv.changes import BooksAdded, FormatsAdded
 from calibre.srv.errors import HTTPForbidden
 from calibre.srv.library_broker import LibraryBroker, path_for_db
+from calibre.srv.metadata import book_json_cache
 from calibre.srv.routes import Router
 from calibre.srv.users import UserManager
 from calibre.utils.date import utcnow
+from calibre.utils.monotonic import monotonic
+
+SortedBooks = namedtuple('SortedBooks', 'version created book_ids positions')
 
 
 class Context(object):
@@ -23,6 +29,10 @@ class Context(object):
     jobs_manager = None
     CATEGORY_CACHE_SIZE = 25
     SEARCH_CACHE_SIZE = 100
+    SORT_CACHE_SIZE = 25
+    # Sorted book lists are kept for at most this long (in seconds), long
+    # enough for a client to page through them
+    SORT_CACHE_TTL = 300
 
     def __init__(self, libraries, opts, testing=False, notify_changes=None):
         self.opts = opts
@@ -37,6 +47,19 @@ class Context(object):
     def notify_changes(self, library_path, change_event):
         if self._notify_changes is not None:
             self._notify_changes(library_path, change_event)
+        book_ids = getattr(change_event, 'book_ids', None)
+        if not book_ids:
+            return
+        library_id = self.library_broker.library_id_for_path(library_path)
+        if library_id is None:
+            return
+        db = self.library_broker.loaded_dbs.get(library_id)
+        if db is not None:
+            book_json_cache(db).invalidate(book_ids)
+        if self.opts.prerender_recent_books > 0 and self.jobs_manager is not None and isinstance(
+                change_event, (BooksAdded, FormatsAdded)):
+            from calibre.srv.books import prerender_books
+            prerender_books(self, library_id, book_ids)
 
     def start_job(self, name, module, func, args=(), kwargs=None, job_done_callback=None, job_data=None):
         return self.jobs_manager.start_job(name, module, func, args, kwargs, job_done_callback, job_data)
@@ -142,15 +165,68 @@ class Context(object):
         with self.lock:
             cache = self.library_broker.search_caches[db.server_library_id]
             old = cache.pop(key, None)
-            if old is None or old[0] < db.clear_search_cache_count:
+            # Only re-run the search if the fields it depends on have changed
+            version = db.search_results_version(query)
+            if old is None or old[0] < version:
                 matches = db.search(query, book_ids=restrict_to_ids)
-                cache[key] = old = (db.clear_search_cache_count, matches)
+                cache[key] = old = (version, matches)
                 if len(cache) > self.SEARCH_CACHE_SIZE:
                     cache.popitem(last=False)
             else:
                 cache[key] = old
             return old[1]
 
+    def search_version(self, request_data, db, query, vl=''):
+        '''
+        Return a key that identifies the results of :meth:`search` for the
+        specified user, query and virtual library, and a version that changes
+        whenever those results may have changed. Computing them does not run
+        the search.
+        '''
+        vl_query = db.pref('virtual_libraries', {}).get(vl) if vl else None
+        key = query or '', vl_query or '', self.restriction_for(request_data, db) or ''
+        return key, tuple(db.search_results_version(q) for q in key)
+
+    def sort_books(self, db, book_ids, multisort, search=None):
+        '''
+        Return book_ids sorted by multisort, as a SortedBooks object whose
+        positions attribute maps book ids to their index in the sorted list.
+        Sorted lists are cached, so that paging through a large result set
+        does not sort it again for every page.
+
+        If search is specified, it is the (key, version) pair returned by
+        :meth:`search_version` for the search that produced the books, and
+        book_ids can be a function that returns them, which is called only
+        when the sorted list is not cached. Then getting a cached list does
+        not depend on the number of books. Otherwise the set of books is
+        the key.
+        '''
+        multisort = tuple(multisort)
+        if search is None:
+            book_ids = frozenset(book_ids)
+            search = book_ids, None
+        key = search[0], multisort
+        version = search[1], db.sort_results_version([field for field, ascending in multisort])
+        now = monotonic()
+        with self.lock:
+            cache = self.library_broker.sort_caches[db.server_library_id]
+            old = cache.pop(key, None)
+            if old is not None and old.version == version and now - old.created < self.SORT_CACHE_TTL:
+                cache[key] = old
+                return old
+        if callable(book_ids):
+            book_ids = book_ids()
+        # Sort without holding the lock, sorting a large library can be slow
+        sorted_ids = tuple(db.multisort(fields=multisort, ids_to_sort=book_ids))
+        ans = SortedBooks(version, now, sorted_ids, {book_id:i for i, book_id in enumerate(sorted_ids)})
+        with self.lock:
+            cache = self.library_broker.sort_caches[db.server_library_id]
+            cache.pop(key, None)
+            cache[key] = ans
+            while len(cache) > self.SORT_CACHE_SIZE:
+                cache.popitem(last=False)
+        return ans
+
 
 SRV_MODULES = ('ajax', 'books', 'cdb', 'code', 'content', 'legacy', 'opds')
 
@@ -171,6 +247,7 @@ class Handler(object):
         self.router.finalize()
         self.router.ctx.url_for = self.router.url_for
         self.dispatch = self.router.dispatch
+        self.lane_for = self.router.lane_for
 
     def set_log(self, log):
         self.router.ctx.log = log
@@ -178,7 +255,11 @@ class Handler(object):
             self.auth_controller.log = log
 
     def set_jobs_manager(self, jobs_manager):
-        self.router.ctx.jobs_manager = jobs_manager
+        ctx = self.router.ctx
+        ctx.jobs_manager = jobs_manager
+        if ctx.opts.prerender_recent_books > 0 and not ctx.testing:
+            from calibre.srv.books import prerender_recent_books
+            prerender_recent_books(ctx)
 
     def close(self):
         self.router.ctx.library_broker.close()
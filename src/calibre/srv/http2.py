@@ -0,0 +1,412 @@
+#!/usr/bin/env python2
+# vim:fileencoding=utf-8
+# License: GPLv3 Copyright: 2017, Kovid Goyal <kovid at kovidgoyal.net>
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import httplib, sys
+from collections import deque
+from functools import partial
+from io import BytesIO, DEFAULT_BUFFER_SIZE
+from Queue import Full
+
+try:
+    from h2.config import H2Configuration
+    from h2.connection import H2Connection
+    from h2.events import ConnectionTerminated, DataReceived, RequestReceived, StreamEnded, StreamReset
+    from h2.exceptions import ProtocolError, StreamClosedError
+    from h2.settings import SettingCodes
+except ImportError:
+    H2Connection = None
+
+from calibre.ptempfile import SpooledTemporaryFile
+from calibre.srv.errors import HTTPSimpleResponse
+from calibre.srv.http_request import HTTP_METHODS, comma_separated_headers, normalize_header_name, parse_uri
+from calibre.srv.http_response import HTTPConnection, ReadableOutput, GeneratedOutput, Range
+from calibre.srv.loop import READ, WRITE, RDWR
+from calibre.srv.pool import DEFAULT_LANE
+from calibre.srv.utils import MultiDict, HTTP11
+from calibre.srv.web_socket import WebSocketConnection
+from calibre.utils.speedups import ReadOnlyFileBuffer
+
+# HTTP/2 is used only if the hyper-h2 package is available
+has_http2 = H2Connection is not None
+ALPN_PROTOCOLS = ('h2', 'http/1.1')
+UPGRADE_RESPONSE = b'HTTP/1.1 101 Switching Protocols\r\nConnection: Upgrade\r\nUpgrade: h2c\r\n\r\n'
+# HTTP/1 headers that are not allowed in HTTP/2 responses
+CONNECTION_HEADERS = frozenset('connection keep-alive proxy-connection transfer-encoding upgrade'.split())
+MAX_CONCURRENT_STREAMS = 100
+READ_SIZE = 64 * 1024
+# Response data is framed only while less than this many bytes are waiting
+# to be written to the socket, so that the streams are interleaved fairly
+SEND_BUFFER_SIZE = 64 * 1024
+
+
+def file_chunks(f, size=None):
+    while size is None or size > 0:
+        data = f.read(READ_SIZE if size is None else min(READ_SIZE, size))
+        if not data:
+            break
+        if size is not None:
+            size -= len(data)
+        yield data
+
+
+class HTTP2Stream(HTTPConnection):
+
+    '''
+    A single request and its response, on a HTTP/2 connection. The response
+    is generated by the same code as for HTTP/1 connections, the headers
+    and body are then sent as HTTP/2 frames by the connection.
+    '''
+
+    def __init__(self, conn, stream_id, method, request_line):
+        # Connection.__init__() is not called as a stream has no socket
+        self.conn, self.stream_id = conn, stream_id
+        for attr in ('opts', 'log', 'access_log', 'tdir', 'remote_addr', 'remote_port', 'is_local_connection',
+                     'request_handler', 'lane_for', 'static_cache', 'translator_cache', 'compressed_variants',
+                     'max_request_body_size'):
+            setattr(self, attr, getattr(conn, attr))
+        self.method, self.request_line = method, request_line
+        self.path = self.query = self.inheaders = None
+        self.request_protocol = self.response_protocol = HTTP11
+        self.close_after_response = self.response_started = self.request_queued = False
+        self.request_body = SpooledTemporaryFile(prefix='rq-body-', max_size=DEFAULT_BUFFER_SIZE, dir=self.tdir)
+        self.request_body_size = 0
+        self.chunks = None
+        self.pending_data = b''
+
+    @property
+    def state_description(self):
+        return 'HTTP/2 stream: %d Client: %s:%s Request: %s' % (
+            self.stream_id, self.remote_addr, self.remote_port, self.request_line)
+
+    def receive_data(self, data):
+        if self.response_started:
+            return  # An error response has already been sent
+        self.request_body_size += len(data)
+        if self.request_body_size > self.max_request_body_size:
+            return self.simple_response(httplib.REQUEST_ENTITY_TOO_LARGE,
+                "The entity sent with the request exceeds the maximum "
+                "allowed bytes (%d)." % self.max_request_body_size)
+        self.request_body.write(data)
+
+    def request_complete(self):
+        if not self.response_started and not self.request_queued:
+            self.request_queued = True
+            self.prepare_response(self.inheaders, self.request_body)
+
+    def queue_job(self, func, *args, **kwargs):
+        lane = kwargs.pop('lane', DEFAULT_LANE)
+        if args or kwargs:
+            func = partial(func, *args, **kwargs)
+        self.conn.queue_stream_job(self, func, lane)
+
+    def response_ready(self, header_file, output=None):
+        # The status line and headers are generated for HTTP/1, convert them
+        self.response_started = True
+        head, body = header_file.read().partition(b'\r\n\r\n')[::2]
+        lines = head.decode('utf-8').split('\r\n')
+        headers = [(':status', lines[0].split(' ', 2)[1])]
+        for line in lines[1:]:
+            name, val = line.partition(':')[::2]
+            name = name.strip().lower()
+            if name not in CONNECTION_HEADERS:
+                headers.append((name, val.strip()))
+        has_body = bool(body) or (output is not None and self.method != 'HEAD')
+        if has_body:
+            self.chunks = self.body_chunks(body, output)
+        self.conn.send_stream_headers(self, headers, has_body)
+
+    def body_chunks(self, prefix, output):
+        if prefix:
+            yield prefix
+        if output is None or self.method == 'HEAD':
+            return
+        if isinstance(output, ReadableOutput):
+            f, ranges = output.src_file, output.ranges
+            if ranges is None:
+                for chunk in file_chunks(f):
+                    yield chunk
+            elif isinstance(ranges, Range):
+                f.seek(ranges.start)
+                for chunk in file_chunks(f, ranges.size):
+                    yield chunk
+            else:
+                first = True
+                for r, range_part in ranges:
+                    if r is None:
+                        yield b'\r\n' + range_part
+                    else:
+                        yield (b'' if first else b'\r\n') + range_part + b'\r\n'
+                        first = False
+                        f.seek(r.start)
+                        for chunk in file_chunks(f, r.size):
+                            yield chunk
+        elif isinstance(output, GeneratedOutput):
+            for chunk in output.output:
+                if chunk:
+                    yield chunk if isinstance(chunk, bytes) else chunk.encode('utf-8')
+        else:
+            raise TypeError('Unknown output type: %r' % output)
+
+    def next_data(self, max_size):
+        ' Return up to max_size bytes of the response body or None if it is finished '
+        while not self.pending_data:
+            try:
+                self.pending_data = next(self.chunks)
+            except StopIteration:
+                return None
+        ans, self.pending_data = self.pending_data[:max_size], self.pending_data[max_size:]
+        return ans
+
+
+class HTTP2Connection(WebSocketConnection):
+
+    '''
+    Adds HTTP/2 support to HTTP connections. HTTP/2 is negotiated with TLS
+    ALPN, with the h2c upgrade of a HTTP/1.1 request or, for clients that know
+    the server supports it, by starting the connection with the HTTP/2
+    connection preface. The requests on a HTTP/2 connection are all handled
+    at the same time, in the server's thread pool.
+    '''
+
+    in_http2_mode = h2_closing = False
+
+    @property
+    def http2_allowed(self):
+        return self.opts.enable_http2 and not self.in_websocket_mode
+
+    def connection_ready(self):
+        if not self.in_http2_mode and self.ssl_context is not None and self.http2_allowed:
+            selected = getattr(self.socket, 'selected_alpn_protocol', lambda: None)()
+            if selected == 'h2':
+                return self.start_http2()
+        WebSocketConnection.connection_ready(self)
+
+    def http2_preface_received(self, line):
+        if not self.http2_allowed:
+            return WebSocketConnection.http2_preface_received(self, line)
+        self.start_http2(initial_data=line)
+
+    def finalize_headers(self, inheaders):
+        upgrade = {x.strip().lower() for x in inheaders.get('Upgrade', '').split(',')}
+        conn = {x.strip().lower() for x in inheaders.get('Connection', '').split(',')}
+        settings = inheaders.get('Http2-Settings')
+        if ('h2c' not in upgrade or 'upgrade' not in conn or settings is None or self.ssl_context is not None or
+                not self.http2_allowed or int(inheaders.get('Content-Length', 0)) > 0 or 'Transfer-Encoding' in inheaders):
+            return WebSocketConnection.finalize_headers(self, inheaders)
+        self.set_state(WRITE, self.upgrade_connection_to_http2, ReadOnlyFileBuffer(UPGRADE_RESPONSE), settings, inheaders)
+
+    def upgrade_connection_to_http2(self, buf, settings, inheaders, event):
+        if self.write(buf):
+            self.start_http2(upgrade=(settings, inheaders))
+
+    # HTTP/2 mode {{{
+    def start_http2(self, initial_data=b'', upgrade=None):
+        self.in_http2_mode = True
+        # Errors can no longer be reported as HTTP/1 responses
+        self.response_started = True
+        self.streams = {}
+        self.sending = deque()
+        self.h2_out = b''
+        self.h2 = H2Connection(config=H2Configuration(client_side=False, header_encoding=str('utf-8')))
+        if upgrade is None:
+            self.h2.initiate_connection()
+        else:
+            self.h2.initiate_upgrade_connection(upgrade[0].encode('ascii'))
+        self.h2.update_settings({SettingCodes.MAX_CONCURRENT_STREAMS: MAX_CONCURRENT_STREAMS})
+        self.handle_event = self.h2_duplex
+        if upgrade is not None:
+            # The upgraded request is stream 1
+            stream = self.streams[1] = HTTP2Stream(self, 1, self.method, self.request_line.decode('utf-8', 'replace'))
+            stream.path, stream.query, stream.request_queued = self.path, self.query, True
+            stream.prepare_response(upgrade[1], BytesIO())
+        if initial_data:
+            self.h2_receive(initial_data)
+        self.set_h2_state()
+
+    def h2_duplex(self, event):
+        if isinstance(event, tuple):
+            self.h2_job_done(*event)
+        else:
+            if event is READ or event is RDWR:
+                self.h2_read()
+            if (event is WRITE or event is RDWR) and self.ready:
+                self.h2_write()
+        self.set_h2_state()
+
+    def h2_read(self):
+        data = self.recv(READ_SIZE)
+        pending = getattr(self.socket, 'pending', None)
+        while data and pending is not None and pending() > 0:
+            # Data already decrypted by SSL is not signalled by the poller
+            data += self.recv(READ_SIZE)
+        if data:
+            self.h2_receive(data)
+
+    def h2_receive(self, data):
+        try:
+            events = self.h2.receive_data(data)
+        except ProtocolError:
+            # h2 has queued a GOAWAY frame, send it and close the connection
+            self.send(self.h2_out + self.h2.data_to_send())
+            self.ready = False
+            return
+        for event in events:
+            if isinstance(event, RequestReceived):
+                self.h2_request_received(event.stream_id, event.headers)
+            elif isinstance(event, DataReceived):
+                stream = self.streams.get(event.stream_id)
+                if stream is not None:
+                    stream.receive_data(event.data)
+                try:
+                    self.h2.acknowledge_received_data(event.flow_controlled_length, event.stream_id)
+                except StreamClosedError:
+                    pass
+            elif isinstance(event, StreamEnded):
+                stream = self.streams.get(event.stream_id)
+                if stream is not None:
+                    stream.request_complete()
+            elif isinstance(event, StreamReset):
+                self.stream_finished(event.stream_id)
+            elif isinstance(event, ConnectionTerminated):
+                self.h2_closing = True
+
+    def h2_request_received(self, stream_id, headers):
+        pseudo, inheaders, cookies = {}, MultiDict(), []
+        for name, val in headers:
+            if name.startswith(':'):
+                pseudo[name] = val
+            elif name == 'cookie':
+                # HTTP/2 allows the cookie header to be split into pieces
+                cookies.append(val)
+            else:
+                key = normalize_header_name(name)
+                if key in comma_separated_headers:
+                    existing = inheaders.pop(key)
+                    if existing is not None:
+                        val = existing + ', ' + val
+                inheaders[key] = val
+        if cookies:
+            inheaders['Cookie'] = '; '.join(cookies)
+        if ':authority' in pseudo and 'Host' not in inheaders:
+            inheaders['Host'] = pseudo[':authority']
+        method, path = pseudo.get(':method', '').upper(), pseudo.get(':path', '')
+        stream = self.streams[stream_id] = HTTP2Stream(self, stream_id, method, '%s %s HTTP/2' % (method, path))
+        if method not in HTTP_METHODS:
+            return stream.simple_response(httplib.BAD_REQUEST, 'Unknown HTTP method')
+        try:
+            stream.path, stream.query = parse_uri(path.encode('utf-8'))[1:]
+        except HTTPSimpleResponse as e:
+            return stream.simple_response(e.http_code, e.message)
+        stream.inheaders = inheaders
+        try:
+            content_length = int(inheaders.get('Content-Length', 0))
+        except ValueError:
+            return stream.simple_response(httplib.BAD_REQUEST, 'Invalid Content-Length')
+        if content_length > self.max_request_body_size:
+            return stream.simple_response(httplib.REQUEST_ENTITY_TOO_LARGE,
+                "The entity sent with the request exceeds the maximum "
+                "allowed bytes (%d)." % self.max_request_body_size)
+
+    def queue_stream_job(self, stream, func, lane):
+        stream_id = stream.stream_id
+
+        def run_stream_job():
+            try:
+                return stream_id, True, func()
+            except Exception:
+                return stream_id, False, sys.exc_info()
+
+        try:
+            self.pool.put_nowait(self.job_id, run_stream_job, lane=lane)
+        except Full:
+            stream.report_busy()
+
+    def h2_job_done(self, ok, result):
+        stream_id, ok, result = result
+        stream = self.streams.get(stream_id)
+        if stream is None:
+            return  # The stream was reset by the client
+        try:
+            stream.job_done(ok, result)
+        except Exception:
+            self.log.exception('Unhandled exception in state: %s' % stream.state_description)
+            if stream.response_started:
+                self.h2.reset_stream(stream_id)
+                self.stream_finished(stream_id)
+            else:
+                stream.report_unhandled_exception(None, None)
+
+    def send_stream_headers(self, stream, headers, has_body):
+        try:
+            self.h2.send_headers(stream.stream_id, headers, end_stream=not has_body)
+        except StreamClosedError:
+            return self.stream_finished(stream.stream_id)
+        if has_body:
+            self.sending.append(stream.stream_id)
+        else:
+            self.stream_finished(stream.stream_id)
+
+    def stream_finished(self, stream_id):
+        self.streams.pop(stream_id, None)
+        try:
+            self.sending.remove(stream_id)
+        except ValueError:
+            pass
+
+    def frame_response_data(self):
+        # Send a frame from each stream in turn, as allowed by flow control
+        while len(self.h2_out) < SEND_BUFFER_SIZE and self.sending:
+            progressed = False
+            for stream_id in tuple(self.sending):
+                try:
+                    size = min(self.h2.local_flow_control_window(stream_id), self.h2.max_outbound_frame_size)
+                    if size < 1:
+                        continue
+                    data = self.streams[stream_id].next_data(size)
+                    if data is None:
+                        self.h2.end_stream(stream_id)
+                        self.stream_finished(stream_id)
+                    elif data:
+                        self.h2.send_data(stream_id, data)
+                except StreamClosedError:
+                    self.stream_finished(stream_id)
+                progressed = True
+            self.h2_out += self.h2.data_to_send()
+            if not progressed:
+                break
+
+    def h2_write(self):
+        self.frame_response_data()
+        if self.h2_out:
+            sent = self.send(self.h2_out[:max(self.send_bufsize, READ_SIZE)])
+            self.h2_out = self.h2_out[sent:]
+
+    def can_send_data(self):
+        for stream_id in self.sending:
+            try:
+                if self.h2.local_flow_control_window(stream_id) > 0:
+                    return True
+            except StreamClosedError:
+                return True  # So that the stream is removed
+        return False
+
+    def set_h2_state(self):
+        if not self.ready:
+            return
+        self.h2_out += self.h2.data_to_send()
+        if self.h2_out or self.can_send_data():
+            self.wait_for = RDWR
+        elif self.h2_closing:
+            self.ready = False
+        else:
+            self.wait_for = READ
+
+    def handle_timeout(self):
+        if self.in_http2_mode:
+            # Do not close connections with requests that are still being processed
+            return bool(self.streams)
+        return WebSocketConnection.handle_timeout(self)
+    # }}}
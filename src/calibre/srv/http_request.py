@@ -19,6 +19,9 @@ from calibre.srv.utils import MultiDict, HTTP1, HTTP11, Accumulator
 protocol_map = {(1, 0):HTTP1, (1, 1):HTTP11}
 quoted_slash = re.compile(br'%2[fF]')
 HTTP_METHODS = {'HEAD', 'GET', 'PUT', 'POST', 'TRACE', 'DELETE', 'OPTIONS'}
+# The first line of the connection preface sent by HTTP/2 clients that know
+# the server supports HTTP/2, see RFC 7540 section 3.4
+HTTP2_PREFACE_LINE = b'PRI * HTTP/2.0\r\n'
 
 # Parse URI {{{
 
@@ -259,6 +262,8 @@ class HTTPRequest(Connection):
             if first:
                 return self.set_state(READ, self.parse_request_line, Accumulator())
             return self.simple_response(httplib.BAD_REQUEST, 'Multiple leading empty lines not allowed')
+        if line == HTTP2_PREFACE_LINE:
+            return self.http2_preface_received(line)
 
         try:
             method, uri, req_protocol = line.strip().split(b' ', 2)
@@ -283,6 +288,9 @@ class HTTPRequest(Connection):
         self.set_state(READ, self.parse_header_line, HTTPHeaderParser(), Accumulator())
     # }}}
 
+    def http2_preface_received(self, line):
+        return self.simple_response(httplib.HTTP_VERSION_NOT_SUPPORTED)
+
     @property
     def state_description(self):
         return 'State: %s Client: %s:%s Request: %s' % (
@@ -7,16 +7,25 @@ __license__ = 'GPL v3'
 __copyright__ = '2015, Kovid Goyal <kovid at kovidgoyal.net>'
 
 import os, httplib, hashlib, uuid, struct, repr as reprlib
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
 from io import BytesIO, DEFAULT_BUFFER_SIZE
 from itertools import chain, repeat, izip_longest
 from operator import itemgetter
 from functools import wraps
 from future_builtins import map
+from threading import Lock, Thread
 
-from calibre import guess_type, force_unicode
+try:
+    import brotli
+    if not hasattr(brotli, 'Compressor'):
+        brotli = None  # Too old to support streaming compression
+except ImportError:
+    brotli = None
+
+from calibre import as_unicode, guess_type, force_unicode, prints
 from calibre.constants import __version__, plugins
 from calibre.srv.loop import WRITE
+from calibre.srv.pool import DEFAULT_LANE
 from calibre.srv.errors import HTTPSimpleResponse
 from calibre.srv.http_request import HTTPRequest, read_headers
 from calibre.srv.sendfile import file_metadata, sendfile_to_socket_async, CannotSendfile, SendfileInterrupted
@@ -33,6 +42,13 @@ zlib, zlib2_err = plugins['zlib2']
 if zlib2_err:
     raise RuntimeError('Failed to laod the zlib2 module with error: ' + zlib2_err)
 del zlib2_err
+# Content encodings supported for responses, most preferred first
+SUPPORTED_ENCODINGS = ('gzip',) if brotli is None else ('br', 'gzip')
+# Compression levels used when compressing responses on the fly and when
+# precompressing static resources
+DYNAMIC_COMPRESS_LEVELS = {'gzip': 6, 'br': 5}
+STATIC_COMPRESS_LEVELS = {'gzip': 9, 'br': 11}
+COMPRESSED_VARIANTS_CACHE_SIZE = 64 * 1024 * 1024  # bytes
 
 
 def header_list_to_file(buf):  # {{{
@@ -83,8 +99,8 @@ def parse_if_none_match(val):  # {{{
 # }}}
 
 
-def acceptable_encoding(val, allowed=frozenset({'gzip'})):  # {{{
-    for x in sort_q_values(val):
+def acceptable_encoding(val, allowed=frozenset({'gzip'}), preferred=()):  # {{{
+    for x in sort_q_values(val, preferred):
         x = x.lower()
         if x in allowed:
             return x
@@ -182,6 +198,103 @@ def compress_readable_output(src_file, compress_level=6):
 # }}}
 
 
+def brotli_compress_readable_output(src_file, quality=5):
+    zobj = brotli.Compressor(quality=quality)
+    while True:
+        data = src_file.read(DEFAULT_BUFFER_SIZE)
+        if not data:
+            break
+        yield zobj.process(data)
+    yield zobj.finish()
+
+
+def compressed_output(src_file, encoding, static=False):
+    level = (STATIC_COMPRESS_LEVELS if static else DYNAMIC_COMPRESS_LEVELS)[encoding]
+    if encoding == 'br':
+        return brotli_compress_readable_output(src_file, level)
+    return compress_readable_output(src_file, level)
+
+
+def is_compressible(content_type):
+    ct = (content_type or '').partition(';')[0]
+    return not ct or ct.startswith('text/') or ct.startswith('image/svg') or ct in COMPRESSIBLE_TYPES
+
+
+class CompressedVariants(object):  # {{{
+
+    '''
+    Stores the compressed forms of responses that have an ETag, so that they
+    are compressed only once, instead of on every request. The total size is
+    limited to max_size bytes, the least recently used variants are discarded
+    first. Since several resources can share an ETag (for example, all the
+    files in the MathJax bundle), variants are keyed by the resource as well,
+    which is the path of the file for filesystem files and the request path
+    otherwise.
+    '''
+
+    def __init__(self, max_size=COMPRESSED_VARIANTS_CACHE_SIZE):
+        self.max_size, self.size = max_size, 0
+        self.items = OrderedDict()
+        self.lock = Lock()
+
+    def get(self, resource, etag, encoding):
+        key = (resource, etag, encoding)
+        with self.lock:
+            ans = self.items.pop(key, None)
+            if ans is not None:
+                self.items[key] = ans
+            return ans
+
+    def set(self, resource, etag, encoding, data):
+        if len(data) > self.max_size // 4:
+            return
+        key = (resource, etag, encoding)
+        with self.lock:
+            old = self.items.pop(key, None)
+            if old is not None:
+                self.size -= len(old)
+            self.items[key] = data
+            self.size += len(data)
+            while self.size > self.max_size:
+                self.size -= len(self.items.popitem(last=False)[1])
+
+    def cache_output(self, chunks, resource, etag, encoding):
+        # Pass the chunks through, storing them once the last one has been
+        # generated
+        parts = []
+        for chunk in chunks:
+            parts.append(chunk)
+            yield chunk
+        self.set(resource, etag, encoding, b''.join(parts))
+
+    def precompress(self, paths, min_size=0):
+        ''' Store the compressed forms of the specified files, using the highest
+        compression levels, in a background thread. '''
+        if min_size < 0:
+            return
+        t = Thread(target=self.precompress_files, args=(tuple(paths), min_size), name='PrecompressFiles')
+        t.daemon = True
+        t.start()
+
+    def precompress_files(self, paths, min_size):
+        for path in paths:
+            mt = guess_type(path)[0]
+            if not mt or not is_compressible(mt):
+                continue
+            try:
+                st = os.stat(path)
+                if st.st_size < min_size:
+                    continue
+                etag = filesystem_etag(path, st)
+                with lopen(path, 'rb') as f:
+                    for encoding in SUPPORTED_ENCODINGS:
+                        f.seek(0)
+                        self.set(path, etag, encoding, b''.join(compressed_output(f, encoding, static=True)))
+            except EnvironmentError as err:
+                prints('Failed to precompress: %s with error: %s' % (path, as_unicode(err)))
+# }}}
+
+
 def get_range_parts(ranges, content_type, content_length):  # {{{
 
     def part(r):
@@ -298,13 +411,17 @@ class ReadableOutput(object):
         self.src_file.seek(0)
 
 
+def filesystem_etag(name, stat_result):
+    return '"%s"' % hashlib.sha1(type('')(stat_result.st_mtime) + force_unicode(name or '')).hexdigest()
+
+
 def filesystem_file_output(output, outheaders, stat_result):
     etag = getattr(output, 'etag', None)
     if etag is None:
-        etag = hashlib.sha1(type('')(stat_result.st_mtime) + force_unicode(output.name or '')).hexdigest()
+        etag = filesystem_etag(output.name, stat_result)
     else:
         output = output.output
-    etag = '"%s"' % etag
+        etag = '"%s"' % etag
     self = ReadableOutput(output, etag=etag, content_length=stat_result.st_size)
     self.name = output.name
     self.use_sendfile = True
@@ -355,6 +472,9 @@ class StaticOutput(object):
 class HTTPConnection(HTTPRequest):
 
     use_sendfile = False
+    # A function that returns the thread pool lane for a request
+    lane_for = None
+    compressed_variants = CompressedVariants()
 
     def write(self, buf, end=None):
         pos = buf.tell()
@@ -433,7 +553,8 @@ class HTTPConnection(HTTPRequest):
             self.remote_addr, self.remote_port, self.is_local_connection,
             self.translator_cache, self.tdir
         )
-        self.queue_job(self.run_request_handler, data)
+        lane = DEFAULT_LANE if self.lane_for is None else self.lane_for(data)
+        self.queue_job(self.run_request_handler, data, lane=lane)
 
     def run_request_handler(self, data):
         result = self.request_handler(data)
@@ -643,12 +764,22 @@ class HTTPConnection(HTTPRequest):
             output = dynamic_output(output(), outheaders, etag=output.etag)
         else:
             output = GeneratedOutput(output)
-        ct = outheaders.get('Content-Type', '').partition(';')[0]
-        compressible = (not ct or ct.startswith('text/') or ct.startswith('image/svg') or
-                        ct.partition(';')[0] in COMPRESSIBLE_TYPES)
-        compressible = (compressible and request.status_code == httplib.OK and
-                        (opts.compress_min_size > -1 and output.content_length >= opts.compress_min_size) and
-                        acceptable_encoding(request.inheaders.get('Accept-Encoding', '')) and not is_http1)
+        encoding = None
+        if (is_compressible(outheaders.get('Content-Type')) and request.status_code == httplib.OK and
+                (opts.compress_min_size > -1 and output.content_length >= opts.compress_min_size) and not is_http1):
+            encoding = acceptable_encoding(
+                request.inheaders.get('Accept-Encoding', ''), frozenset(SUPPORTED_ENCODINGS), SUPPORTED_ENCODINGS)
+        variant = None
+        # The request path is a tuple, so it cannot clash with a file path
+        resource = getattr(output, 'name', None) or request.path
+        if encoding and output.etag:
+            variant = self.compressed_variants.get(resource, output.etag, encoding)
+        uncompressed_length = output.content_length
+        if variant is not None:
+            # Unlike output that is compressed on the fly, the stored compressed
+            # form has a known length, so it can be sent in ranges
+            output = ReadableOutput(ReadOnlyFileBuffer(variant), etag=output.etag, content_length=len(variant))
+        compressible = encoding is not None and variant is None
         accept_ranges = (not compressible and output.accept_ranges is not None and request.status_code == httplib.OK and
                         not is_http1)
         ranges = get_ranges(request.inheaders.get('Range'), output.content_length) if output.accept_ranges and self.method in ('GET', 'HEAD') else None
@@ -675,11 +806,17 @@ class HTTPConnection(HTTPRequest):
             outheaders.set('ETag', output.etag, replace_all=True)
         if accept_ranges:
             outheaders.set('Accept-Ranges', 'bytes', replace_all=True)
+        if variant is not None:
+            outheaders.set('Content-Encoding', encoding, replace_all=True)
+            outheaders.set('Calibre-Uncompressed-Length', '%d' % uncompressed_length)
         if compressible and not ranges:
-            outheaders.set('Content-Encoding', 'gzip', replace_all=True)
+            outheaders.set('Content-Encoding', encoding, replace_all=True)
             if getattr(output, 'content_length', None):
                 outheaders.set('Calibre-Uncompressed-Length', '%d' % output.content_length)
-            output = GeneratedOutput(compress_readable_output(output.src_file), etag=output.etag)
+            chunks = compressed_output(output.src_file, encoding)
+            if output.etag and self.method == 'GET':
+                chunks = self.compressed_variants.cache_output(chunks, resource, output.etag, encoding)
+            output = GeneratedOutput(chunks, etag=output.etag)
         if output.content_length is not None and not compressible and not ranges:
             outheaders.set('Content-Length', '%d' % output.content_length, replace_all=True)
 
@@ -702,10 +839,13 @@ class HTTPConnection(HTTPRequest):
         return output
 
 
-def create_http_handler(handler=None, websocket_handler=None):
+def create_http_handler(handler=None, websocket_handler=None, lane_for=None):
+    from calibre.srv.http2 import ALPN_PROTOCOLS, HTTP2Connection, has_http2
     from calibre.srv.web_socket import WebSocketConnection
+    connection_class = HTTP2Connection if has_http2 else WebSocketConnection
     static_cache = {}
     translator_cache = {}
+    compressed_variants = CompressedVariants()
     if handler is None:
         def dummy_http_handler(data):
             return 'Hello'
@@ -713,10 +853,15 @@ def create_http_handler(handler=None, websocket_handler=None):
 
     @wraps(handler)
     def wrapper(*args, **kwargs):
-        ans = WebSocketConnection(*args, **kwargs)
+        ans = connection_class(*args, **kwargs)
         ans.request_handler = handler
         ans.websocket_handler = websocket_handler
+        ans.lane_for = lane_for
         ans.static_cache = static_cache
         ans.translator_cache = translator_cache
+        ans.compressed_variants = compressed_variants
         return ans
+    wrapper.compressed_variants = compressed_variants
+    # The protocols to offer to clients with TLS ALPN
+    wrapper.alpn_protocols = ALPN_PROTOCOLS if has_http2 else None
     return wrapper
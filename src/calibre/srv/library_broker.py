@@ -76,9 +76,9 @@ class LibraryBroker(object):
             self.library_name_map[library_id] = os.path.basename(original_path)
             self.original_path_map[path] = original_path
         self.loaded_dbs = {}
-        self.category_caches, self.search_caches, self.tag_browser_caches = (
+        self.category_caches, self.search_caches, self.tag_browser_caches, self.sort_caches = (
             defaultdict(OrderedDict), defaultdict(OrderedDict),
-            defaultdict(OrderedDict))
+            defaultdict(OrderedDict), defaultdict(OrderedDict))
 
     def get(self, library_id=None):
         with self:
@@ -107,6 +107,26 @@ class LibraryBroker(object):
                 getattr(db, 'close', lambda: None)()
             self.lmap, self.loaded_dbs = OrderedDict(), {}
 
+    def library_id_for_path(self, library_path):
+        path = canonicalize_path(library_path)
+        with self:
+            for library_id, lpath in self.lmap.iteritems():
+                if lpath == path:
+                    return library_id
+
+    def library_changed(self, library_path):
+        ''' Re-read the metadata of the specified library, if it is loaded.
+        Used when the library has been changed by another process. '''
+        with self:
+            library_id = self.library_id_for_path(library_path)
+            if library_id is None:
+                return
+            db = self.loaded_dbs.get(library_id)
+            for cache in (self.category_caches, self.search_caches, self.tag_browser_caches, self.sort_caches):
+                cache.pop(library_id, None)
+        if db is not None:
+            db.new_api.reload_from_db()
+
     @property
     def default_library(self):
         return next(self.lmap.iterkeys())
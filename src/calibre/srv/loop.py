@@ -6,15 +6,18 @@ from __future__ import (unicode_literals, division, absolute_import,
 __license__ = 'GPL v3'
 __copyright__ = '2015, Kovid Goyal <kovid at kovidgoyal.net>'
 
-import ssl, socket, select, os, traceback
+import ssl, socket, select, os, traceback, heapq
+from collections import deque
 from io import BytesIO
+from itertools import count
 from Queue import Empty, Full
 from functools import partial
 
 from calibre import as_unicode
+from calibre.constants import islinux
 from calibre.ptempfile import TemporaryDirectory
 from calibre.srv.errors import JobQueueFull
-from calibre.srv.pool import ThreadPool, PluginPool
+from calibre.srv.pool import ThreadPool, PluginPool, DEFAULT_LANE
 from calibre.srv.opts import Options
 from calibre.srv.jobs import JobsManager
 from calibre.srv.utils import (
@@ -28,6 +31,11 @@ from calibre.utils.mdns import get_external_ip
 
 READ, WRITE, RDWR, WAIT = 'READ', 'WRITE', 'RDWR', 'WAIT'
 WAKEUP, JOB_DONE = bytes(bytearray(xrange(2)))
+# The socket module in python 2 does not expose this option
+SO_REUSEPORT = getattr(socket, 'SO_REUSEPORT', 15 if islinux else None)
+# Numbers connections, so that a new connection that gets the file descriptor
+# of a closed one can be told apart from it
+connection_counter = count()
 
 
 class ReadBuffer(object):  # {{{
@@ -118,10 +126,117 @@ class ReadBuffer(object):  # {{{
     # }}}
 
 
+# Pollers {{{
+
+class SelectPoller(object):
+
+    '''
+    Poller that uses select(). Works everywhere, but every poll is
+    O(number of connections) and it cannot handle file descriptors larger
+    than FD_SETSIZE (usually 1024).
+    '''
+
+    def __init__(self):
+        self.readers, self.writers = set(), set()
+
+    def register(self, fd, wait_for):
+        self.readers.discard(fd), self.writers.discard(fd)
+        if wait_for is READ or wait_for is RDWR:
+            self.readers.add(fd)
+        if wait_for is WRITE or wait_for is RDWR:
+            self.writers.add(fd)
+
+    def unregister(self, fd):
+        self.readers.discard(fd), self.writers.discard(fd)
+
+    def poll(self, timeout):
+        readable, writable, _ = select.select(self.readers, self.writers, [], timeout)
+        return readable, writable
+
+    def bad_fds(self):
+        for fd in self.readers | self.writers:
+            try:
+                select.select([fd], [], [], 0)
+            except (select.error, socket.error) as e:
+                if getattr(e, 'errno', e.args[0]) not in socket_errors_eintr:
+                    yield fd
+
+    def close(self):
+        self.readers.clear(), self.writers.clear()
+
+
+class EpollPoller(object):
+
+    '''
+    Level triggered poller that uses epoll() on Linux. The registrations live
+    in the kernel and are only changed when a connection starts waiting for
+    something else, so every poll is O(number of ready connections).
+    '''
+
+    def __init__(self):
+        self.epoll = select.epoll()
+        self.registered = {}
+        self.event_map = {READ: select.EPOLLIN, WRITE: select.EPOLLOUT, RDWR: select.EPOLLIN | select.EPOLLOUT}
+        self.read_events = select.EPOLLIN | select.EPOLLHUP | select.EPOLLERR
+        self.write_events = select.EPOLLOUT | select.EPOLLHUP | select.EPOLLERR
+
+    def register(self, fd, wait_for):
+        events = self.event_map.get(wait_for, 0)
+        old = self.registered.get(fd)
+        if events == old:
+            return
+        if not events:
+            # The kernel always reports errors and hangups, even with an empty
+            # event mask, so connections that are not waiting for anything must
+            # not be registered
+            return self.unregister(fd)
+        if old is None:
+            self.epoll.register(fd, events)
+        else:
+            self.epoll.modify(fd, events)
+        self.registered[fd] = events
+
+    def unregister(self, fd):
+        if self.registered.pop(fd, None) is not None:
+            try:
+                self.epoll.unregister(fd)
+            except EnvironmentError:
+                pass  # fd was already closed
+
+    def poll(self, timeout):
+        readable, writable = [], []
+        registered = self.registered
+        for fd, events in self.epoll.poll(timeout):
+            wanted = registered.get(fd, 0)
+            if events & self.read_events and wanted & select.EPOLLIN:
+                readable.append(fd)
+            if events & self.write_events and wanted & select.EPOLLOUT:
+                writable.append(fd)
+        return readable, writable
+
+    def bad_fds(self):
+        return ()
+
+    def close(self):
+        self.registered.clear()
+        self.epoll.close()
+
+
+def create_poller():
+    if hasattr(select, 'epoll'):
+        return EpollPoller()
+    return SelectPoller()
+# }}}
+
+
 class Connection(object):  # {{{
 
+    # Called with no arguments whenever wait_for changes, set by the ServerLoop
+    wait_for_changed = None
+
     def __init__(self, socket, opts, ssl_context, tdir, addr, pool, log, access_log, wakeup):
         self.opts, self.pool, self.log, self.wakeup, self.access_log = opts, pool, log, wakeup, access_log
+        self.connection_id = next(connection_counter)
         try:
             self.remote_addr = addr[0]
             self.remote_port = addr[1]
@@ -146,6 +261,16 @@ class Connection(object):  # {{{
         self.last_activity = monotonic()
         self.ready = True
 
+    @property
+    def wait_for(self):
+        return self._wait_for
+
+    @wait_for.setter
+    def wait_for(self, val):
+        self._wait_for = val
+        if self.wait_for_changed is not None:
+            self.wait_for_changed()
+
     def optimize_for_sending_packet(self):
         start_cork(self.socket)
         self.orig_send_bufsize = self.send_bufsize = self.socket.getsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF)
@@ -265,15 +390,21 @@ class Connection(object):  # {{{
         except socket.error:
             pass
 
-    def queue_job(self, func, *args):
-        if args:
-            func = partial(func, *args)
+    def queue_job(self, func, *args, **kwargs):
+        lane = kwargs.pop('lane', DEFAULT_LANE)
+        if args or kwargs:
+            func = partial(func, *args, **kwargs)
         try:
-            self.pool.put_nowait(self.socket.fileno(), func)
+            self.pool.put_nowait(self.job_id, func, lane=lane)
         except Full:
             raise JobQueueFull()
         self.set_state(WAIT, self._job_done)
 
+    @property
+    def job_id(self):
+        ' The id of jobs queued in the pool by this connection, see ServerLoop.dispatch_job_results() '
+        return self.socket.fileno(), self.connection_id
+
     def _job_done(self, event):
         self.job_done(*event)
 
@@ -328,11 +459,23 @@ class ServerLoop(object):
         self.bind_address = ba
         self.bound_address = None
         self.connection_map = {}
+        self.poller = create_poller()
+        # Heap of (deadline, id(conn), fd) used to find connections that have
+        # been inactive for too long, without checking every connection
+        self.timeouts = []
+        # Connections that have buffered data that can be read without
+        # waiting for the socket
+        self.buffered = set()
+        # Connections whose wait_for was changed, possibly by other threads
+        self.state_changes = deque()
 
         self.ssl_context = None
         if self.opts.ssl_certfile is not None and self.opts.ssl_keyfile is not None:
             self.ssl_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
             self.ssl_context.load_cert_chain(certfile=self.opts.ssl_certfile, keyfile=self.opts.ssl_keyfile)
+            alpn_protocols = getattr(handler, 'alpn_protocols', None)
+            if alpn_protocols and self.opts.enable_http2 and getattr(ssl, 'HAS_ALPN', False):
+                self.ssl_context.set_alpn_protocols(alpn_protocols)
 
         self.pre_activated_socket = None
         if self.opts.allow_socket_preallocation:
@@ -343,11 +486,17 @@ class ServerLoop(object):
                 self.bind_address = self.pre_activated_socket.getsockname()
 
         self.create_control_connection()
-        self.pool = ThreadPool(self.log, self.job_completed, count=self.opts.worker_count)
+        self.pool = ThreadPool(self.log, self.job_completed, count=self.opts.worker_count, max_count=self.opts.max_worker_count)
         self.plugin_pool = PluginPool(self, plugins)
 
     def create_control_connection(self):
+        if getattr(self, 'control_out', None) is not None:
+            try:
+                self.poller.unregister(self.control_out.fileno())
+            except socket.error:
+                pass
         self.control_in, self.control_out = create_sock_pair()
+        self.poller.register(self.control_out.fileno(), READ)
 
     def __str__(self):
         return "%s(%r)" % (self.__class__.__name__, self.bind_address)
@@ -410,6 +559,7 @@ class ServerLoop(object):
     def serve(self):
         self.connection_map = {}
         self.socket.listen(min(socket.SOMAXCONN, 128))
+        self.poller.register(self.socket.fileno(), READ)
         self.bound_address = ba = self.socket.getsockname()
         if isinstance(ba, tuple):
             ba = ':'.join(map(type(''), ba))
@@ -440,6 +590,10 @@ class ServerLoop(object):
 
     def setup_socket(self):
         self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.opts.worker_processes > 1 and SO_REUSEPORT is not None:
+            # Let the other server processes bind to the same address, the
+            # kernel distributes incoming connections between them
+            self.socket.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
         self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
 
         # If listening on the IPV6 any address ('::' = IN6ADDR_ANY),
@@ -464,48 +618,39 @@ class ServerLoop(object):
 
     def tick(self):
         now = monotonic()
-        read_needed, write_needed, readable, remove = [], [], [], []
-        for s, conn in self.connection_map.iteritems():
-            if now - conn.last_activity > self.opts.timeout:
-                if conn.handle_timeout():
-                    conn.last_activity = now
-                else:
-                    remove.append((s, conn))
-                    continue
-            wf = conn.wait_for
-            if wf is READ:
-                (readable if conn.read_buffer.has_data else read_needed).append(s)
-            elif wf is WRITE:
-                write_needed.append(s)
-            elif wf is RDWR:
-                write_needed.append(s)
-                (readable if conn.read_buffer.has_data else read_needed).append(s)
-
-        for s, conn in remove:
-            self.log('Closing connection because of extended inactivity: %s' % conn.state_description)
-            self.close(s, conn)
+        self.check_timeouts(now)
+        while self.state_changes:
+            s = self.state_changes.popleft()
+            conn = self.connection_map.get(s)
+            if conn is not None:
+                self.update_registration(s, conn)
 
-        if readable:
-            writable = []
+        if self.buffered:
+            timeout = 0
         else:
-            try:
-                readable, writable, _ = select.select([self.socket.fileno(), self.control_out.fileno()] + read_needed, write_needed, [], self.opts.timeout)
-            except ValueError:  # self.socket.fileno() == -1
-                self.ready = False
-                self.log.error('Listening socket was unexpectedly terminated')
-                return
-            except (select.error, socket.error) as e:
-                # select.error has no errno attribute. errno is instead
-                # e.args[0]
-                if getattr(e, 'errno', e.args[0]) in socket_errors_eintr:
-                    return
-                for s, conn in tuple(self.connection_map.iteritems()):
-                    try:
-                        select.select([s], [], [], 0)
-                    except (select.error, socket.error) as e:
-                        if getattr(e, 'errno', e.args[0]) not in socket_errors_eintr:
-                            self.close(s, conn)  # Bad socket, discard
+            timeout = self.opts.timeout
+            if self.timeouts:
+                timeout = max(0, min(timeout, self.timeouts[0][0] - now))
+        try:
+            readable, writable = self.poller.poll(timeout)
+        except ValueError:  # self.socket.fileno() == -1
+            self.ready = False
+            self.log.error('Listening socket was unexpectedly terminated')
+            return
+        except (select.error, socket.error, EnvironmentError) as e:
+            # select.error has no errno attribute. errno is instead
+            # e.args[0]
+            if getattr(e, 'errno', e.args[0]) in socket_errors_eintr:
                 return
+            for s in tuple(self.poller.bad_fds()):
+                conn = self.connection_map.get(s)
+                if conn is None:
+                    self.poller.unregister(s)
+                else:
+                    self.close(s, conn)  # Bad socket, discard
+            return
+        if self.buffered:
+            readable = list(self.buffered.union(readable))
 
         if not self.ready:
             return
@@ -542,6 +687,32 @@ class ServerLoop(object):
                 else:
                     self.log.error('Error in SSL handshake, terminating connection: %s' % as_unicode(e))
                     self.close(s, conn)
+            if s in self.connection_map:
+                self.update_registration(s, conn)
+
+    def update_registration(self, s, conn):
+        wf = conn.wait_for
+        self.poller.register(s, wf)
+        if (wf is READ or wf is RDWR) and conn.read_buffer.has_data:
+            self.buffered.add(s)
+        else:
+            self.buffered.discard(s)
+
+    def check_timeouts(self, now):
+        timeouts, timeout = self.timeouts, self.opts.timeout
+        while timeouts and timeouts[0][0] <= now:
+            deadline, conn_id, s = heapq.heappop(timeouts)
+            conn = self.connection_map.get(s)
+            if conn is None or id(conn) != conn_id:
+                continue  # Connection was closed
+            if now - conn.last_activity >= timeout:
+                if conn.handle_timeout():
+                    conn.last_activity = now
+                else:
+                    self.log('Closing connection because of extended inactivity: %s' % conn.state_description)
+                    self.close(s, conn)
+                    continue
+            heapq.heappush(timeouts, (conn.last_activity + timeout, conn_id, s))
 
     def wakeup(self):
         self.control_in.sendall(WAKEUP)
@@ -552,15 +723,20 @@ class ServerLoop(object):
     def dispatch_job_results(self):
         while True:
             try:
-                s, ok, result = self.pool.get_nowait()
+                (s, connection_id), ok, result = self.pool.get_nowait()
             except Empty:
                 break
             conn = self.connection_map.get(s)
-            if conn is not None:
+            # The connection that queued the job may have been closed and its
+            # file descriptor re-used by a new connection
+            if conn is not None and conn.connection_id == connection_id:
                 yield s, conn, (ok, result)
 
     def close(self, s, conn):
         self.connection_map.pop(s, None)
+        self.poller.unregister(s)
+        self.buffered.discard(s)
+        conn.wait_for_changed = None
         conn.close()
 
     def get_actions(self, readable, writable):
@@ -574,6 +750,9 @@ class ServerLoop(object):
                     if s > -1:
                         self.connection_map[s] = conn = self.handler(
                             sock, self.opts, self.ssl_context, self.tdir, addr, self.pool, self.log, self.access_log, self.wakeup)
+                        conn.wait_for_changed = partial(self.state_changes.append, s)
+                        self.update_registration(s, conn)
+                        heapq.heappush(self.timeouts, (conn.last_activity + self.opts.timeout, id(conn), s))
                         if self.ssl_context is not None:
                             yield s, conn, RDWR
             elif s == control:
@@ -620,12 +799,14 @@ class ServerLoop(object):
         self.jobs_manager.shutdown()
         try:
             if getattr(self, 'socket', None):
+                self.poller.unregister(self.socket.fileno())
                 self.socket.close()
                 self.socket = None
         except socket.error:
             pass
         for s, conn in tuple(self.connection_map.iteritems()):
             self.close(s, conn)
+        self.timeouts = []
         wait_till = monotonic() + self.opts.shutdown_timeout
         for pool in (self.plugin_pool, self.pool):
             pool.stop(wait_till)
@@ -4,9 +4,9 @@
 
 from __future__ import (unicode_literals, division, absolute_import,
                         print_function)
-import os
+import os, weakref
 from copy import copy
-from collections import namedtuple
+from collections import OrderedDict, namedtuple
 from datetime import datetime, time
 from functools import partial
 from threading import Lock
@@ -25,6 +25,8 @@ from calibre.library.comments import comments_to_html, markdown
 from calibre.library.field_metadata import category_icon_map
 
 IGNORED_FIELDS = frozenset('cover ondevice path marked au_map size'.split())
+# The maximum number of serialized books kept in memory, per library
+BOOK_JSON_CACHE_SIZE = 4096
 
 
 def encode_datetime(dateval):
@@ -63,9 +65,74 @@ def add_field(field, db, book_id, ans, field_metadata):
             ans[field] = val
 
 
+class BookJSONCache(object):
+
+    '''
+    The serialized metadata of recently requested books of a library. Entries
+    are keyed by book id and the kind of serialization and are used only as
+    long as their version is unchanged. The version is the last modified time
+    of the book together with the count of changes to items shared by many
+    books, such as renamed tags, see :func:`book_json_version`, so edits are
+    never missed. Entries are also removed when the server is notified of
+    changes to books, see :meth:`Context.notify_changes`.
+    '''
+
+    def __init__(self, max_items=BOOK_JSON_CACHE_SIZE):
+        self.max_items = max_items
+        self.items = OrderedDict()
+        self.lock = Lock()
+
+    def get(self, key, version):
+        with self.lock:
+            entry = self.items.pop(key, None)
+            if entry is None or entry[0] != version:
+                return
+            self.items[key] = entry
+            return entry[1]
+
+    def set(self, key, version, data):
+        with self.lock:
+            self.items.pop(key, None)
+            self.items[key] = (version, data)
+            while len(self.items) > self.max_items:
+                self.items.popitem(last=False)
+
+    def invalidate(self, book_ids=None):
+        with self.lock:
+            if book_ids is None:
+                self.items.clear()
+            else:
+                for key in tuple(self.items):
+                    if key[0] in book_ids:
+                        del self.items[key]
+
+
+def book_json_version(db, last_modified):
+    return last_modified, db.new_api.item_changes
+
+
+book_json_caches = weakref.WeakKeyDictionary()
+book_json_caches_lock = Lock()
+
+
+def book_json_cache(db):
+    db = db.new_api
+    with book_json_caches_lock:
+        ans = book_json_caches.get(db)
+        if ans is None:
+            ans = book_json_caches[db] = BookJSONCache()
+        return ans
+
+
 def book_as_json(db, book_id):
     db = db.new_api
+    cache = book_json_cache(db)
+    key = book_id, 'interface'
     with db.safe_read_lock:
+        version = book_json_version(db, db._field_for('last_modified', book_id))
+        ans = cache.get(key, version)
+        if ans is not None:
+            return ans.copy()
         ans = {'formats':db._formats(book_id)}
         if not ans['formats'] and not db.has_id(book_id):
             return None
@@ -79,7 +146,8 @@ def book_as_json(db, book_id):
         langs = ans.get('languages')
         if langs:
             ans['lang_names'] = {l:calibre_langcode_to_name(l) for l in langs}
-    return ans
+        cache.set(key, version, ans)
+    return ans.copy()
 
 
 _include_fields = frozenset(Tag.__slots__) - frozenset({
@@ -394,7 +394,9 @@ def get_acquisition_feed(rc, ids, offset, page_url, up_url, id_,
         raise HTTPNotFound('No books found')
     with rc.db.safe_read_lock:
         sort_by = sanitize_sort_field_name(rc.db.field_metadata, sort_by)
-        items = rc.db.multisort([(sort_by, ascending)], ids)
+        # The sorted list is cached, so clients crawling a large feed page
+        # by page do not cause it to be sorted again for every page
+        items = rc.ctx.sort_books(rc.db, ids, [(sort_by, ascending)]).book_ids
         max_items = rc.opts.max_opds_items
         offsets = Offsets(offset, max_items, len(items))
         items = items[offsets.offset:offsets.offset+max_items]
@@ -60,10 +60,44 @@ raw_options = (
     'compress_min_size', 1024,
     None,
 
+    _('Max. disk space for cover thumbnails (in MB)'),
+    'max_thumbnail_cache_size', 256,
+    _('Thumbnails of book covers are stored on disk, so that they do not have to'
+      ' be re-generated, even after the server is restarted. When they use more'
+      ' than this amount of space, the least recently used thumbnails are removed.'
+      ' Set to zero to disable storing of thumbnails.'),
+
+    _('Max. disk space for books prepared for the in-browser viewer (in MB)'),
+    'max_render_cache_size', 2048,
+    _('Books are converted to a form that can be displayed by the in-browser'
+      ' viewer the first time they are opened. The converted books are stored on'
+      ' disk, when they use more than this amount of space, the least recently'
+      ' opened books are removed.'),
+
+    _('Number of recently added books to prepare for the in-browser viewer'),
+    'prerender_recent_books', 0,
+    _('Prepare this many of the most recently added books in the default library'
+      ' for the in-browser viewer when the server starts, as well as any books'
+      ' added while it is running, so that they open instantly. Zero disables'
+      ' this.'),
+
     _('Number of worker threads used to process requests'),
     'worker_count', 10,
     None,
 
+    _('Maximum number of worker threads used to process requests'),
+    'max_worker_count', 40,
+    _('When requests have to wait for a free worker thread, more threads are'
+      ' started, up to this number. Threads in excess of the normal number of'
+      ' worker threads are stopped once they are no longer needed.'),
+
+    _('Number of server processes'),
+    'worker_processes', 1,
+    _('Run this many server processes, all listening on the same port, so that'
+      ' requests can be processed on more than one CPU core. Each process opens'
+      ' the libraries independently and changes made through one process are'
+      ' propagated to the others. Only supported on Linux.'),
+
     _('Maximum number of worker processes'),
     'max_jobs', 0,
     _('Worker processes are launched as needed and used for large jobs such as preparing'
@@ -117,6 +151,12 @@ raw_options = (
     ' increasing performance. However, it can cause corrupted file transfers on some'
     ' broken filesystems. If you experience corrupted file transfers, turn it off.'),
 
+    _('Use HTTP/2 with browsers that support it'),
+    'enable_http2', True,
+    _('HTTP/2 allows browsers to make many requests over a single connection at the same time,'
+    ' which makes the in-browser viewer load much faster over slow networks. It is only'
+    ' available if the h2 python package is installed. Browsers only use HTTP/2 over SSL.'),
+
     _('Max. log file size (in MB)'),
     'max_log_size', 20,
     _('The maximum size of log files, generated by the server. When the log becomes larger'
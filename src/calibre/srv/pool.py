@@ -7,30 +7,59 @@ __license__ = 'GPL v3'
 __copyright__ = '2015, Kovid Goyal <kovid at kovidgoyal.net>'
 
 import sys
+from collections import deque, OrderedDict
 from Queue import Queue, Full
-from threading import Thread
+from threading import Thread, Condition
 
 from calibre.utils.monotonic import monotonic
 
+# The lanes that requests are scheduled in. Each lane may use at most the
+# specified fraction of the maximum number of worker threads, so that a burst
+# of slow requests cannot starve fast ones.
+DEFAULT_LANE, SLOW_LANE = 'default', 'slow'
+LANES = OrderedDict(((DEFAULT_LANE, 1.0), (SLOW_LANE, 0.5)))
+# Stop worker threads, above the minimum number, that have been idle for this
+# long (in seconds)
+SHRINK_IDLE_TIME = 60
+
+
+class Lane(object):
+
+    def __init__(self, name, fraction):
+        self.name, self.fraction = name, fraction
+        self.jobs = deque()
+        self.running = self.started = self.completed = 0
+        self.total_wait = self.max_wait = 0.0
+
+    def limit(self, num_workers):
+        return max(1, int(self.fraction * num_workers))
+
+    @property
+    def stats(self):
+        return {
+            'queued': len(self.jobs), 'running': self.running, 'completed': self.completed,
+            'average_wait': self.total_wait / max(1, self.started), 'max_wait': self.max_wait,
+        }
+
 
 class Worker(Thread):
 
     daemon = True
 
-    def __init__(self, log, notify_server, num, request_queue, result_queue):
-        self.request_queue, self.result_queue = request_queue, result_queue
+    def __init__(self, log, notify_server, num, pool, result_queue):
+        self.pool, self.result_queue = pool, result_queue
         self.notify_server = notify_server
         self.log = log
         self.working = False
+        self.idle_since = monotonic()
         Thread.__init__(self, name='ServerWorker%d' % num)
 
     def run(self):
         while True:
-            x = self.request_queue.get()
+            x = self.pool.next_job(self)
             if x is None:
                 break
-            job_id, func = x
-            self.working = True
+            lane, job_id, func = x
             try:
                 result = func()
             except Exception:
@@ -38,7 +67,7 @@ class Worker(Thread):
             else:
                 self.result_queue.put((job_id, True, result))
             finally:
-                self.working = False
+                self.pool.job_finished(self, lane)
             try:
                 self.notify_server()
             except Exception:
@@ -50,26 +79,118 @@ class Worker(Thread):
 
 class ThreadPool(object):
 
-    def __init__(self, log, notify_server, count=10, queue_size=1000):
-        self.request_queue, self.result_queue = Queue(queue_size), Queue(queue_size)
-        self.workers = [Worker(log, notify_server, i, self.request_queue, self.result_queue) for i in xrange(count)]
+    '''
+    Runs jobs in worker threads. Jobs are queued in lanes (see :data:`LANES`)
+    and each lane can only use some of the workers. Workers are picked up in
+    order of arrival across all lanes that are below their limit. The pool
+    starts with count workers and grows up to max_count when jobs would have
+    to wait in the queue, shrinking back when workers are idle.
+    '''
 
-    def start(self):
-        for w in self.workers:
+    def __init__(self, log, notify_server, count=10, queue_size=1000, max_count=None):
+        self.log, self.notify_server = log, notify_server
+        self.min_count, self.max_count = count, max(count, max_count or count)
+        self.queue_size, self.queued = queue_size, 0
+        self.result_queue = Queue(queue_size)
+        self.lanes = OrderedDict((name, Lane(name, fraction)) for name, fraction in LANES.iteritems())
+        self.cond = Condition()
+        self.started = self.stopping = False
+        self.excess = 0
+        self.worker_counter = 0
+        self.workers = []
+        for i in xrange(count):
+            self.add_worker()
+
+    def add_worker(self):
+        w = Worker(self.log, self.notify_server, self.worker_counter, self, self.result_queue)
+        self.worker_counter += 1
+        self.workers.append(w)
+        if self.started:
             w.start()
 
-    def put_nowait(self, job_id, func):
-        self.request_queue.put_nowait((job_id, func))
+    def start(self):
+        with self.cond:
+            self.started = True
+            for w in self.workers:
+                w.start()
+
+    def put_nowait(self, job_id, func, lane=DEFAULT_LANE):
+        with self.cond:
+            if self.queued >= self.queue_size:
+                raise Full()
+            lane = self.lanes.get(lane) or self.lanes[DEFAULT_LANE]
+            now = monotonic()
+            lane.jobs.append((now, job_id, func))
+            self.queued += 1
+            self.resize(now)
+            self.cond.notify()
 
     def get_nowait(self):
         return self.result_queue.get_nowait()
 
+    def runnable_lane(self):
+        # Must be called with the lock held. Returns the lane, below its
+        # limit, that has the job that has been waiting the longest.
+        ans = None
+        for lane in self.lanes.itervalues():
+            if lane.jobs and lane.running < lane.limit(self.max_count) and (ans is None or lane.jobs[0][0] < ans.jobs[0][0]):
+                ans = lane
+        return ans
+
+    def resize(self, now):
+        # Must be called with the lock held
+        if self.runnable_lane() is not None:
+            # A job would have to wait for a worker
+            if self.idle == 0 and len(self.workers) - self.excess < self.max_count:
+                self.add_worker()
+        elif len(self.workers) - self.excess > self.min_count:
+            idle = [w for w in self.workers if not w.working and now - w.idle_since > SHRINK_IDLE_TIME]
+            if len(idle) > 1:
+                self.excess += 1
+                self.cond.notify()
+
+    def next_job(self, worker):
+        with self.cond:
+            while True:
+                if self.stopping:
+                    return
+                if self.excess > 0:
+                    self.excess -= 1
+                    self.workers.remove(worker)
+                    if self.runnable_lane() is not None:
+                        self.cond.notify()  # pass on the wakeup meant for a job
+                    return
+                lane = self.runnable_lane()
+                if lane is not None:
+                    break
+                self.cond.wait()
+            queued_at, job_id, func = lane.jobs.popleft()
+            self.queued -= 1
+            lane.running += 1
+            lane.started += 1
+            worker.working = True
+            now = monotonic()
+            wait = now - queued_at
+            lane.total_wait += wait
+            lane.max_wait = max(lane.max_wait, wait)
+            self.resize(now)
+            return lane, job_id, func
+
+    def job_finished(self, worker, lane):
+        with self.cond:
+            lane.running -= 1
+            lane.completed += 1
+            worker.working = False
+            worker.idle_since = monotonic()
+            if lane.jobs:
+                # A job in this lane, that was held back by its limit, may
+                # now be runnable
+                self.cond.notify()
+
     def stop(self, wait_till):
-        for w in self.workers:
-            try:
-                self.request_queue.put_nowait(None)
-            except Full:
-                break
+        with self.cond:
+            self.stopping = True
+            self.cond.notify_all()
         for w in self.workers:
             now = monotonic()
             if now >= wait_till:
@@ -85,6 +206,16 @@ class ThreadPool(object):
     def idle(self):
         return sum(int(not w.working) for w in self.workers)
 
+    @property
+    def stats(self):
+        ''' Queue depth and wait time statistics (in seconds) per lane '''
+        with self.cond:
+            ans = {name: lane.stats for name, lane in self.lanes.iteritems()}
+            for name, lane in self.lanes.iteritems():
+                ans[name]['limit'] = lane.limit(self.max_count)
+            ans['workers'] = len(self.workers)
+            return ans
+
 
 class PluginPool(object):
 
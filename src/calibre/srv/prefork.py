@@ -0,0 +1,207 @@
+#!/usr/bin/env python2
+# vim:fileencoding=utf-8
+# License: GPLv3 Copyright: 2017, Kovid Goyal <kovid at kovidgoyal.net>
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import errno, os, select, signal, sys, traceback
+from multiprocessing import Pipe
+from threading import Lock, Thread
+
+from calibre.utils.logging import ThreadSafeLog
+from calibre.utils.monotonic import monotonic
+
+# A worker that dies within this many seconds of being started is assumed to
+# have failed to start, for example, because it could not bind to the port
+STARTUP_TIME = 5
+LIBRARY_CHANGED, STOP = 'library_changed', 'stop'
+
+
+class Worker(object):
+
+    def __init__(self, num, pid, conn):
+        self.num, self.pid, self.conn = num, pid, conn
+        self.start_time = monotonic()
+
+    def send(self, msg):
+        try:
+            self.conn.send(msg)
+        except EnvironmentError:
+            pass  # The worker has died, it will be reaped
+
+
+class WorkerConnection(object):
+
+    ''' The connection from a worker process to the coordinator. Changes made
+    to libraries by this worker are sent to the coordinator, which forwards
+    them to all other workers. '''
+
+    def __init__(self, conn, server):
+        self.conn, self.server = conn, server
+        self.send_lock = Lock()
+        self.listener = Thread(target=self.listen, name='CoordinatorListener')
+        self.listener.daemon = True
+
+    def notify_changes(self, library_path, change_event):
+        with self.send_lock:
+            try:
+                self.conn.send((LIBRARY_CHANGED, library_path))
+            except EnvironmentError:
+                pass
+
+    def listen(self):
+        log = self.server.loop.log
+        broker = self.server.handler.ctx.library_broker
+        while True:
+            try:
+                msg = self.conn.recv()
+            except (EOFError, EnvironmentError):
+                msg = (STOP,)
+            if msg[0] == STOP:
+                self.server.stop()
+                break
+            if msg[0] == LIBRARY_CHANGED:
+                try:
+                    broker.library_changed(msg[1])
+                except Exception:
+                    log.exception('Failed to reload the library at:', msg[1])
+
+
+def run_worker(conn, create_server):
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGHUP, signal.SIG_DFL)
+    wc = WorkerConnection(conn, None)
+    wc.server = server = create_server(notify_changes=wc.notify_changes)
+    signal.signal(signal.SIGTERM, lambda s, f: server.stop())
+    # The coordinator handles SIGINT (Ctrl-C) for the whole process group
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    wc.listener.start()
+    # Needed for dynamic cover generation, which uses Qt for drawing. Qt must
+    # only be initialized after forking.
+    from calibre.gui2 import ensure_app, load_builtin_fonts
+    ensure_app(), load_builtin_fonts()
+    server.serve_forever()
+
+
+class Coordinator(object):
+
+    '''
+    Runs the server in multiple worker processes. Each worker has its own
+    :class:`calibre.srv.loop.ServerLoop`, listening on the same address using
+    SO_REUSEPORT, so that the kernel distributes connections between them.
+    Each worker opens the libraries itself, the coordinator only restarts
+    workers that die and forwards library change notifications between
+    them. Caches that are stored on disk, such as the rendered books cache,
+    are shared by all workers.
+    '''
+
+    def __init__(self, create_server, opts, log=None):
+        self.create_server = create_server
+        self.opts = opts
+        self.num_workers = max(1, opts.worker_processes)
+        self.log = log or ThreadSafeLog(level=ThreadSafeLog.DEBUG)
+        self.workers = {}
+        self.ready = False
+        self.failure = None
+
+    def spawn(self, num):
+        conn, child_conn = Pipe()
+        pid = os.fork()
+        if pid == 0:
+            conn.close()
+            for w in self.workers.itervalues():
+                w.conn.close()
+            status = 0
+            try:
+                run_worker(child_conn, self.create_server)
+            except BaseException:
+                traceback.print_exc()
+                status = 1
+            finally:
+                sys.stdout.flush(), sys.stderr.flush()
+                os._exit(status)
+        child_conn.close()
+        self.workers[pid] = Worker(num, pid, conn)
+
+    def stop(self):
+        self.ready = False
+
+    def run(self):
+        self.ready = True
+        for i in xrange(self.num_workers):
+            self.spawn(i)
+        self.log('Started %d server processes' % self.num_workers)
+        while self.ready:
+            try:
+                self.tick()
+            except KeyboardInterrupt:
+                break
+        self.shutdown()
+        if self.failure is not None:
+            raise SystemExit(self.failure)
+
+    def tick(self):
+        fd_map = {w.conn.fileno(): w for w in self.workers.itervalues()}
+        try:
+            readable = select.select(list(fd_map), [], [], 1)[0]
+        except (select.error, EnvironmentError) as e:
+            if e.args[0] != errno.EINTR:
+                raise
+            readable = ()
+        for fd in readable:
+            src = fd_map[fd]
+            try:
+                msg = src.conn.recv()
+            except (EOFError, EnvironmentError):
+                continue  # The worker has died, it will be reaped below
+            if msg[0] == LIBRARY_CHANGED:
+                for w in self.workers.itervalues():
+                    if w is not src:
+                        w.send(msg)
+        self.reap()
+
+    def reap(self):
+        while self.workers:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except EnvironmentError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                if e.errno == errno.ECHILD:
+                    break
+                raise
+            if pid == 0:
+                break
+            w = self.workers.pop(pid, None)
+            if w is None:
+                continue
+            w.conn.close()
+            if not self.ready:
+                continue
+            if status != 0 and monotonic() - w.start_time < STARTUP_TIME:
+                self.failure = 'Server process %d failed to start, exiting' % w.num
+                self.log.error(self.failure)
+                self.stop()
+                break
+            self.log.warn('Server process %d (pid: %d) exited with status: %d, restarting it' % (w.num, pid, status))
+            self.spawn(w.num)
+
+    def shutdown(self):
+        for w in self.workers.itervalues():
+            w.send((STOP,))
+        wait_till = monotonic() + self.opts.shutdown_timeout + 1
+        while self.workers and monotonic() < wait_till:
+            self.reap()
+            if self.workers:
+                try:
+                    select.select([], [], [], 0.1)
+                except select.error:
+                    pass
+        for pid in tuple(self.workers):
+            self.log.warn('Server process with pid: %d did not shutdown cleanly, killing it' % pid)
+            try:
+                os.kill(pid, signal.SIGKILL)
+                os.waitpid(pid, 0)
+            except EnvironmentError:
+                pass
+            self.workers.pop(pid).conn.close()
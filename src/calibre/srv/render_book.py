@@ -16,7 +16,7 @@ from urllib import quote
 from cssutils import replaceUrls
 from cssutils.css import CSSRule
 
-from calibre import prepare_string_for_xml
+from calibre import detect_ncpus, prepare_string_for_xml
 from calibre.ebooks import parse_css_length
 from calibre.ebooks.oeb.base import (
     OEB_DOCS, OEB_STYLES, rewrite_links, XPath, urlunquote, XLINK, XHTML_NS, OPF, XHTML, EPUB_NS)
@@ -28,10 +28,15 @@ from calibre.ebooks.oeb.polish.utils import extract
 from calibre.ebooks.css_transform_rules import StyleDeclaration
 from calibre.ebooks.oeb.polish.toc import get_toc, get_landmarks
 from calibre.ebooks.oeb.polish.utils import guess_type
+from calibre.utils.filenames import atomic_rename
 from calibre.utils.short_uuid import uuid4
 from calibre.utils.logging import default_log
 
 RENDER_VERSION = 1
+PROGRESS_NAME = 'calibre-book-render-progress.json'
+# Books with fewer files than this many per worker process are rendered in a
+# single process, as starting worker processes has a significant overhead
+FILES_PER_WORKER = 10
 
 BLANK_JPEG = b'\xff\xd8\xff\xdb\x00C\x00\x03\x02\x02\x02\x02\x02\x03\x02\x02\x02\x03\x03\x03\x03\x04\x06\x04\x04\x04\x04\x04\x08\x06\x06\x05\x06\t\x08\n\n\t\x08\t\t\n\x0c\x0f\x0c\n\x0b\x0e\x0b\t\t\r\x11\r\x0e\x0f\x10\x10\x11\x10\n\x0c\x12\x13\x12\x10\x13\x0f\x10\x10\x10\xff\xc9\x00\x0b\x08\x00\x01\x00\x01\x01\x01\x11\x00\xff\xcc\x00\x06\x00\x10\x10\x05\xff\xda\x00\x08\x01\x01\x00\x00?\x00\xd2\xcf \xff\xd9'  # noqa
 
@@ -168,134 +173,83 @@ def toc_anchor_map(toc):
     return dict(ans)
 
 
-class Container(ContainerBase):
+class SimpleContainer(ContainerBase):
+
+    ''' Transforms the individual files of an already extracted book. Used by
+    the worker processes that render the files of a book in parallel. '''
 
     tweak_mode = True
 
-    def __init__(self, path_to_ebook, tdir, log=None, book_hash=None):
-        log = log or default_log
-        book_fmt, opfpath, input_fmt = extract_book(path_to_ebook, tdir, log=log)
+    def __init__(self, tdir, opfpath, log, link_uid):
         ContainerBase.__init__(self, tdir, opfpath, log)
-        excluded_names = {
-            name for name, mt in self.mime_map.iteritems() if
-            name == self.opf_name or mt == guess_type('a.ncx') or name.startswith('META-INF/') or
-            name == 'mimetype'
-        }
-        raster_cover_name, titlepage_name = self.create_cover_page(input_fmt.lower())
-        toc = get_toc(self).to_dict(count())
-        spine = [name for name, is_linear in self.spine_names]
-        spineq = frozenset(spine)
-        landmarks = [l for l in get_landmarks(self) if l['dest'] in spineq]
-
-        self.book_render_data = data = {
-            'version': RENDER_VERSION,
-            'toc':toc,
-            'spine':spine,
-            'link_uid': uuid4(),
-            'book_hash': book_hash,
-            'is_comic': input_fmt.lower() in {'cbc', 'cbz', 'cbr', 'cb7'},
-            'raster_cover_name': raster_cover_name,
-            'title_page_name': titlepage_name,
-            'has_maths': False,
-            'total_length': 0,
-            'spine_length': 0,
-            'toc_anchor_map': toc_anchor_map(toc),
-            'landmarks': landmarks,
-        }
-        # Mark the spine as dirty since we have to ensure it is normalized
-        for name in data['spine']:
-            self.parsed(name), self.dirty(name)
-        self.transform_css()
+        self.link_uid = link_uid
         self.virtualized_names = set()
-        self.virtualize_resources()
-
-        def manifest_data(name):
-            mt = (self.mime_map.get(name) or 'application/octet-stream').lower()
-            ans = {
-                'size':os.path.getsize(self.name_path_map[name]),
-                'is_virtualized': name in self.virtualized_names,
-                'mimetype':mt,
-                'is_html': mt in OEB_DOCS,
-            }
-            if ans['is_html']:
-                root = self.parsed(name)
-                ans['length'] = l = get_length(root)
-                self.book_render_data['total_length'] += l
-                if name in data['spine']:
-                    self.book_render_data['spine_length'] += l
-                ans['has_maths'] = hm = check_for_maths(root)
-                if hm:
-                    self.book_render_data['has_maths'] = True
-                ans['anchor_map'] = anchor_map(root)
-            return ans
-        data['files'] = {name:manifest_data(name) for name in set(self.name_path_map) - excluded_names}
-        self.commit()
-        for name in excluded_names:
-            os.remove(self.name_path_map[name])
-        with lopen(os.path.join(self.root, 'calibre-book-manifest.json'), 'wb') as f:
-            f.write(json.dumps(self.book_render_data, ensure_ascii=False).encode('utf-8'))
 
-    def create_cover_page(self, input_fmt):
-        templ = '''
-        <html xmlns="http://www.w3.org/1999/xhtml" xml:lang="en">
-        <head><style>
-        html, body, img { height: 100vh; display: block; margin: 0; padding: 0; border-width: 0; }
-        img {
-            width: auto; height: auto;
-            margin-left: auto; margin-right: auto;
-            max-width: 100vw; max-height: 100vh
+    def process_file(self, name, in_spine=False):
+        ''' Transform the specified file, writing it to disk. Returns the
+        manifest data for the file and for any stylesheets created from its
+        <style> tags. '''
+        if in_spine:
+            # Mark the spine as dirty since we have to ensure it is normalized
+            self.parsed(name), self.dirty(name)
+        names = [name] + self.transform_css(name)
+        self.virtualize_resources(names)
+        ans = {}
+        for name in names:
+            ans[name] = self.manifest_data(name)
+            if name in self.dirtied:
+                self.commit_item(name)
+            else:
+                self.parsed_cache.pop(name, None)
+            ans[name]['size'] = os.path.getsize(self.name_path_map[name])
+        return ans
+
+    def manifest_data(self, name):
+        mt = (self.mime_map.get(name) or 'application/octet-stream').lower()
+        ans = {
+            'size':os.path.getsize(self.name_path_map[name]),
+            'is_virtualized': name in self.virtualized_names,
+            'mimetype':mt,
+            'is_html': mt in OEB_DOCS,
         }
-        </style></head><body><img src="%s"/></body></html>
-        '''
-        if input_fmt == 'epub':
-            def cover_path(action, data):
-                if action == 'write_image':
-                    data.write(BLANK_JPEG)
-            return set_epub_cover(self, cover_path, (lambda *a: None), options={'template':templ})
-        raster_cover_name = find_cover_image(self, strict=True)
-        if raster_cover_name is None:
-            item = self.generate_item(name='cover.jpeg', id_prefix='cover')
-            raster_cover_name = self.href_to_name(item.get('href'), self.opf_name)
-        with self.open(raster_cover_name, 'wb') as dest:
-            dest.write(BLANK_JPEG)
-        item = self.generate_item(name='titlepage.html', id_prefix='titlepage')
-        titlepage_name = self.href_to_name(item.get('href'), self.opf_name)
-        raw = templ % prepare_string_for_xml(self.name_to_href(raster_cover_name, titlepage_name), True)
-        with self.open(titlepage_name, 'wb') as f:
-            f.write(raw.encode('utf-8'))
-        spine = self.opf_xpath('//opf:spine')[0]
-        ref = spine.makeelement(OPF('itemref'), idref=item.get('id'))
-        self.insert_into_xml(spine, ref, index=0)
-        self.dirty(self.opf_name)
-        return raster_cover_name, titlepage_name
-
-    def transform_css(self):
-        transform_css(self, transform_sheet=transform_sheet, transform_style=transform_declaration)
+        if ans['is_html']:
+            root = self.parsed(name)
+            ans['length'] = get_length(root)
+            ans['has_maths'] = check_for_maths(root)
+            ans['anchor_map'] = anchor_map(root)
+        return ans
+
+    def transform_css(self, name):
+        ''' Transform the CSS in the specified file. Returns the names of the
+        stylesheets created from its <style> tags. '''
+        transform_css(self, transform_sheet=transform_sheet, transform_style=transform_declaration, names=(name,))
+        ans = []
+        if self.mime_map[name].lower() not in OEB_DOCS:
+            return ans
         # Firefox flakes out sometimes when dynamically creating <style> tags,
         # so convert them to external stylesheets to ensure they never fail
         style_xpath = XPath('//h:style')
-        for name, mt in tuple(self.mime_map.iteritems()):
-            mt = mt.lower()
-            if mt in OEB_DOCS:
-                head = ensure_head(self.parsed(name))
-                for style in style_xpath(self.parsed(name)):
-                    if style.text and (style.get('type') or 'text/css').lower() == 'text/css':
-                        in_head = has_ancestor(style, head)
-                        if not in_head:
-                            extract(style)
-                            head.append(style)
-                        css = style.text
-                        style.clear()
-                        style.tag = XHTML('link')
-                        style.set('type', 'text/css')
-                        style.set('rel', 'stylesheet')
-                        sname = self.add_file(name + '.css', css.encode('utf-8'), modify_name_if_needed=True)
-                        style.set('href', self.name_to_href(sname, name))
-
-    def virtualize_resources(self):
+        head = ensure_head(self.parsed(name))
+        for style in style_xpath(self.parsed(name)):
+            if style.text and (style.get('type') or 'text/css').lower() == 'text/css':
+                in_head = has_ancestor(style, head)
+                if not in_head:
+                    extract(style)
+                    head.append(style)
+                css = style.text
+                style.clear()
+                style.tag = XHTML('link')
+                style.set('type', 'text/css')
+                style.set('rel', 'stylesheet')
+                sname = self.add_file(name + '.css', css.encode('utf-8'), modify_name_if_needed=True)
+                style.set('href', self.name_to_href(sname, name))
+                ans.append(sname)
+        return ans
+
+    def virtualize_resources(self, names):
 
         changed = set()
-        link_uid = self.book_render_data['link_uid']
+        link_uid = self.link_uid
         resource_template = link_uid + '|{}|'
         xlink_xpath = XPath('//*[@xl:href]')
         link_xpath = XPath('//h:a[@href]')
@@ -326,8 +280,8 @@ class Container(ContainerBase):
                 changed.add(base)
             return url
 
-        for name, mt in self.mime_map.iteritems():
-            mt = mt.lower()
+        for name in names:
+            mt = self.mime_map[name].lower()
             if mt in OEB_STYLES:
                 replaceUrls(self.parsed(name), partial(link_replacer, name))
                 self.virtualized_names.add(name)
@@ -370,6 +324,138 @@ class Container(ContainerBase):
         return json.dumps(html_as_dict(root), ensure_ascii=False, separators=(',', ':')).encode('utf-8')
 
 
+class Container(SimpleContainer):
+
+    def __init__(self, path_to_ebook, tdir, log=None, book_hash=None, max_workers=None):
+        log = log or default_log
+        book_fmt, opfpath, input_fmt = extract_book(path_to_ebook, tdir, log=log)
+        SimpleContainer.__init__(self, tdir, opfpath, log, uuid4())
+        excluded_names = {
+            name for name, mt in self.mime_map.iteritems() if
+            name == self.opf_name or mt == guess_type('a.ncx') or name.startswith('META-INF/') or
+            name == 'mimetype'
+        }
+        raster_cover_name, titlepage_name = self.create_cover_page(input_fmt.lower())
+        toc = get_toc(self).to_dict(count())
+        spine = [name for name, is_linear in self.spine_names]
+        spineq = frozenset(spine)
+        landmarks = [l for l in get_landmarks(self) if l['dest'] in spineq]
+
+        self.book_render_data = data = {
+            'version': RENDER_VERSION,
+            'toc':toc,
+            'spine':spine,
+            'link_uid': self.link_uid,
+            'book_hash': book_hash,
+            'is_comic': input_fmt.lower() in {'cbc', 'cbz', 'cbr', 'cb7'},
+            'raster_cover_name': raster_cover_name,
+            'title_page_name': titlepage_name,
+            'has_maths': False,
+            'total_length': 0,
+            'spine_length': 0,
+            'toc_anchor_map': toc_anchor_map(toc),
+            'landmarks': landmarks,
+        }
+        # Write out the changes made so far, so that they are seen by the
+        # worker processes
+        self.commit()
+
+        # The files are transformed in spine order, so that the start of the
+        # book is ready first
+        names = set(self.name_path_map) - excluded_names
+        spine_pos = {name:i for i, name in enumerate(spine)}
+        tasks = sorted((
+            name for name in names if self.mime_map[name].lower() in OEB_DOCS | OEB_STYLES | {'image/svg+xml'}),
+            key=lambda name: (spine_pos.get(name, len(spine)), name))
+        tasks = [(name, name in spineq) for name in tasks]
+        if max_workers is None:
+            max_workers = min(detect_ncpus(), len(tasks) // FILES_PER_WORKER)
+        if max_workers > 1:
+            files = self.process_files_in_pool(tasks, max_workers)
+        else:
+            files = {}
+            for i, (name, in_spine) in enumerate(tasks):
+                files.update(self.process_file(name, in_spine))
+                self.report_progress(i + 1, len(tasks))
+        for name in names - set(files):
+            files[name] = self.manifest_data(name)
+        for name, ans in files.iteritems():
+            if ans['is_html']:
+                data['total_length'] += ans['length']
+                if name in spineq:
+                    data['spine_length'] += ans['length']
+                if ans['has_maths']:
+                    data['has_maths'] = True
+        data['files'] = files
+        for name in excluded_names:
+            os.remove(self.name_path_map[name])
+        try:
+            os.remove(os.path.join(self.root, PROGRESS_NAME))
+        except EnvironmentError:
+            pass
+        with lopen(os.path.join(self.root, 'calibre-book-manifest.json'), 'wb') as f:
+            f.write(json.dumps(self.book_render_data, ensure_ascii=False).encode('utf-8'))
+
+    def process_files_in_pool(self, tasks, max_workers):
+        from calibre.utils.ipc.pool import run_jobs
+        ans = {}
+        for i, (idx, result) in enumerate(run_jobs(
+                tasks, 'calibre.srv.render_book', 'process_file_in_worker',
+                common_data=(self.root, self.name_to_abspath(self.opf_name), self.link_uid),
+                max_workers=max_workers, name='RenderBook')):
+            ans.update(result)
+            self.report_progress(i + 1, len(tasks))
+        # Pick up the stylesheets created by the workers
+        for name, data in ans.iteritems():
+            if name not in self.name_path_map:
+                self.name_path_map[name] = self.name_to_abspath(name)
+                self.mime_map[name] = data['mimetype']
+        return ans
+
+    def report_progress(self, done, total):
+        path = os.path.join(self.root, PROGRESS_NAME)
+        try:
+            with lopen(path + '.tmp', 'wb') as f:
+                f.write(json.dumps({'done':done, 'total':total}))
+            atomic_rename(path + '.tmp', path)
+        except EnvironmentError:
+            pass
+
+    def create_cover_page(self, input_fmt):
+        templ = '''
+        <html xmlns="http://www.w3.org/1999/xhtml" xml:lang="en">
+        <head><style>
+        html, body, img { height: 100vh; display: block; margin: 0; padding: 0; border-width: 0; }
+        img {
+            width: auto; height: auto;
+            margin-left: auto; margin-right: auto;
+            max-width: 100vw; max-height: 100vh
+        }
+        </style></head><body><img src="%s"/></body></html>
+        '''
+        if input_fmt == 'epub':
+            def cover_path(action, data):
+                if action == 'write_image':
+                    data.write(BLANK_JPEG)
+            return set_epub_cover(self, cover_path, (lambda *a: None), options={'template':templ})
+        raster_cover_name = find_cover_image(self, strict=True)
+        if raster_cover_name is None:
+            item = self.generate_item(name='cover.jpeg', id_prefix='cover')
+            raster_cover_name = self.href_to_name(item.get('href'), self.opf_name)
+        with self.open(raster_cover_name, 'wb') as dest:
+            dest.write(BLANK_JPEG)
+        item = self.generate_item(name='titlepage.html', id_prefix='titlepage')
+        titlepage_name = self.href_to_name(item.get('href'), self.opf_name)
+        raw = templ % prepare_string_for_xml(self.name_to_href(raster_cover_name, titlepage_name), True)
+        with self.open(titlepage_name, 'wb') as f:
+            f.write(raw.encode('utf-8'))
+        spine = self.opf_xpath('//opf:spine')[0]
+        ref = spine.makeelement(OPF('itemref'), idref=item.get('id'))
+        self.insert_into_xml(spine, ref, index=0)
+        self.dirty(self.opf_name)
+        return raster_cover_name, titlepage_name
+
+
 def split_name(name):
     l, r = name.partition('}')[::2]
     if r:
@@ -507,8 +593,29 @@ def html_as_dict(root):
     return {'ns_map':ns_map, 'tag_map':tags, 'tree':tree}
 
 
-def render(pathtoebook, output_dir, book_hash=None):
-    Container(pathtoebook, output_dir, book_hash=book_hash)
+worker_container = None
+
+
+def process_file_in_worker(name, in_spine, common_data=None):
+    global worker_container
+    root, opfpath, link_uid = common_data
+    if worker_container is None or worker_container.root != os.path.abspath(root):
+        worker_container = SimpleContainer(root, opfpath, default_log, link_uid)
+    return worker_container.process_file(name, in_spine)
+
+
+def render(pathtoebook, output_dir, book_hash=None, max_workers=None):
+    Container(pathtoebook, output_dir, book_hash=book_hash, max_workers=max_workers)
+
+
+def read_progress(output_dir):
+    ' Return the fraction of the files of a book being rendered that are done '
+    try:
+        with lopen(os.path.join(output_dir, PROGRESS_NAME), 'rb') as f:
+            ans = json.load(f)
+        return ans['done'] / max(1, ans['total'])
+    except Exception:
+        return 0
 
 
 if __name__ == '__main__':
@@ -0,0 +1,280 @@
+#!/usr/bin/env python2
+# vim:fileencoding=utf-8
+# License: GPLv3 Copyright: 2017, Kovid Goyal <kovid at kovidgoyal.net>
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import errno, json, os, shutil, tempfile, time
+from collections import OrderedDict, namedtuple
+from threading import Lock, RLock
+
+from calibre.utils.filenames import atomic_rename
+from calibre.utils.lock import ExclusiveFile
+
+INDEX_NAME = 'index.json'
+INDEX_VERSION = 1
+MANIFEST_NAME = 'calibre-book-manifest.json'
+# Access times are saved to the index at most this often (in seconds). Books
+# being added or removed cause the index to be saved immediately.
+INDEX_SAVE_INTERVAL = 60
+# A staging directory that has no lock file and is older than this (in
+# seconds) was left behind by a process that crashed while creating it
+STALE_STAGING_AGE = 60 * 60
+
+Entry = namedtuple('Entry', 'size atime')
+
+
+def safe_remove(x, is_file=None):
+    if is_file is None:
+        is_file = os.path.isfile(x)
+    try:
+        os.remove(x) if is_file else shutil.rmtree(x, ignore_errors=True)
+    except EnvironmentError:
+        pass
+
+
+def listdir(path):
+    try:
+        return os.listdir(path)
+    except EnvironmentError:
+        return ()
+
+
+def dir_size(path):
+    ans = 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        for name in filenames:
+            try:
+                ans += os.path.getsize(os.path.join(dirpath, name))
+            except EnvironmentError:
+                pass
+    return ans
+
+
+def try_lock(path):
+    ' Return an open file holding an exclusive lock on path or None if some other process holds the lock '
+    try:
+        return ExclusiveFile(path, timeout=0).__enter__()
+    except EnvironmentError:
+        return None
+
+
+class RenderCache(object):
+
+    '''
+    The books rendered for the in-browser viewer. Rendered books are stored in
+    the f sub-directory, in a directory per book hash, books being rendered are
+    in the s sub-directory. The disk space used is bounded by max_size (in MB),
+    the books that were least recently opened are removed first.
+
+    The sizes and access times of the rendered books are kept in an index
+    file, so that the rendered books do not have to be scanned on startup. The
+    cache can be shared by several server processes. Lock files are used to
+    ensure that a book is rendered by only one process at a time.
+    '''
+
+    def __init__(self, location, max_size):
+        self.location = location
+        self.final_dir, self.staging_root = os.path.join(location, 'f'), os.path.join(location, 's')
+        self.index_path = os.path.join(self.final_dir, INDEX_NAME)
+        self.max_size = int(max_size * 1024 * 1024)
+        self.lock = RLock()
+        self.items = None
+        self.total_size = 0
+        self.last_index_save = 0
+        self.staging = self.staging_lock = None
+        self.render_locks = {}
+
+    # Index {{{
+    def ensure_index(self):
+        # Must be called with the lock held
+        if self.items is not None:
+            return
+        items = {}
+        try:
+            with lopen(self.index_path, 'rb') as f:
+                data = json.load(f)
+            if data['version'] == INDEX_VERSION:
+                items = {k: Entry(*v) for k, v in data['items'].iteritems()}
+        except (EnvironmentError, ValueError, KeyError, TypeError):
+            pass
+        # Only rendered books missing from the index (for instance, because
+        # they were added by another process since it was saved) are scanned
+        present = frozenset(x for x in listdir(self.final_dir) if x != INDEX_NAME and not x.endswith('.tmp'))
+        for bhash in present - frozenset(items):
+            path = os.path.join(self.final_dir, bhash)
+            try:
+                atime = os.path.getmtime(os.path.join(path, MANIFEST_NAME))
+            except EnvironmentError:
+                # An incomplete or very old rendered book
+                safe_remove(path, False)
+                continue
+            items[bhash] = Entry(dir_size(path), atime)
+        self.items = OrderedDict()
+        self.total_size = 0
+        for bhash, entry in sorted(items.iteritems(), key=lambda x: x[1].atime):
+            if bhash in present:
+                self.items[bhash] = entry
+                self.total_size += entry.size
+        self.apply_size()
+        self.save_index()
+
+    def save_index(self):
+        # Must be called with the lock held
+        self.last_index_save = time.time()
+        data = json.dumps({'version': INDEX_VERSION, 'items': self.items})
+        tpath = '%s.%d.tmp' % (self.index_path, os.getpid())
+        try:
+            with lopen(tpath, 'wb') as f:
+                f.write(data.encode('utf-8') if not isinstance(data, bytes) else data)
+            atomic_rename(tpath, self.index_path)
+        except EnvironmentError:
+            safe_remove(tpath, True)
+
+    def maybe_save_index(self):
+        if time.time() - self.last_index_save > INDEX_SAVE_INTERVAL:
+            self.save_index()
+
+    def remove_entry(self, bhash):
+        entry = self.items.pop(bhash, None)
+        if entry is not None:
+            self.total_size -= entry.size
+        safe_remove(os.path.join(self.final_dir, bhash), False)
+
+    def apply_size(self):
+        # The most recently used book is never removed, so that a book larger
+        # than the quota can still be opened
+        while self.total_size > self.max_size and len(self.items) > 1:
+            self.remove_entry(next(self.items.iterkeys()))
+    # }}}
+
+    def manifest(self, bhash):
+        ' Return the manifest of the rendered book or None if it has not been rendered '
+        path = os.path.join(self.final_dir, bhash, MANIFEST_NAME)
+        try:
+            with lopen(path, 'rb') as f:
+                ans = json.load(f)
+        except EnvironmentError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            with self.lock:
+                if self.items is not None and bhash in self.items:
+                    # Removed by another process sharing this cache
+                    self.total_size -= self.items.pop(bhash).size
+                    self.maybe_save_index()
+            return
+        self.touch(bhash)
+        return ans
+
+    def touch(self, bhash):
+        with self.lock:
+            self.ensure_index()
+            entry = self.items.pop(bhash, None)
+            if entry is None:
+                entry = Entry(dir_size(os.path.join(self.final_dir, bhash)), 0)
+                self.total_size += entry.size
+            self.items[bhash] = Entry(entry.size, time.time())
+            self.apply_size()
+            self.maybe_save_index()
+        try:
+            os.utime(os.path.join(self.final_dir, bhash, MANIFEST_NAME), None)
+        except EnvironmentError:
+            pass
+
+    def add(self, bhash, tdir):
+        ' Move a book rendered into tdir into the cache '
+        dest = os.path.join(self.final_dir, bhash)
+        with self.lock:
+            self.ensure_index()
+            if os.path.exists(os.path.join(dest, MANIFEST_NAME)):
+                # Already rendered by another process, do not replace a book
+                # whose files may be being served
+                safe_remove(tdir, False)
+            else:
+                safe_remove(dest, False)
+                os.rename(tdir, dest)
+            old = self.items.pop(bhash, None)
+            if old is not None:
+                self.total_size -= old.size
+            entry = self.items[bhash] = Entry(dir_size(dest), time.time())
+            self.total_size += entry.size
+            self.apply_size()
+            self.save_index()
+
+    def remove(self, bhash):
+        with self.lock:
+            self.ensure_index()
+            self.remove_entry(bhash)
+            self.save_index()
+
+    # Rendering {{{
+    def staging_dir(self):
+        ' A directory, private to this process, in which to render books '
+        with self.lock:
+            if self.staging is None:
+                self.clean_staging()
+                self.staging = tempfile.mkdtemp(prefix='p', dir=self.staging_root)
+                self.staging_lock = try_lock(os.path.join(self.staging, 'lock'))
+            return self.staging
+
+    def clean_staging(self):
+        # Remove the staging directories and render locks of processes that
+        # are no longer running
+        now = time.time()
+        for name in listdir(self.staging_root):
+            path = os.path.join(self.staging_root, name)
+            if name.endswith('.lock'):
+                f = try_lock(path)
+                if f is not None:
+                    f.close()
+                    safe_remove(path, True)
+                continue
+            if not os.path.isdir(path):
+                safe_remove(path, True)
+                continue
+            lpath = os.path.join(path, 'lock')
+            if not os.path.exists(lpath):
+                try:
+                    if now - os.path.getmtime(path) < STALE_STAGING_AGE:
+                        continue  # Being created by another process
+                except EnvironmentError:
+                    continue
+            else:
+                f = try_lock(lpath)
+                if f is None:
+                    continue
+                f.close()
+            safe_remove(path, False)
+
+    def claim(self, bhash):
+        ''' Become the process that renders the specified book. Returns False if
+        it is already being rendered. '''
+        with self.lock:
+            if bhash in self.render_locks:
+                return False
+            path = os.path.join(self.staging_root, bhash + '.lock')
+            f = try_lock(path)
+            if f is None:
+                return False
+            self.render_locks[bhash] = (f, path)
+            return True
+
+    def release(self, bhash):
+        with self.lock:
+            x = self.render_locks.pop(bhash, None)
+            if x is not None:
+                x[0].close()
+                safe_remove(x[1], True)
+    # }}}
+
+
+caches = {}
+caches_lock = Lock()
+
+
+def render_cache(location, max_size):
+    with caches_lock:
+        ans = caches.get(location)
+        if ans is None:
+            ans = caches[location] = RenderCache(location, max_size)
+        return ans
@@ -12,6 +12,7 @@ from itertools import izip
 from operator import attrgetter
 
 from calibre.srv.errors import HTTPSimpleResponse, HTTPNotFound, RouteError
+from calibre.srv.pool import DEFAULT_LANE
 from calibre.srv.utils import http_date
 from calibre.utils.serialize import msgpack_dumps, json_dumps, MSGPACK_MIME
 
@@ -66,7 +67,13 @@ def endpoint(route,
              # 200 for GET and HEAD and 201 for POST
              ok_code=None,
 
-             postprocess=None
+             postprocess=None,
+
+             # The thread pool lane in which requests for this endpoint are
+             # processed, see calibre.srv.pool.LANES. Can also be a function
+             # that is called with the URL path arguments of the request and
+             # returns the lane.
+             lane=DEFAULT_LANE
 ):
     from calibre.srv.handler import Context
     from calibre.srv.http_response import RequestData
@@ -81,6 +88,7 @@ def endpoint(route,
         f.cache_control = cache_control
         f.postprocess = postprocess
         f.ok_code = ok_code
+        f.lane = lane
         f.is_endpoint = True
         argspec = inspect.getargspec(f)
         if len(argspec.args) < 2:
@@ -289,6 +297,14 @@ class Router(object):
                         # need more sophisticated value parsing
                         c[k] = v.strip('"')
 
+    def lane_for(self, data):
+        try:
+            endpoint_, args = self.find_route(data.path)
+        except HTTPNotFound:
+            return DEFAULT_LANE
+        lane = endpoint_.lane
+        return lane(*args) if callable(lane) else lane
+
     def dispatch(self, data):
         endpoint_, args = self.find_route(data.path)
         if data.method not in endpoint_.methods:
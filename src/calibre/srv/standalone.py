@@ -10,11 +10,12 @@ import sys, os, signal
 from functools import partial
 
 from calibre import as_unicode, prints
-from calibre.constants import plugins, iswindows, preferred_encoding, is_running_from_develop
+from calibre.constants import plugins, iswindows, islinux, preferred_encoding, is_running_from_develop
 from calibre.srv.loop import ServerLoop
 from calibre.srv.library_broker import load_gui_libraries
 from calibre.srv.bonjour import BonJour
 from calibre.srv.opts import opts_to_parser
+from calibre.srv.content import static_resource_paths
 from calibre.srv.http_response import create_http_handler
 from calibre.srv.handler import Handler
 from calibre.srv.utils import RotatingLog
@@ -61,18 +62,19 @@ def daemonize():  # {{{
 
 class Server(object):
 
-    def __init__(self, libraries, opts):
+    def __init__(self, libraries, opts, notify_changes=None):
         log = access_log = None
         log_size = opts.max_log_size * 1024 * 1024
         if opts.log:
             log = RotatingLog(opts.log, max_size=log_size)
         if opts.access_log:
             access_log = RotatingLog(opts.access_log, max_size=log_size)
-        self.handler = Handler(libraries, opts)
+        self.handler = Handler(libraries, opts, notify_changes=notify_changes)
         plugins = []
         if opts.use_bonjour:
             plugins.append(BonJour())
-        self.loop = ServerLoop(create_http_handler(self.handler.dispatch), opts=opts, log=log, access_log=access_log, plugins=plugins)
+        http_handler = create_http_handler(self.handler.dispatch, lane_for=self.handler.lane_for)
+        self.loop = ServerLoop(http_handler, opts=opts, log=log, access_log=access_log, plugins=plugins)
         self.handler.set_log(self.loop.log)
         self.handler.set_jobs_manager(self.loop.jobs_manager)
         self.serve_forever = self.loop.serve_forever
@@ -80,6 +82,7 @@ class Server(object):
         if is_running_from_develop:
             from calibre.utils.rapydscript import compile_srv
             compile_srv()
+        http_handler.compressed_variants.precompress(static_resource_paths(), opts.compress_min_size)
 
 # Manage users CLI {{{
 
@@ -343,7 +346,16 @@ def main(args=sys.argv):
             raise SystemExit(e.message)
     opts.auto_reload_port=int(os.environ.get('CALIBRE_AUTORELOAD_PORT', 0))
     opts.allow_console_print = 'CALIBRE_ALLOW_CONSOLE_PRINT' in os.environ
-    server=Server(libraries, opts)
+    if opts.worker_processes > 1:
+        if not islinux:
+            raise SystemExit('Multiple server processes are only supported on Linux')
+        from calibre.srv.prefork import Coordinator
+        log = None
+        if opts.log:
+            log = RotatingLog(opts.log, max_size=opts.max_log_size * 1024 * 1024)
+        server = Coordinator(partial(Server, libraries, opts), opts, log=log)
+    else:
+        server=Server(libraries, opts)
     if opts.daemonize:
         if not opts.log and not iswindows:
             raise SystemExit('In order to daemonize you must specify a log file, you can use /dev/stdout to log to screen even as a daemon')
@@ -354,6 +366,8 @@ def main(args=sys.argv):
     signal.signal(signal.SIGTERM, lambda s,f: server.stop())
     if not opts.daemonize and not iswindows:
         signal.signal(signal.SIGHUP, lambda s,f: server.stop())
+    if opts.worker_processes > 1:
+        return server.run()
     # Needed for dynamic cover generation, which uses Qt for drawing
     from calibre.gui2 import ensure_app, load_builtin_fonts
     ensure_app(), load_builtin_fonts()
@@ -50,6 +50,25 @@ class ContentTest(LibraryBaseTest):
             r, data = request('s?ids=1,2')
             self.ae(set(data.iterkeys()), {'1', '2'})
 
+            # Serialized metadata is cached till the book is changed
+            from calibre.srv.changes import metadata
+            from calibre.srv.metadata import book_json_cache
+            cache = book_json_cache(db)
+            self.assertIn(1, {key[0] for key in cache.items})
+            self.assertTrue(all(isinstance(key, tuple) for key in cache.items))
+            num = len(cache.items)
+            self.ae(request('/1')[1], onedata)
+            self.ae(len(cache.items), num)
+            db.set_field('title', {1: 'Changed title'})
+            r, data = request('/1')
+            self.ae(data['title'], 'Changed title')
+            server.handler.router.ctx.notify_changes(self.library_path, metadata((1,)))
+            self.assertNotIn(1, {key[0] for key in cache.items})
+            self.assertIn(2, {key[0] for key in cache.items})
+            # Renaming items shared by many books is not missed
+            db.rename_items('tags', {db.get_item_id('tags', 'Tag One'):'Renamed Tag'})
+            self.assertIn('Renamed Tag', request('/2')[1]['tags'])
+
     # }}}
 
     def test_ajax_categories(self):  # {{{
@@ -82,6 +101,70 @@ class ContentTest(LibraryBaseTest):
             self.ae(set(data['book_ids']), {2})
     # }}}
 
+    def test_search_cursor(self):  # {{{
+        'Test paging through search results with cursors'
+        with self.create_server() as server:
+            ctx = server.handler.router.ctx
+            db = ctx.library_broker.get(None)
+            conn = server.connect()
+            request = partial(make_request, conn)
+            r, data = request('/search?' + urlencode({'sort': 'title', 'num': 100}))
+            all_ids = data['book_ids']
+            self.assertIsNone(data['cursor'])
+            r, data = request('/search?' + urlencode({'sort': 'title', 'num': 1}))
+            self.ae(data['book_ids'], all_ids[:1])
+            seen = list(data['book_ids'])
+            while data['cursor']:
+                r, data = request('/search?' + urlencode({'cursor': data['cursor'], 'num': 1}))
+                self.ae(r.status, httplib.OK)
+                self.ae(data['sort'], 'title')
+                seen.extend(data['book_ids'])
+            self.ae(seen, all_ids)
+            # Every page used the same sorted list, cached by the search not the books
+            sort_cache = ctx.library_broker.sort_caches[db.server_library_id]
+            self.ae(len(sort_cache), 1)
+            self.assertFalse(any(isinstance(key[0], frozenset) for key in sort_cache))
+
+            # Changing the sort field invalidates the cached order
+            r, data = request('/search?' + urlencode({'sort': 'title', 'num': 1}))
+            cursor = data['cursor']
+            version, tags_version = db.sort_results_version(['title']), db.sort_results_version(['tags'])
+            db.set_field('title', {all_ids[-1]: '000 first'})
+            self.assertLess(version, db.sort_results_version(['title']))
+            self.ae(tags_version, db.sort_results_version(['tags']))
+            # The next page starts after the last book shown, wherever it now is
+            r, data = request('/search?' + urlencode({'cursor': cursor, 'num': 100}))
+            self.ae(data['book_ids'], all_ids[1:-1])
+
+            # Added books are not missed by the cached order
+            from calibre.ebooks.metadata.book.base import Metadata
+            book_id = db.create_book_entry(Metadata('zzz'), apply_import_tags=False)
+            r, data = request('/search?' + urlencode({'sort': 'title', 'num': 100}))
+            self.ae(data['book_ids'][-1], book_id)
+
+            r, data = request('/search?' + urlencode({'cursor': 'garbage'}))
+            self.ae(r.status, httplib.BAD_REQUEST)
+    # }}}
+
+    def test_library_changed(self):  # {{{
+        'Test reloading a library changed by another process'
+        from calibre.db.cache import Cache
+        from calibre.db.legacy import create_backend
+        with self.create_server() as server:
+            broker = server.handler.router.ctx.library_broker
+            db = broker.get(None)
+            broker.search_caches[db.server_library_id]['x'] = 1
+            other = Cache(create_backend(self.library_path))
+            other.init()
+            other.set_field('title', {1:'Changed elsewhere'})
+            other.close()
+            self.assertNotEqual(db.field_for('title', 1), 'Changed elsewhere')
+            broker.library_changed(self.library_path)
+            self.ae(db.field_for('title', 1), 'Changed elsewhere')
+            self.assertNotIn(db.server_library_id, broker.search_caches)
+            broker.library_changed(self.library_path + 'x')  # unknown libraries are ignored
+    # }}}
+
     def test_srv_restrictions(self):
         ' Test that virtual lib. + search restriction works on all end points'
         with self.create_server(auth=True, auth_mode='basic') as server:
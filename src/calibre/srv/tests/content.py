@@ -224,3 +224,156 @@ class ContentTest(LibraryBaseTest):
             self.ae(zlib.decompress(raw, 16+zlib.MAX_WBITS), data)
 
     # }}}
+
+    def test_thumbnail_store(self):  # {{{
+        'Test the persistent store of cover thumbnails'
+        from calibre.db.cache import Cache
+        from calibre.db.legacy import create_backend
+        from calibre.srv.thumbnails import ThumbnailStore, PYRAMID
+        db = Cache(create_backend(self.library_path))
+        db.init()
+        location = os.path.join(self.mkdtemp(), 'thumbs')
+        store = ThumbnailStore(location, 10)
+        path, used_cache = store.thumbnail(db, 1, 60, 80)
+        self.assertFalse(used_cache)
+        self.ae(identify(open(path, 'rb').read())[0], 'jpeg')
+        self.ae(store.thumbnail(db, 1, 60, 80), (path, True))
+        self.ae(store.thumbnail(db, 3, 60, 80), (None, False))  # no cover
+        for i in xrange(100):
+            if len(store.items) > len(PYRAMID):
+                break
+            time.sleep(0.05)
+        self.ae(len(store.items), len(PYRAMID) + 1)
+
+        # The store is persistent
+        other = ThumbnailStore(location, 10)
+        self.ae(other.thumbnail(db, 1, 60, 80), (path, True))
+
+        # Changing the cover removes the stale thumbnails
+        db.set_cover({1:I('polish.png', data=True)})
+        for i in xrange(100):
+            if not os.path.exists(path):
+                break
+            time.sleep(0.05)
+        self.assertFalse(os.path.exists(path))
+        self.assertFalse(store.thumbnail(db, 1, 60, 80)[1])
+
+        # The disk space used is bounded
+        store = ThumbnailStore(location, 0)
+        store.thumbnail(db, 2, 60, 80)
+        self.ae(store.total_size, 0)
+
+        # Books queued for a library that has since been closed can be queued again
+        qkey = (db.library_id, 1000)
+        with store.lock:
+            store.queued.add(qkey)
+        store.pending.put((lambda: None, qkey))
+        for i in xrange(100):
+            if qkey not in store.queued:
+                break
+            time.sleep(0.05)
+        self.assertNotIn(qkey, store.queued)
+        db.close()
+    # }}}
+
+    def test_render_cache(self):  # {{{
+        'Test the cache of books rendered for the in-browser viewer'
+        import tempfile
+        from calibre.srv.render_cache import RenderCache, MANIFEST_NAME
+        location = self.mkdtemp()
+        for x in 'fs':
+            os.mkdir(os.path.join(location, x))
+        cache = RenderCache(location, 1)
+
+        def render(bhash, size=1000):
+            tdir = tempfile.mkdtemp(dir=cache.staging_dir())
+            with open(os.path.join(tdir, MANIFEST_NAME), 'wb') as f:
+                f.write(json.dumps({'hash': bhash}))
+            with open(os.path.join(tdir, 'data'), 'wb') as f:
+                f.write(b'x' * size)
+            cache.add(bhash, tdir)
+            return tdir
+
+        self.assertIsNone(cache.manifest('a'))
+        # Only one render of a book at a time
+        self.assertTrue(cache.claim('a'))
+        self.assertFalse(cache.claim('a'))
+        render('a')
+        cache.release('a')
+        self.ae(cache.manifest('a'), {'hash': 'a'})
+        self.assertTrue(cache.claim('a'))
+        cache.release('a')
+        # An already rendered book is not replaced
+        self.assertFalse(os.path.exists(render('a')))
+        self.ae(cache.manifest('a'), {'hash': 'a'})
+
+        # The index is persistent
+        render('b')
+        other = RenderCache(location, 1)
+        other.ensure_index()
+        self.ae(list(other.items), ['a', 'b'])
+        self.ae(other.total_size, cache.total_size)
+
+        # The disk space used is bounded, the least recently used books are
+        # removed first
+        cache.manifest('a')
+        render('c', 1024 * 1024)
+        self.ae(list(cache.items), ['c'])
+        self.assertIsNone(cache.manifest('a')), self.assertIsNone(cache.manifest('b'))
+        self.ae(cache.manifest('c'), {'hash': 'c'})
+    # }}}
+
+    def test_render_book(self):  # {{{
+        'Test that rendering a book in worker processes gives the same result'
+        from calibre.ebooks.oeb.polish.tests.base import get_split_book
+        from calibre.srv.render_book import render
+        book = get_split_book()
+
+        def rendered(max_workers):
+            tdir = self.mkdtemp()
+            render(book, tdir, book_hash='x', max_workers=max_workers)
+            with open(os.path.join(tdir, 'calibre-book-manifest.json'), 'rb') as f:
+                manifest = json.loads(f.read())
+            # The uid used to mark up links is different for every render
+            link_uid = manifest['link_uid'].encode('utf-8')
+            files = {}
+            for dirpath, dirnames, filenames in os.walk(tdir):
+                for fname in filenames:
+                    path = os.path.join(dirpath, fname)
+                    with open(path, 'rb') as f:
+                        files[os.path.relpath(path, tdir)] = f.read().replace(link_uid, b'')
+            return json.loads(files.pop('calibre-book-manifest.json')), files
+
+        manifest, files = rendered(1)
+        self.assertGreater(len(manifest['files']), 2)
+        self.assertIn('is_html', manifest['files'][manifest['spine'][0]])
+        self.ae(rendered(2), (manifest, files))
+    # }}}
+
+    def test_prerender_recent_books(self):  # {{{
+        'Test queueing the most recently added books for pre-rendering'
+        from Queue import Queue
+        from calibre.db.cache import Cache
+        from calibre.db.legacy import create_backend
+        from calibre.srv import books
+        from calibre.srv.opts import Options
+        db = Cache(create_backend(self.library_path))
+        db.init()
+
+        class Context(object):
+            opts = Options(prerender_recent_books=2)
+
+        orig_queue, orig_worker = books.prerender_queue, books.prerender_worker
+        # Do not start the pre-rendering thread, only check what is queued
+        books.prerender_queue, books.prerender_worker = Queue(), object()
+        try:
+            books.prerender_recent_books(Context())
+            ctx, library_id, book_ids = books.prerender_queue.get_nowait()
+            self.assertIsNone(library_id)
+            self.ae(list(book_ids(db)), list(db.multisort([('timestamp', False)])[:2]))
+            books.prerender_books(ctx, 'x', iter((1, 2)))
+            self.ae(books.prerender_queue.get_nowait()[1:], ('x', (1, 2)))
+        finally:
+            books.prerender_queue, books.prerender_worker = orig_queue, orig_worker
+        db.close()
+    # }}}
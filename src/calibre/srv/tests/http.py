@@ -6,11 +6,12 @@ from __future__ import (unicode_literals, division, absolute_import,
 __license__ = 'GPL v3'
 __copyright__ = '2015, Kovid Goyal <kovid at kovidgoyal.net>'
 
-import httplib, hashlib, zlib, string, time, os
+import httplib, hashlib, zlib, string, time, os, socket, unittest
 from io import BytesIO
 from tempfile import NamedTemporaryFile
 
 from calibre import guess_type
+from calibre.srv.http2 import has_http2
 from calibre.srv.tests.base import BaseTest, TestServer
 from calibre.utils.monotonic import monotonic
 
@@ -61,13 +62,15 @@ class TestHTTP(BaseTest):
         'Test parsing of Accept-Encoding'
         from calibre.srv.http_response import acceptable_encoding
 
-        def test(name, val, ans, allowed={'gzip'}):
-            self.ae(acceptable_encoding(val, allowed), ans, name + ' failed')
+        def test(name, val, ans, allowed={'gzip'}, preferred=()):
+            self.ae(acceptable_encoding(val, allowed, preferred), ans, name + ' failed')
         test('Empty field', '', None)
         test('Simple', 'gzip', 'gzip')
         test('Case insensitive', 'GZIp', 'gzip')
         test('Multiple', 'gzip, identity', 'gzip')
         test('Priority', '1;q=0.5, 2;q=0.75, 3;q=1.0', '3', {'1', '2', '3'})
+        test('Preferred', 'gzip, deflate, br', 'br', {'gzip', 'br'}, ('br', 'gzip'))
+        test('Preferred with priority', 'gzip, br;q=0.5', 'gzip', {'gzip', 'br'}, ('br', 'gzip'))
     # }}}
 
     def test_accept_language(self):  # {{{
@@ -327,6 +330,34 @@ class TestHTTP(BaseTest):
             self.ae(str(len(raw)), r.getheader('Calibre-Uncompressed-Length'))
             self.ae(r.status, httplib.OK), self.ae(zlib.decompress(r.read(), 16+zlib.MAX_WBITS), raw)
 
+            # Test cached compressed variants
+            server.change_handler(lambda conn: conn.generate_static_output('raw', lambda: raw))
+            conn = server.connect()
+            conn.request('GET', '/an_etagged_path', headers={'Accept-Encoding':'gzip'})
+            r = conn.getresponse()
+            self.ae(r.status, httplib.OK), self.assertIsNone(r.getheader('Content-Length'))
+            gz = r.read()
+            self.ae(zlib.decompress(gz, 16+zlib.MAX_WBITS), raw)
+            conn.request('GET', '/an_etagged_path', headers={'Accept-Encoding':'gzip'})
+            r = conn.getresponse()
+            self.ae(r.status, httplib.OK), self.ae(r.getheader('Content-Encoding'), 'gzip')
+            self.ae(r.getheader('Content-Length'), str(len(gz))), self.ae(r.read(), gz)
+            self.ae(str(len(raw)), r.getheader('Calibre-Uncompressed-Length'))
+            conn.request('GET', '/an_etagged_path', headers={'Accept-Encoding':'gzip', 'Range':'bytes=2-9'})
+            r = conn.getresponse()
+            self.ae(r.status, httplib.PARTIAL_CONTENT), self.ae(r.read(), gz[2:10])
+            self.ae(r.getheader('Content-Range'), 'bytes 2-9/%d' % len(gz))
+
+            # Test that resources sharing an ETag get their own variants
+            server.change_handler(lambda conn: conn.etagged_dynamic_response('shared', lambda: ''.join(conn.path) * 1000))
+            conn = server.connect()
+            for i in xrange(2):
+                for path in ('one', 'two'):
+                    conn.request('GET', '/' + path, headers={'Accept-Encoding':'gzip'})
+                    r = conn.getresponse()
+                    self.ae(r.status, httplib.OK), self.ae(r.getheader('ETag'), '"shared"')
+                    self.ae(zlib.decompress(r.read(), 16+zlib.MAX_WBITS), path.encode('ascii') * 1000)
+
             # Test dynamic etagged content
             num_calls = [0]
 
@@ -416,6 +447,72 @@ class TestHTTP(BaseTest):
 
     # }}}
 
+    @unittest.skipUnless(has_http2, 'The h2 package is not installed')
+    def test_http2(self):  # {{{
+        'Test HTTP/2 with prior knowledge and with the h2c upgrade'
+        from h2.config import H2Configuration
+        from h2.connection import H2Connection
+        from h2.events import DataReceived, ResponseReceived, StreamEnded
+        big = b'x' * 200000
+
+        def handler(data):
+            if data.path[0] == 'big':
+                return big
+            return '/'.join(data.path) + ':' + data.read().decode('utf-8')
+
+        def exchange(sock, client, streams):
+            responses = {}
+            while len(responses) < streams or not all(r.get('ended') for r in responses.itervalues()):
+                data = sock.recv(65536)
+                self.assertTrue(data, 'Connection closed by server')
+                for event in client.receive_data(data):
+                    if isinstance(event, ResponseReceived):
+                        responses[event.stream_id] = {'headers':dict(event.headers), 'body':b''}
+                    elif isinstance(event, DataReceived):
+                        responses[event.stream_id]['body'] += event.data
+                        client.acknowledge_received_data(event.flow_controlled_length, event.stream_id)
+                    elif isinstance(event, StreamEnded):
+                        responses[event.stream_id]['ended'] = True
+                sock.sendall(client.data_to_send())
+            return responses
+
+        def request(client, stream_id, path, body=None):
+            client.send_headers(stream_id, [(':method', 'POST' if body else 'GET'), (':path', path), (':scheme', 'http'),
+                                            (':authority', 'localhost')], end_stream=body is None)
+            if body:
+                client.send_data(stream_id, body, end_stream=True)
+
+        with TestServer(handler) as server:
+            sock = socket.create_connection(server.address)
+            client = H2Connection(H2Configuration(client_side=True))
+            client.initiate_connection()
+            request(client, 1, '/one')
+            request(client, 3, '/big')
+            request(client, 5, '/two', b'body')
+            sock.sendall(client.data_to_send())
+            responses = exchange(sock, client, 3)
+            self.ae(responses[1]['headers'][b':status'], b'200')
+            self.ae(responses[1]['body'], b'one:')
+            self.ae(responses[3]['body'], big)
+            self.ae(responses[5]['body'], b'two:body')
+            self.assertNotIn(b'connection', responses[1]['headers'])
+            sock.close()
+
+            sock = socket.create_connection(server.address)
+            client = H2Connection(H2Configuration(client_side=True))
+            settings = client.initiate_upgrade_connection()
+            sock.sendall(b'GET /upgraded HTTP/1.1\r\nHost: localhost\r\nConnection: Upgrade, HTTP2-Settings\r\n'
+                         b'Upgrade: h2c\r\nHTTP2-Settings: ' + settings + b'\r\n\r\n')
+            data = b''
+            while b'\r\n\r\n' not in data:
+                data += sock.recv(1)
+            self.assertTrue(data.startswith(b'HTTP/1.1 101 '))
+            sock.sendall(client.data_to_send())
+            responses = exchange(sock, client, 1)
+            self.ae(responses[1]['body'], b'upgraded:')
+            sock.close()
+    # }}}
+
     def test_static_generation(self):  # {{{
         'Test static generation'
         nums = list(map(str, xrange(10)))
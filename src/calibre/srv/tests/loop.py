@@ -12,6 +12,7 @@ from unittest import skipIf
 from glob import glob
 from threading import Event
 
+from calibre.srv.loop import SO_REUSEPORT
 from calibre.srv.pre_activated import has_preactivated_support
 from calibre.srv.tests.base import BaseTest, TestServer
 from calibre.ptempfile import TemporaryDirectory
@@ -230,6 +231,112 @@ class LoopTest(BaseTest):
         self.assertGreaterEqual(b - a, 0.09)
         self.assertLessEqual(b - a, 0.2)
 
+    def test_pollers(self):
+        'Test the select() and epoll() pollers'
+        import select
+        from calibre.srv.loop import SelectPoller, EpollPoller, READ, WRITE, RDWR, WAIT
+        pollers = [SelectPoller] + ([EpollPoller] if hasattr(select, 'epoll') else [])
+        for cls in pollers:
+            p = cls()
+            a, b = socket.socketpair()
+            try:
+                fd = a.fileno()
+                p.register(fd, READ)
+                self.ae(p.poll(0), ([], []))
+                b.sendall(b'x')
+                self.ae(p.poll(0.1), ([fd], []))
+                p.register(fd, RDWR)
+                self.ae(p.poll(0.1), ([fd], [fd]))
+                p.register(fd, WAIT)
+                self.ae(p.poll(0), ([], []))
+                p.register(fd, WRITE)
+                self.ae(p.poll(0.1), ([], [fd]))
+                p.unregister(fd)
+                self.ae(p.poll(0), ([], []))
+            finally:
+                a.close(), b.close()
+
+    def test_timeouts(self):
+        'Test that inactive connections are timed out'
+        with TestServer(lambda data:(data.path[0] + data.read()), timeout=0.2) as server:
+            conns = []
+            for i in xrange(3):
+                conn = server.connect()
+                conn.request('GET', '/test')
+                self.ae(conn.getresponse().read(), b'test')
+                conns.append(conn)
+            self.ae(server.loop.num_active_connections, 3)
+            time.sleep(0.5)
+            server.loop.wakeup()
+            time.sleep(0.1)
+            self.ae(server.loop.num_active_connections, 0)
+
+    def test_job_results(self):
+        'Test that job results only go to the connection that queued the job'
+        with TestServer(lambda data:(data.path[0] + data.read())) as server:
+            conn = server.connect()
+            conn.request('GET', '/test')
+            self.ae(conn.getresponse().read(), b'test')
+            (s, c), = server.loop.connection_map.items()
+            results = server.loop.pool.result_queue
+            # A late result for a closed connection whose file descriptor was re-used
+            results.put(((s, c.connection_id - 1), True, None))
+            self.ae(list(server.loop.dispatch_job_results()), [])
+            results.put((c.job_id, True, None))
+            self.ae(list(server.loop.dispatch_job_results()), [(s, c, (True, None))])
+
+    def test_pool_lanes(self):
+        'Test the lanes and resizing of the request thread pool'
+        from functools import partial
+        from calibre.srv.pool import ThreadPool, DEFAULT_LANE, SLOW_LANE
+        from calibre.srv.utils import ServerLog
+        block, done = Event(), []
+        pool = ThreadPool(ServerLog(), lambda: None, count=4, max_count=4)
+        pool.start()
+        try:
+            for i in xrange(4):
+                pool.put_nowait(i, block.wait, lane=SLOW_LANE)
+            time.sleep(0.1)
+            self.ae(pool.busy, 2)  # slow jobs can only use half the workers
+            pool.put_nowait(4, partial(done.append, 4))
+            time.sleep(0.1)
+            self.ae(done, [4])
+            stats = pool.stats
+            self.ae((stats[SLOW_LANE]['running'], stats[SLOW_LANE]['queued']), (2, 2))
+            self.ae(stats[DEFAULT_LANE]['completed'], 1)
+            block.set()
+            time.sleep(0.1)
+            self.ae(pool.stats[SLOW_LANE]['completed'], 4)
+            self.assertGreater(pool.stats[SLOW_LANE]['max_wait'], 0.05)
+        finally:
+            block.set()
+            pool.stop(monotonic() + 1)
+        self.assertFalse(pool.workers)
+
+        block.clear()
+        pool = ThreadPool(ServerLog(), lambda: None, count=1, max_count=3)
+        pool.start()
+        try:
+            for i in xrange(5):
+                pool.put_nowait(i, block.wait)
+            time.sleep(0.1)
+            self.ae((len(pool.workers), pool.busy), (3, 3))
+            self.ae(pool.stats[DEFAULT_LANE]['queued'], 2)
+        finally:
+            block.set()
+            pool.stop(monotonic() + 1)
+
+    @skipIf(SO_REUSEPORT is None, 'SO_REUSEPORT not available')
+    def test_reuseport(self):
+        'Test that multiple server processes can listen on the same port'
+        with TestServer(lambda data:b'one', worker_processes=2) as one:
+            with TestServer(lambda data:b'two', worker_processes=2, port=one.address[1]) as two:
+                self.ae(one.address, two.address)
+                self.assertTrue(two.loop.ready)
+                conn = two.connect()
+                conn.request('GET', '/')
+                self.assertIn(conn.getresponse().read(), (b'one', b'two'))
+
     def test_jobs_manager(self):
         'Test the jobs manager'
         from calibre.srv.jobs import JobsManager
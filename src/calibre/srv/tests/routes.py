@@ -105,3 +105,33 @@ class TestRouter(BaseTest):
         self.ae(router.url_for('/needs quoting', x='a/b c'), '/needs quoting/a%2Fb%20c')
         self.ae(router.url_for(None), '/')
         self.ae(router.url_for('/get', a='1', b='xxx'), '/get/1/xxx')
+
+    def test_route_lanes(self):
+        'Test choosing the thread pool lane for a request'
+        from calibre.srv.routes import Router, endpoint
+        from calibre.srv.pool import DEFAULT_LANE, SLOW_LANE
+        router = Router()
+
+        @endpoint('/fast')
+        def fast(ctx, data):
+            pass
+
+        @endpoint('/slow', lane=SLOW_LANE)
+        def slow(ctx, data):
+            pass
+
+        @endpoint('/get/{what}', lane=lambda what: SLOW_LANE if what == 'cover' else DEFAULT_LANE)
+        def get(ctx, data, what):
+            pass
+
+        for x in (fast, slow, get):
+            router.add(x)
+        router.finalize()
+
+        def lane(path):
+            return router.lane_for(type(b'Data', (), {'path':filter(None, path.split('/'))}))
+        self.ae(lane('/fast'), DEFAULT_LANE)
+        self.ae(lane('/slow'), SLOW_LANE)
+        self.ae(lane('/get/cover'), SLOW_LANE)
+        self.ae(lane('/get/thumb'), DEFAULT_LANE)
+        self.ae(lane('/does/not/exist'), DEFAULT_LANE)
@@ -0,0 +1,278 @@
+#!/usr/bin/env python2
+# vim:fileencoding=utf-8
+# License: GPLv3 Copyright: 2017, Kovid Goyal <kovid at kovidgoyal.net>
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import errno, os, weakref
+from collections import OrderedDict, defaultdict, namedtuple
+from io import BytesIO
+from Queue import Queue
+from threading import Lock, Thread
+
+from calibre.utils.config_base import tweaks
+from calibre.utils.date import timestampfromdt
+from calibre.utils.filenames import atomic_rename
+from calibre.utils.img import scale_image
+
+# Every cover has thumbnails of these sizes generated for it in the
+# background. Thumbnails of other sizes are scaled down from the smallest of
+# these that is large enough, instead of from the full size cover.
+PYRAMID = ((150, 200), (300, 400), (600, 800))
+
+Entry = namedtuple('Entry', 'path size timestamp')
+
+
+def cover_timestamp(mtime):
+    return int(timestampfromdt(mtime) * 1000)
+
+
+def thumbnail_quality():
+    return min(99, max(50, tweaks['content_server_thumbnail_compression_quality']))
+
+
+def safe_remove(path):
+    try:
+        os.remove(path)
+    except EnvironmentError:
+        pass
+
+
+class CoverChangeListener(object):
+
+    ' Registered as a cover cache with a library, to be told when covers change '
+
+    def __init__(self, store, db):
+        self.store, self.db_ref = store, weakref.ref(db)
+
+    def invalidate(self, book_ids):
+        for book_id in book_ids:
+            self.store.queue_pyramid(self.db_ref, book_id)
+
+
+class ThumbnailStore(object):
+
+    '''
+    A persistent store of cover thumbnails. Thumbnails are keyed by library,
+    book, size and the modification time of the cover, so a thumbnail is never
+    served for a cover that has since changed. The disk space used is bounded
+    by max_size (in MB), the least recently used thumbnails are removed first.
+    The store can be shared by several server processes.
+    '''
+
+    def __init__(self, location, max_size):
+        self.location = location
+        self.max_size = int(max_size * 1024 * 1024)
+        self.lock = Lock()
+        self.items = None
+        self.book_keys = defaultdict(set)
+        self.total_size = 0
+        self.pending, self.queued = Queue(), set()
+        self.worker = None
+        self.watched = weakref.WeakSet()
+
+    def path_for(self, key, timestamp):
+        library_id, book_id, width, height = key
+        return os.path.join(self.location, library_id, '%d' % (book_id % 100), '%d-%dx%d-%d.jpg' % (
+            book_id, width, height, timestamp))
+
+    def load_index(self):
+        # Must be called with the lock held. Uses file modification times, that
+        # are updated on every access, to restore the least recently used order.
+        items = []
+
+        def listdir(*args):
+            try:
+                return os.listdir(os.path.join(*args))
+            except EnvironmentError:
+                return ()
+
+        for library_id in listdir(self.location):
+            for bucket in listdir(self.location, library_id):
+                for name in listdir(self.location, library_id, bucket):
+                    path = os.path.join(self.location, library_id, bucket, name)
+                    try:
+                        book_id, size, timestamp = name.rpartition('.')[0].split('-')
+                        width, height = map(int, size.split('x'))
+                        key = (library_id, int(book_id), width, height)
+                        st = os.stat(path)
+                        items.append((st.st_mtime, key, Entry(path, st.st_size, int(timestamp))))
+                    except (ValueError, TypeError, EnvironmentError):
+                        continue
+        items.sort(key=lambda x: x[0])
+        self.items = OrderedDict()
+        for mtime, key, entry in items:
+            self.add_entry(key, entry)
+        self.apply_size()
+
+    def add_entry(self, key, entry):
+        old = self.items.pop(key, None)
+        if old is not None:
+            self.total_size -= old.size
+            if old.path != entry.path:
+                safe_remove(old.path)
+        self.items[key] = entry
+        self.total_size += entry.size
+        self.book_keys[key[:2]].add(key)
+
+    def remove_entry(self, key):
+        entry = self.items.pop(key, None)
+        if entry is not None:
+            self.total_size -= entry.size
+            safe_remove(entry.path)
+            keys = self.book_keys[key[:2]]
+            keys.discard(key)
+            if not keys:
+                del self.book_keys[key[:2]]
+
+    def apply_size(self):
+        while self.total_size > self.max_size and self.items:
+            self.remove_entry(next(self.items.iterkeys()))
+
+    def get(self, key, timestamp):
+        ' Return the path to the thumbnail for key or None if it is not present or stale '
+        with self.lock:
+            if self.items is None:
+                self.load_index()
+            entry = self.items.pop(key, None)
+            if entry is None:
+                return
+            self.items[key] = entry
+            if entry.timestamp != timestamp:
+                self.remove_entry(key)
+                return
+            try:
+                os.utime(entry.path, None)
+            except EnvironmentError as err:
+                if err.errno == errno.ENOENT:
+                    # Removed by another process sharing this store
+                    self.remove_entry(key)
+                    return
+            return entry.path
+
+    def put(self, key, timestamp, data):
+        path = self.path_for(key, timestamp)
+        tpath = '%s.%d.tmp' % (path, os.getpid())
+        try:
+            try:
+                f = open(tpath, 'wb')
+            except EnvironmentError:
+                os.makedirs(os.path.dirname(path))
+                f = open(tpath, 'wb')
+            with f:
+                f.write(data)
+            atomic_rename(tpath, path)
+        except EnvironmentError:
+            safe_remove(tpath)
+            return
+        with self.lock:
+            if self.items is None:
+                self.load_index()
+            self.add_entry(key, Entry(path, len(data), timestamp))
+            self.apply_size()
+        return path
+
+    def thumbnail(self, db, book_id, width, height):
+        '''
+        Return the path to a thumbnail of the cover of the specified book, that
+        fits in width x height and whether it was already present in the store.
+        Returns None, False if the book has no cover.
+        '''
+        mtime = db.cover_last_modified(book_id)
+        if mtime is None:
+            return None, False
+        timestamp, library_id = cover_timestamp(mtime), db.library_id
+        key = (library_id, book_id, width, height)
+        path = self.get(key, timestamp)
+        if path is not None:
+            return path, True
+        source = None
+        for w, h in PYRAMID:
+            if w >= width and h >= height:
+                lpath = self.get((library_id, book_id, w, h), timestamp)
+                if lpath is not None:
+                    try:
+                        with open(lpath, 'rb') as f:
+                            source = f.read()
+                    except EnvironmentError:
+                        pass
+                break
+        if source is None:
+            buf = BytesIO()
+            if not db.copy_cover_to(book_id, buf):
+                return None, False
+            source = buf.getvalue()
+            self.queue_pyramid(weakref.ref(db), book_id)
+        data = scale_image(source, width=width, height=height, compression_quality=thumbnail_quality())[-1]
+        return self.put(key, timestamp, data), False
+
+    def queue_pyramid(self, db_ref, book_id):
+        db = db_ref()
+        if db is None:
+            return
+        qkey = (db.library_id, book_id)
+        with self.lock:
+            if qkey in self.queued:
+                return
+            self.queued.add(qkey)
+            if self.worker is None:
+                self.worker = Thread(target=self.generate_pyramids, name='ThumbnailPyramids')
+                self.worker.daemon = True
+                self.worker.start()
+        self.pending.put((db_ref, qkey))
+
+    def generate_pyramids(self):
+        while True:
+            db_ref, qkey = self.pending.get()
+            try:
+                db = db_ref()
+                # The library may have been closed since the book was queued
+                if db is not None:
+                    self.generate_pyramid(db, qkey[1])
+            except Exception:
+                import traceback
+                traceback.print_exc()
+            finally:
+                with self.lock:
+                    self.queued.discard(qkey)
+
+    def generate_pyramid(self, db, book_id):
+        library_id = db.library_id
+        if db not in self.watched:
+            # Registering needs the library's write lock, so it is done here,
+            # not in the request handling threads that may hold a read lock
+            self.watched.add(db)
+            db.add_cover_cache(CoverChangeListener(self, db))
+        mtime = db.cover_last_modified(book_id)
+        timestamp = None if mtime is None else cover_timestamp(mtime)
+        with self.lock:
+            if self.items is None:
+                self.load_index()
+            # Remove thumbnails of deleted books and of previous covers
+            for key in tuple(self.book_keys.get((library_id, book_id), ())):
+                if self.items[key].timestamp != timestamp:
+                    self.remove_entry(key)
+        if timestamp is None:
+            return
+        missing = [(w, h) for w, h in PYRAMID if self.get((library_id, book_id, w, h), timestamp) is None]
+        if not missing:
+            return
+        buf = BytesIO()
+        if not db.copy_cover_to(book_id, buf):
+            return
+        source, quality = buf.getvalue(), thumbnail_quality()
+        for w, h in missing:
+            self.put((library_id, book_id, w, h), timestamp, scale_image(
+                source, width=w, height=h, compression_quality=quality)[-1])
+
+
+stores = {}
+stores_lock = Lock()
+
+
+def thumbnail_store(location, max_size):
+    with stores_lock:
+        ans = stores.get(location)
+        if ans is None:
+            ans = stores[location] = ThumbnailStore(location, max_size)
+        return ans
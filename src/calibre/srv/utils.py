@@ -243,8 +243,9 @@ def parse_http_dict(header_val):
     return ans
 
 
-def sort_q_values(header_val):
-    'Get sorted items from an HTTP header of type: a;q=0.5, b;q=0.7...'
+def sort_q_values(header_val, preferred=()):
+    '''Get sorted items from an HTTP header of type: a;q=0.5, b;q=0.7...
+    Items with the same q value are sorted by their order in preferred.'''
     if not header_val:
         return []
 
@@ -257,7 +258,12 @@ def sort_q_values(header_val):
                 q = max(0.0, min(1.0, float(v.strip())))
             except Exception:
                 pass
-        return e.strip(), q
+        e = e.strip()
+        try:
+            rank = len(preferred) - preferred.index(e.lower())
+        except ValueError:
+            rank = 0
+        return e, (q, rank)
     return tuple(map(itemgetter(0), sorted(map(item, parse_http_list(header_val)), key=itemgetter(1), reverse=True)))
 
 
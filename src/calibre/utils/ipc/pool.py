@@ -93,6 +93,7 @@ class Worker(object):
         self.process, self.conn = p, conn
         self.events = events
         self.name = name or ''
+        self.baseline_memory = None
 
     def __call__(self, job):
         eintr_retry_call(self.conn.send_bytes, cPickle.dumps(job, -1))
@@ -120,9 +121,14 @@ class Pool(Thread):
 
     daemon = True
 
-    def __init__(self, max_workers=None, name=None):
+    def __init__(self, max_workers=None, name=None, max_memory_growth=None):
+        ''' If max_memory_growth is not None, worker processes whose memory
+        usage has grown by more than that many bytes since they finished their
+        first job are replaced by new worker processes. '''
         Thread.__init__(self, name=name)
         self.max_workers = max_workers or detect_ncpus()
+        self.max_memory_growth = max_memory_growth
+        self.retired_workers = []
         self.available_workers = []
         self.busy_workers = {}
         self.pending_jobs = []
@@ -235,13 +241,19 @@ class Pool(Thread):
         elif isinstance(event, WorkerResult):
             worker_result = event
             self.busy_workers.pop(worker_result.worker, None)
-            self.available_workers.append(worker_result.worker)
+            retired = not worker_result.is_terminal_failure and self.memory_has_grown(worker_result.worker)
+            if retired:
+                self.retire_worker(worker_result.worker)
+            else:
+                self.available_workers.append(worker_result.worker)
             self.tracker.task_done()
             if worker_result.is_terminal_failure:
                 self.terminal_failure = TerminalFailure('Worker process crashed while executing job', worker_result.result.traceback, worker_result.id)
                 self.terminal_error()
                 return False
             self.results.put(worker_result)
+            if retired and self.pending_jobs and self.start_worker() is False:
+                return False
         else:
             self.common_data = cPickle.dumps(event, -1)
             if len(self.common_data) > MAX_SIZE:
@@ -273,6 +285,34 @@ class Pool(Thread):
             return False
         self.busy_workers[worker] = job
 
+    def memory_has_grown(self, worker):
+        if self.max_memory_growth is None:
+            return False
+        try:
+            import psutil
+            rss = psutil.Process(worker.process.pid).memory_info().rss
+        except Exception:
+            return False
+        if worker.baseline_memory is None:
+            # The first job loads all the modules the jobs need, so measure
+            # growth from after it is done
+            worker.baseline_memory = rss
+            return False
+        return rss - worker.baseline_memory > self.max_memory_growth
+
+    def retire_worker(self, worker):
+        ' Tell worker to exit, it is reaped later, when it has exited '
+        try:
+            worker(None)
+        except Exception:
+            pass
+        try:
+            worker.conn.close()
+        except Exception:
+            pass
+        self.retired_workers = [p for p in self.retired_workers if p.poll() is None]
+        self.retired_workers.append(worker.process)
+
     @property
     def failed(self):
         return self.terminal_failure is not None
@@ -297,7 +337,7 @@ class Pool(Thread):
                     worker.process.terminate()
                 except EnvironmentError:
                     pass  # If the process has already been killed
-        workers = [w.process for w in self.available_workers + list(self.busy_workers)]
+        workers = [w.process for w in self.available_workers + list(self.busy_workers)] + self.retired_workers
         aw = list(self.available_workers)
 
         def join():
@@ -327,6 +367,7 @@ class Pool(Thread):
                 except EnvironmentError:
                     pass
         del self.available_workers[:]
+        del self.retired_workers[:]
         self.busy_workers.clear()
         if hasattr(self, 'cd_file'):
             try:
@@ -335,6 +376,39 @@ class Pool(Thread):
                 pass
 
 
+def run_jobs(jobs, module, func, common_data=None, max_workers=None, name=None, max_memory_growth=None):
+    ''' Run func from module once for every tuple of arguments in jobs, in a
+    pool of worker processes. Returns an iterator over (index of the job in
+    jobs, return value of func), in the order in which the jobs finish. Raises
+    :class:`Failure` if a worker process crashes and Exception if func raises.
+    Stopping the iteration early shuts down the pool. '''
+    max_workers = min(max_workers or detect_ncpus(), len(jobs))
+    if not jobs:
+        return
+    pool = Pool(max_workers=max_workers, name=name, max_memory_growth=max_memory_growth)
+    try:
+        if common_data is not None:
+            pool.set_common_data(common_data)
+        queued = 0
+        # The pool runs pending jobs in LIFO order, so only queue as many jobs
+        # as there are workers, to preserve the order of the jobs
+        while queued < max_workers:
+            pool(queued, module, func, *jobs[queued])
+            queued += 1
+        for i in xrange(len(jobs)):
+            r = pool.results.get()
+            if r.is_terminal_failure:
+                raise Failure(pool.terminal_failure)
+            if r.result.err:
+                raise Exception('%s.%s%r failed with error: %s\n%s' % (module, func, tuple(jobs[r.id]), r.result.err, r.result.traceback))
+            if queued < len(jobs):
+                pool(queued, module, func, *jobs[queued])
+                queued += 1
+            yield r.id, r.result.value
+    finally:
+        pool.shutdown()
+
+
 def worker_main(conn):
     from importlib import import_module
     common_data = None
@@ -482,4 +556,34 @@ def test():
         p(i, 'import time;\ndef x(i):\n time.sleep(10000)', 'x', i)
     p.shutdown(), p.join()
 
+    # Test run_jobs, with workers replaced after every job
+    for max_memory_growth in (None, 1):
+        results = dict(run_jobs([(i,) for i in range(100)], 'def x(i, common_data=None):\n return common_data * i', 'x',
+                                common_data=3, max_workers=4, name='Test', max_memory_growth=max_memory_growth))
+        if results != {i:3 * i for i in range(100)}:
+            raise SystemExit('run_jobs() returned incorrect results: %r' % results)
+    try:
+        list(run_jobs([(1,)], 'def x(i):\n return 1/0', 'x', name='Test'))
+    except Exception as err:
+        if 'ZeroDivisionError' not in as_unicode(err):
+            raise SystemExit('Unexpected error from run_jobs(): %s' % as_unicode(err))
+    else:
+        raise SystemExit('run_jobs() did not raise for a failing job')
+
+    # Test rescaling images in worker processes
+    from io import BytesIO
+    from PIL import Image
+    from calibre.ebooks.oeb.transforms.rescale import RescaleImages
+    jobs = []
+    for i in range(20):
+        buf = BytesIO()
+        Image.new('RGB', (100 + i, 50)).save(buf, 'png')
+        jobs.append(('%d.png' % i, buf.getvalue(), 'png', 10 + i, 5, False))
+    results = dict(RescaleImages().rescale_in_pool(jobs, 4))
+    if set(results) != set(range(len(jobs))):
+        raise SystemExit('Not all images were rescaled')
+    for i, (data, messages) in results.iteritems():
+        if data is None or Image.open(BytesIO(data)).size != (10 + i, 5):
+            raise SystemExit('Image %d was not rescaled correctly: %r' % (i, messages))
+
     print ('Tests all passed!')
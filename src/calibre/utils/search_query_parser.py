@@ -20,6 +20,7 @@ import sys, operator, weakref, re
 
 from calibre.constants import preferred_encoding
 from calibre.utils.icu import sort_key
+from calibre.utils.monotonic import monotonic
 from calibre import prints
 
 
@@ -315,6 +316,9 @@ class SearchQueryParser(object):
         self.parser = Parser()
         self.lookup_saved_search = global_lookup_saved_search if lookup_saved_search is None else lookup_saved_search
         self.sqp_parse_cache = parse_cache
+        # Set this to a list to have the evaluation of every node of the
+        # query recorded in it, see explain()
+        self.explain_log = None
 
     def sqp_change_locations(self, locations):
         self.sqp_initialize(locations, optimize=self.optimize)
@@ -360,21 +364,60 @@ class SearchQueryParser(object):
         return getattr(self, 'evaluate_'+group_name)
 
     def evaluate(self, parse_result, candidates):
-        return self.method(parse_result[0])(parse_result[1:], candidates)
+        if self.explain_log is None:
+            return self.method(parse_result[0])(parse_result[1:], candidates)
+        cost, selectivity = self.estimate(parse_result)
+        entry = {'node':node_as_text(parse_result), 'cost':cost, 'selectivity':selectivity,
+                 'candidates':len(candidates), 'children':[]}
+        parent, self.explain_log = self.explain_log, entry['children']
+        st = monotonic()
+        try:
+            ans = self.method(parse_result[0])(parse_result[1:], candidates)
+        finally:
+            entry['time'] = monotonic() - st
+            self.explain_log = parent
+        entry['matches'] = len(ans)
+        parent.append(entry)
+        return ans
+
+    def plan(self, op, argument):
+        ''' Return the terms of a chain of and/or operations, in the order in
+        which they should be evaluated. When optimizing, the cheapest and most
+        selective terms are evaluated first, so that the more expensive terms
+        only have to look at the books that remain. '''
+        terms = flatten_chain(op, argument)
+        if self.optimize:
+            if op == 'and':
+                key = lambda cs: cs[0] / max(1.0 - cs[1], 0.01)
+            else:
+                key = lambda cs: cs[0] / max(cs[1], 0.01)
+            terms.sort(key=lambda t: key(self.estimate(t)))
+        return terms
 
     def evaluate_and(self, argument, candidates):
-        # RHS checks only those items matched by LHS
-        # returns result of RHS check: RHmatches(LHmatches(c))
-        #  return self.evaluate(argument[0]).intersection(self.evaluate(argument[1]))
-        l = self.evaluate(argument[0], candidates)
-        return l.intersection(self.evaluate(argument[1], l))
+        # Each term checks only those items matched by the previous terms
+        # returns the intersection of the matches of all terms, stopping as
+        # soon as nothing is left
+        if not candidates:
+            return set()
+        for term in self.plan('and', argument):
+            candidates = candidates.intersection(self.evaluate(term, candidates))
+            if not candidates:
+                break
+        return candidates
 
     def evaluate_or(self, argument, candidates):
-        # RHS checks only those elements not matched by LHS
-        # returns LHS union RHS: LHmatches(c) + RHmatches(c-LHmatches(c))
-        #  return self.evaluate(argument[0]).union(self.evaluate(argument[1]))
-        l = self.evaluate(argument[0], candidates)
-        return l.union(self.evaluate(argument[1], candidates.difference(l)))
+        # Each term checks only those elements not matched by the previous
+        # terms, returns the union of the matches of all terms, stopping as
+        # soon as all candidates have been matched
+        matches = set()
+        for term in self.plan('or', argument):
+            if not candidates:
+                break
+            m = self.evaluate(term, candidates)
+            matches |= m
+            candidates = candidates.difference(m)
+        return matches
 
     def evaluate_not(self, argument, candidates):
         # unary op checks only candidates. Result: list of items matching
@@ -430,6 +473,69 @@ class SearchQueryParser(object):
         '''
         return set([])
 
+    def estimate(self, parse_result):
+        '''
+        Return an estimate of the cost of evaluating the specified node of a
+        parsed query over all candidates and the fraction of candidates it is
+        expected to match, as a 2-tuple: (cost, selectivity).
+        '''
+        op = parse_result[0]
+        if op == 'token':
+            return self.estimate_token(parse_result[1], parse_result[2])
+        if op == 'not':
+            cost, selectivity = self.estimate(parse_result[1])
+            return cost, 1.0 - selectivity
+        ests = [self.estimate(x) for x in parse_result[1:]]
+        cost = sum(c for c, s in ests)
+        selectivity = 1.0
+        for c, s in ests:
+            selectivity *= (s if op == 'and' else 1.0 - s)
+        return cost, (selectivity if op == 'and' else 1.0 - selectivity)
+
+    def estimate_token(self, location, query):
+        '''
+        Return a (cost, selectivity) estimate for matching :param:`query` in
+        :param:`location`. The default implementation knows nothing about the
+        data, so all terms are considered equal and are evaluated in the order
+        they were specified. Subclasses should re-implement this to use
+        statistics about their data.
+        '''
+        return 1.0, 0.5
+
+    def explain(self, query, candidates=None):
+        '''
+        Evaluate the query, returning the matches and the plan that was used.
+        The plan is a list of dicts, one per evaluated node of the query, with
+        the estimated cost and selectivity, the number of candidates and
+        matches, the time taken and the plans of any child nodes.
+        '''
+        self.explain_log = []
+        try:
+            ans = self.parse(query, candidates=candidates)
+            return ans, self.explain_log
+        finally:
+            self.explain_log = None
+
+
+def flatten_chain(op, argument):
+    ' Return the terms of a chain of the same binary operation as a flat list '
+    ans = []
+    for x in argument:
+        if x[0] == op:
+            ans.extend(flatten_chain(op, x[1:]))
+        else:
+            ans.append(x)
+    return ans
+
+
+def node_as_text(node):
+    op = node[0]
+    if op == 'token':
+        return '%s:"%s"' % (node[1], node[2])
+    if op == 'not':
+        return 'not ' + node_as_text(node[1])
+    return '(' + (' %s ' % op).join(node_as_text(x) for x in flatten_chain(op, node[1:])) + ')'
+
 # Testing {{{
 
 
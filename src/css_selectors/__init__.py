@@ -7,7 +7,7 @@ __license__ = 'GPL v3'
 __copyright__ = '2015, Kovid Goyal <kovid at kovidgoyal.net>'
 
 from css_selectors.parser import parse
-from css_selectors.select import Select, INAPPROPRIATE_PSEUDO_CLASSES
+from css_selectors.select import Select, SelectorIndex, INAPPROPRIATE_PSEUDO_CLASSES
 from css_selectors.errors import SelectorError, SelectorSyntaxError, ExpressionError
 
-__all__ = ['parse', 'Select', 'INAPPROPRIATE_PSEUDO_CLASSES', 'SelectorError', 'SelectorSyntaxError', 'ExpressionError']
+__all__ = ['parse', 'Select', 'SelectorIndex', 'INAPPROPRIATE_PSEUDO_CLASSES', 'SelectorError', 'SelectorSyntaxError', 'ExpressionError']
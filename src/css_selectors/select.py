@@ -13,8 +13,8 @@ from itertools import chain
 
 from lxml import etree
 
-from css_selectors.errors import ExpressionError
-from css_selectors.parser import parse, ascii_lower, Element
+from css_selectors.errors import ExpressionError, SelectorError
+from css_selectors.parser import parse, ascii_lower, Element, Hash, Class, CombinedSelector
 from css_selectors.ordered_set import OrderedSet
 
 PARSE_CACHE_SIZE = 200
@@ -81,6 +81,69 @@ def normalize_language_tag(tag):
 INAPPROPRIATE_PSEUDO_CLASSES = frozenset([
     'active', 'after', 'disabled', 'visited', 'link', 'before', 'focus', 'first-letter', 'enabled', 'first-line', 'hover', 'checked', 'target'])
 
+def rightmost_key(parsed_tree):
+    ''' Return the (kind, key) that an element must have to match the
+    rightmost compound selector of parsed_tree. kind is one of 'id', 'class' or
+    'tag' and is None for selectors that can match any element. '''
+    while isinstance(parsed_tree, CombinedSelector):
+        parsed_tree = parsed_tree.subselector
+    cls = tag = None
+    while parsed_tree is not None:
+        if isinstance(parsed_tree, Hash):
+            return 'id', ascii_lower(parsed_tree.id)
+        if isinstance(parsed_tree, Class):
+            cls = ascii_lower(parsed_tree.class_name)
+        elif isinstance(parsed_tree, Element):
+            if parsed_tree.element and parsed_tree.element != '*':
+                tag = ascii_lower(parsed_tree.element)
+            break
+        parsed_tree = getattr(parsed_tree, 'selector', None)
+    if cls is not None:
+        return 'class', cls
+    if tag is not None:
+        return 'tag', tag
+    return None, None
+
+class SelectorIndex(object):
+
+    '''
+    A list of selectors, parsed once and bucketed by the id, class or tag name
+    in their rightmost compound selector. Use it with
+    :meth:`Select.candidate_selectors` to find the selectors that can possibly
+    match a tree, without evaluating all of them. The index does not depend on
+    any tree, so the same index can be used with any number of trees.
+
+    >>> index = SelectorIndex(['p.myclass', '#myid', 'div > *'])
+    >>> for i in sorted(select.candidate_selectors(index)):
+    ...     print(tuple(select.select_parsed(index.parsed[i])))
+
+    Selectors that fail to parse have None as their parsed value and the error
+    in the errors dict.
+    '''
+
+    def __init__(self, selectors):
+        self.parsed = []
+        self.errors = {}
+        self.buckets = {'id':defaultdict(list), 'class':defaultdict(list), 'tag':defaultdict(list)}
+        self.universal = []
+        for i, raw in enumerate(selectors):
+            try:
+                parsed = get_parsed_selector(raw)
+            except SelectorError as err:
+                self.errors[i] = err
+                self.parsed.append(None)
+                continue
+            self.parsed.append(parsed)
+            for selector in parsed:
+                kind, key = rightmost_key(selector.parsed_tree)
+                if kind is None:
+                    self.universal.append(i)
+                else:
+                    self.buckets[kind][key].append(i)
+
+    def __len__(self):
+        return len(self.parsed)
+
 class Select(object):
 
     '''
@@ -169,21 +232,39 @@ class Select(object):
         specify root, then only tags that are root or descendants of root are
         returned. Note that this can be very expensive if root has a lot of
         descendants. '''
+        for item in self.select_parsed(get_parsed_selector(selector), root=root):
+            yield item
+
+    def has_matches(self, selector, root=None):
+        'Return True iff selector matches at least one item in the tree'
+        for elem in self(selector, root=root):
+            return True
+        return False
+
+    def select_parsed(self, parsed_selectors, root=None):
+        ''' Same as calling this object, except that it takes a list of
+        selectors already parsed by :func:`css_selectors.parse` '''
         seen = set()
         if root is not None:
             root = frozenset(self.itertag(root))
-        for selector in get_parsed_selector(selector):
+        for selector in parsed_selectors:
             parsed_selector = selector.parsed_tree
             for item in self.iterparsedselector(parsed_selector):
                 if item not in seen and (root is None or item in root):
                     yield item
                     seen.add(item)
 
-    def has_matches(self, selector, root=None):
-        'Return True iff selector matches at least one item in the tree'
-        for elem in self(selector, root=root):
-            return True
-        return False
+    def candidate_selectors(self, index):
+        ''' Return the set of positions in index (a :class:`SelectorIndex`) of
+        the selectors that can match something in the tree. Selectors whose
+        rightmost id, class or tag name is not present in the tree are
+        excluded, without being evaluated. '''
+        ans = set(index.universal)
+        for kind, elem_map in (('id', self.id_map), ('class', self.class_map), ('tag', self.element_map)):
+            for key, positions in index.buckets[kind].iteritems():
+                if elem_map.get(key):
+                    ans.update(positions)
+        return ans
     # }}}
 
     def iterparsedselector(self, parsed_selector):
@@ -12,7 +12,7 @@ from lxml import etree, html
 
 from css_selectors.errors import SelectorSyntaxError, ExpressionError
 from css_selectors.parser import tokenize, parse
-from css_selectors.select import Select
+from css_selectors.select import Select, SelectorIndex
 
 class TestCSSSelectors(unittest.TestCase):
 
@@ -795,6 +795,22 @@ by William Shakespeare
         assert count('div[class|=dialog]') == 50  # ? Seems right
         assert count('div[class~=dialog]') == 51  # ? Seems right
 
+    def test_selector_index(self):
+        document = html.document_fromstring(self.HTML_SHAKESPEARE)
+        select = Select(document)
+        selectors = ['div.dialog', '#speech5', 'DIV#scene1 div.Dialog div', 'div > *', 'p.nosuchclass', '#nosuchid',
+                     'nosuchtag', 'div.character, div.dialog', 'div + div', '*', '[class]', 'div:first-child', 'span div.dialog', 'div ..']
+        index = SelectorIndex(selectors)
+        self.ae(set(index.errors), {len(selectors) - 1})
+        candidates = select.candidate_selectors(index)
+        for i in (4, 5, 6):
+            self.assertNotIn(i, candidates)
+        for i, selector in enumerate(selectors[:-1]):
+            expected = tuple(select(selector))
+            self.ae(i in candidates, bool(expected) or i == 12)
+            if i in candidates:
+                self.ae(tuple(select.select_parsed(index.parsed[i])), expected)
+
     # }}}
 
 # Run tests {{{